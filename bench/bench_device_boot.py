@@ -0,0 +1,105 @@
+"""Measure how long OakCameraFactory takes to bring up several devices, using fake devices with a fixed boot latency.
+
+Also records the slowest queue lookup made while the devices were booting, which should
+stay far below the boot latency since lookups never wait on a boot.
+
+Usage:
+    python bench/bench_device_boot.py [--devices 6] [--boot-seconds 2] [--workers 4]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from threading import Lock
+
+import depthai as dai
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from oakd.oak_camera_factory import (OakCameraFactory,  # noqa: E402
+                                     PipelineRequirement)
+
+
+class FakeQueue:
+    def close(self) -> None:
+        pass
+
+
+class FakeDevice:
+    """Stands in for dai.Device: booting just sleeps for BOOT_SECONDS."""
+    BOOT_SECONDS = 2.0
+    MXIDS: list = []
+    lock = Lock()
+    scans = 0
+
+    def __init__(self, pipeline: dai.Pipeline, info: dai.DeviceInfo) -> None:
+        time.sleep(self.BOOT_SECONDS)
+        self.names = ["rgb", "nn"] if info is not None else []
+
+    @classmethod
+    def getAllAvailableDevices(cls) -> list:
+        with cls.lock:
+            cls.scans += 1
+        # a scan of the XLink devices takes a while too
+        time.sleep(0.1)
+        return [dai.DeviceInfo(mxid) for mxid in cls.MXIDS]
+
+    def getOutputQueueNames(self) -> list:
+        return self.names
+
+    def getOutputQueue(self, name: str, maxSize: int, blocking: bool) -> FakeQueue:
+        return FakeQueue()
+
+    def readCalibration(self) -> dai.CalibrationHandler:
+        return dai.CalibrationHandler()
+
+    def close(self) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--devices", type=int, default=6)
+    parser.add_argument("--boot-seconds", type=float, default=2.0)
+    parser.add_argument("--workers", type=int, default=OakCameraFactory.BOOT_WORKERS)
+    args = parser.parse_args()
+
+    FakeDevice.BOOT_SECONDS = args.boot_seconds
+    FakeDevice.MXIDS = ["FAKE%02d" % i for i in range(args.devices)]
+    OakCameraFactory.useDeviceClass(FakeDevice)
+
+    factory = OakCameraFactory()
+    OakCameraFactory.BOOT_DEBOUNCE_SECONDS = 0.0
+    OakCameraFactory.bootPool = type(OakCameraFactory.bootPool)(max_workers=args.workers)
+
+    start = time.monotonic()
+    for mxid in FakeDevice.MXIDS:
+        factory.submit(mxid, "camera/bench", PipelineRequirement())
+
+    slowest_lookup = 0.0
+    while True:
+        lookup_start = time.monotonic()
+        ready = [factory.getRbgQueue(mxid) is not None for mxid in FakeDevice.MXIDS]
+        slowest_lookup = max(slowest_lookup, (time.monotonic() - lookup_start) / len(ready))
+        if all(ready):
+            break
+        time.sleep(0.005)
+    elapsed = time.monotonic() - start
+
+    for mxid in FakeDevice.MXIDS:
+        factory.withdraw(mxid, "camera/bench")
+
+    print(json.dumps({
+        "devices": args.devices,
+        "workers": args.workers,
+        "boot_seconds_per_device": args.boot_seconds,
+        "all_ready_seconds": round(elapsed, 3),
+        "serial_estimate_seconds": round(args.devices * args.boot_seconds, 3),
+        "device_scans": FakeDevice.scans,
+        "slowest_queue_lookup_us": round(slowest_lookup * 1e6, 1),
+    }))
+
+
+if __name__ == "__main__":
+    main()
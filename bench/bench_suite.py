@@ -0,0 +1,731 @@
+"""Benchmark the module against simulated devices, no OAK needed.
+
+Runs each benchmark against OakCameraFactory with SimulatedDevice and prints one JSON
+document, so results of different releases can be compared by a script:
+
+    camera_thread   frames/s published by CameraThread and host CPU per camera
+    get_image       OakCamera.get_image latency percentiles under concurrent callers
+    detections      OakVisionService.get_detections_from_camera latency percentiles
+    tracking        box updates/s and get_tracks latency with an object tracker and the NN at --nn-fps
+    host_inference  how long --callers concurrent get_detections(image) calls take with --inference-threads in flight
+                    and --nn-latency-ms per inference
+    idle            frames/s and host CPU of an idle camera, and how long its first image takes
+    boot            time until several devices are all streaming
+    startup         import time of the module, and time from creating a camera to its first frame
+    streams         preview get_image latency, alone and while other callers read the full resolution ISP stream
+    shared_memory   frames read by another process through gRPC get_image and through the shared memory ring
+    record_replay   host CPU and write cost of recording the device MJPEG and NN results, replay rate and seek time
+    tuning          NN results/s and latency of every auto_tune trial on a modelled NN taking --inference-ms,
+                    the settings picked, and whether a restart applies them without sweeping again
+
+Host CPU is the CPU time of the whole process minus the time spent inside the simulated
+devices, in percent of one core.
+
+Usage:
+    python bench/bench_suite.py [--benchmarks camera_thread,get_image,detections,tracking,host_inference,idle,boot,startup,streams,shared_memory,record_replay,tuning]
+        [--seconds 5] [--fps 30] [--width 640] [--height 480] [--cameras 2]
+        [--callers 1,8] [--interval-ms 0] [--nn-fps 10] [--inference-threads 2] [--idle-fps 1] [--isp-resolution 4k] [--isp-readers 2] [--devices 4] [--boot-seconds 1] [--inference-ms 45] [--output results.json]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import Future
+from threading import Event
+from typing import Any, Awaitable, Callable, Dict, List
+
+# depthai logs its warnings to stdout, which is kept for the report
+os.environ.setdefault("DEPTHAI_LEVEL", "error")
+
+import depthai as dai  # noqa: E402
+import numpy as np  # noqa: E402
+from grpclib.server import Server as GRPCServer  # noqa: E402
+from PIL import Image  # noqa: E402
+from viam.proto.app.robot import ComponentConfig  # noqa: E402
+from viam.components.camera import CameraRPCService  # noqa: E402
+from viam.resource.manager import ResourceManager  # noqa: E402
+from viam.utils import dict_to_struct  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from oakd.detection_thread import DETECTION_THREADS, TRACKING_THREADS  # noqa: E402
+from oakd.host_inference import HOST_INFERENCE_THREADS  # noqa: E402
+from oakd.oak_camera import OakCamera  # noqa: E402
+from oakd.nn_tuning import (FactoryTrialRunner, NNTuner, TuningConfig,  # noqa: E402
+                            TuningStore, sweep)
+from oakd.oak_camera_factory import OakCameraFactory, PipelineRequirement  # noqa: E402
+from oakd.oak_vision_service import OakVisionService  # noqa: E402
+from oakd.replay_device import ReplayDevice, ReplaySettings  # noqa: E402
+from oakd.simulated_device import SimulatedDevice, SimulationSettings  # noqa: E402
+
+
+class CpuMeter:
+    """Host CPU used between start and stop, without the simulated devices' share."""
+
+    def __init__(self) -> None:
+        self.process = time.process_time()
+        self.device = SimulatedDevice.cpu_seconds
+        self.wall = time.monotonic()
+
+    def stop(self) -> Dict[str, float]:
+        wall = time.monotonic() - self.wall
+        host = (time.process_time() - self.process) - (SimulatedDevice.cpu_seconds - self.device)
+        return {"seconds": round(wall, 3), "host_cpu_percent": round(100.0 * host / wall, 1)}
+
+
+def camera_config(mxid: str, args: argparse.Namespace, **attributes: Any) -> ComponentConfig:
+    return ComponentConfig(name="bench-" + mxid, attributes=dict_to_struct(dict({
+        "mxid": mxid, "fps": args.fps, "width_px": args.width, "height_px": args.height,
+    }, **attributes)))
+
+
+async def wait_for(ready: Callable[[], bool], timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not ready():
+        if time.monotonic() > deadline:
+            raise TimeoutError("simulated devices did not come up")
+        await asyncio.sleep(0.01)
+
+
+def latencies(samples: List[float]) -> Dict[str, float]:
+    # exact percentiles, the stats histograms are too coarse for sub-millisecond calls
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples) * 1000.0
+    return {
+        "count": len(samples),
+        "mean_ms": round(float(values.mean()), 4),
+        "p50_ms": round(float(np.percentile(values, 50)), 4),
+        "p90_ms": round(float(np.percentile(values, 90)), 4),
+        "p99_ms": round(float(np.percentile(values, 99)), 4),
+        "max_ms": round(float(values.max()), 4),
+    }
+
+
+async def call_repeatedly(call: Callable[[], Awaitable[Any]], callers: int, seconds: float, interval: float) -> List[float]:
+    """Latencies of call made by several concurrent callers, each waiting interval between its calls."""
+    samples: List[float] = []
+    end = time.monotonic() + seconds
+
+    async def caller() -> None:
+        while time.monotonic() < end:
+            start = time.perf_counter()
+            await call()
+            samples.append(time.perf_counter() - start)
+            # yields to the other callers even without an interval
+            await asyncio.sleep(interval)
+
+    await asyncio.gather(*[caller() for _ in range(callers)])
+    return samples
+
+
+async def bench_camera_thread(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    mxids = ["SIMCAM%02d" % i for i in range(args.cameras)]
+    cameras = [OakCamera.new(camera_config(mxid, args), {}) for mxid in mxids]
+    await wait_for(lambda: all(camera.worker.has_frame_stream() for camera in cameras))
+    await asyncio.sleep(1.0)
+
+    received = [camera.worker.stats.queue("rgb").received for camera in cameras]
+    meter = CpuMeter()
+    await asyncio.sleep(args.seconds)
+    result = meter.stop()
+    received = [camera.worker.stats.queue("rgb").received - start for camera, start in zip(cameras, received)]
+    convert = cameras[0].worker.stats.stage("convert").snapshot()
+    for camera in cameras:
+        camera.stop()
+
+    return [dict(result, **{
+        "benchmark": "camera_thread",
+        "cameras": args.cameras,
+        "fps": args.fps,
+        "resolution": [args.width, args.height],
+        "frames_per_second": round(sum(received) / result["seconds"] / args.cameras, 1),
+        "host_cpu_percent_per_camera": round(result["host_cpu_percent"] / args.cameras, 1),
+        "convert_p50_ms": round(convert["p50_ms"], 3),
+    })]
+
+
+async def bench_get_image(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    camera = OakCamera.new(camera_config("SIMIMAGE", args), {})
+    await wait_for(camera.worker.has_frame_stream)
+    await asyncio.sleep(1.0)
+
+    results = []
+    for callers in args.callers:
+        encodes = camera.worker.encoded.encodes
+        meter = CpuMeter()
+        samples = await call_repeatedly(lambda: camera.get_image("image/jpeg", timeout=5), callers, args.seconds, args.interval_ms / 1000.0)
+        result = meter.stop()
+        results.append(dict(result, **{
+            "benchmark": "get_image",
+            "callers": callers,
+            "interval_ms": args.interval_ms,
+            "fps": args.fps,
+            "resolution": [args.width, args.height],
+            "calls_per_second": round(len(samples) / result["seconds"], 1),
+            "encodes": camera.worker.encoded.encodes - encodes,
+        }, **latencies(samples)))
+    camera.stop()
+    return results
+
+
+async def bench_detections(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    # a vision service needs a compiled model, so it is set up by hand on top of a camera's device
+    camera = OakCamera.new(camera_config("SIMNN", args), {})
+    service = OakVisionService("bench-vision")
+    service.mxid = camera.mxid
+    service.compiled = Future()
+    service.compiled.set_result(None)
+    service.worker = DETECTION_THREADS.acquire(camera.mxid, OakVisionService.CameraFactory)
+    await wait_for(service.worker.has_queue)
+    await asyncio.sleep(1.0)
+
+    results = []
+    for callers in args.callers:
+        meter = CpuMeter()
+        samples = await call_repeatedly(lambda: service.get_detections_from_camera("", timeout=5), callers, args.seconds, args.interval_ms / 1000.0)
+        result = meter.stop()
+        results.append(dict(result, **{
+            "benchmark": "detections",
+            "callers": callers,
+            "interval_ms": args.interval_ms,
+            "fps": args.fps,
+            "detections_per_result": SimulatedDevice.settings.detections,
+            "calls_per_second": round(len(samples) / result["seconds"], 1),
+        }, **latencies(samples)))
+    DETECTION_THREADS.release(service.worker, timeout=1)
+    camera.stop()
+    return results
+
+
+async def bench_tracking(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    # the simulated NN skips frames like nn_fps does, the tracker still reports on every frame
+    settings = SimulatedDevice.settings
+    settings.tracking = True
+    settings.nn_divisor = max(1, int(round(args.fps / args.nn_fps)))
+    camera = OakCamera.new(camera_config("SIMTRACK", args), {})
+    service = OakVisionService("bench-tracking")
+    service.mxid = camera.mxid
+    service.tracking = True
+    service.compiled = Future()
+    service.compiled.set_result(None)
+    service.worker = TRACKING_THREADS.acquire(camera.mxid, OakVisionService.CameraFactory)
+    nn_worker = DETECTION_THREADS.acquire(camera.mxid, OakVisionService.CameraFactory)
+    await wait_for(service.worker.has_queue)
+    await asyncio.sleep(1.0)
+
+    nn_queue = service.worker.stats.queue("nn")
+    tracklets_queue = service.worker.stats.queue("tracklets")
+    nn_received = nn_queue.received
+    tracklets_received = tracklets_queue.received
+    meter = CpuMeter()
+    samples = await call_repeatedly(lambda: service.get_tracks(timeout=5), 1, args.seconds, args.interval_ms / 1000.0)
+    result = meter.stop()
+    results = [dict(result, **{
+        "benchmark": "tracking",
+        "fps": args.fps,
+        "nn_fps": args.nn_fps,
+        "nn_results_per_second": round((nn_queue.received - nn_received) / result["seconds"], 1),
+        "box_updates_per_second": round((tracklets_queue.received - tracklets_received) / result["seconds"], 1),
+        "calls_per_second": round(len(samples) / result["seconds"], 1),
+    }, **latencies(samples))]
+    DETECTION_THREADS.release(nn_worker, timeout=1)
+    TRACKING_THREADS.release(service.worker, timeout=1)
+    camera.stop()
+    settings.tracking = False
+    settings.nn_divisor = 1
+    return results
+
+
+async def bench_host_inference(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    # the simulator answers 'nn_in' itself, the host NN branch of a real pipeline needs a compiled model
+    settings = SimulatedDevice.settings
+    settings.host_nn = True
+    camera = OakCamera.new(camera_config("SIMHOST", args), {})
+    OakVisionService.CameraFactory.submit(camera.mxid, "bench-host-inference", PipelineRequirement(hostInference=True, inferenceThreads=args.inference_threads))
+    service = OakVisionService("bench-host-inference")
+    service.mxid = camera.mxid
+    service.compiled = Future()
+    service.compiled.set_result(None)
+    service.worker = DETECTION_THREADS.acquire(camera.mxid, OakVisionService.CameraFactory)
+    service.host_worker = HOST_INFERENCE_THREADS.acquire(camera.mxid, OakVisionService.CameraFactory)
+    await wait_for(service.host_worker.has_queue)
+    await asyncio.sleep(1.0)
+    image = Image.new("RGB", (args.width, args.height))
+
+    results = []
+    for callers in args.callers:
+        batches = []
+        meter = CpuMeter()
+        deadline = time.monotonic() + args.seconds
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            await asyncio.gather(*[service.get_detections(image, timeout=5) for _ in range(callers)])
+            batches.append(time.perf_counter() - start)
+        result = meter.stop()
+        results.append(dict(result, **{
+            "benchmark": "host_inference",
+            "callers": callers,
+            "inference_threads": args.inference_threads,
+            "nn_latency_ms": args.nn_latency_ms,
+            # requests beyond inference_threads wait for a free thread
+            "lower_bound_ms": round(-(-callers // args.inference_threads) * args.nn_latency_ms, 1),
+        }, **{"all_answered_" + name: value for name, value in latencies(batches).items()}))
+    HOST_INFERENCE_THREADS.release(service.host_worker, timeout=1)
+    DETECTION_THREADS.release(service.worker, timeout=1)
+    OakVisionService.CameraFactory.withdraw(camera.mxid, "bench-host-inference")
+    camera.stop()
+    settings.host_nn = False
+    return results
+
+
+async def bench_idle(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    camera = OakCamera.new(camera_config("SIMIDLE", args, idle_seconds=1.0, idle_fps=args.idle_fps), {})
+    await wait_for(camera.worker.has_frame_stream)
+    await camera.get_image("image/jpeg", timeout=5)
+    # past idle_seconds, and long enough for the frame rate to settle
+    await asyncio.sleep(2.0)
+
+    queue = camera.worker.stats.queue("rgb")
+    received = queue.received
+    meter = CpuMeter()
+    await asyncio.sleep(args.seconds)
+    result = meter.stop()
+    received = queue.received - received
+
+    start = time.perf_counter()
+    await camera.get_image("image/jpeg", timeout=5)
+    wake = time.perf_counter() - start
+    camera.stop()
+
+    return [dict(result, **{
+        "benchmark": "idle",
+        "fps": args.fps,
+        "idle_fps": args.idle_fps,
+        "resolution": [args.width, args.height],
+        "frames_per_second": round(received / result["seconds"], 1),
+        "first_image_ms": round(wake * 1000.0, 3),
+    })]
+
+
+async def bench_boot(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    boot_seconds = SimulatedDevice.settings.boot_seconds
+    SimulatedDevice.settings.boot_seconds = args.boot_seconds
+    mxids = ["SIMBOOT%02d" % i for i in range(args.devices)]
+    start = time.monotonic()
+    cameras = [OakCamera.new(camera_config(mxid, args), {}) for mxid in mxids]
+    await wait_for(lambda: all(camera.worker.has_frame_stream() for camera in cameras))
+    first_frames = await asyncio.gather(*[camera.get_image("image/jpeg", timeout=5) for camera in cameras])
+    elapsed = time.monotonic() - start
+    for camera in cameras:
+        camera.stop()
+    SimulatedDevice.settings.boot_seconds = boot_seconds
+
+    return [{
+        "benchmark": "boot",
+        "devices": args.devices,
+        "boot_seconds_per_device": args.boot_seconds,
+        "debounce_seconds": OakCameraFactory.BOOT_DEBOUNCE_SECONDS,
+        "all_streaming_seconds": round(elapsed, 3),
+        "frames": len(first_frames),
+    }]
+
+
+async def bench_streams(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    def config(name: str, stream: str) -> ComponentConfig:
+        return ComponentConfig(name="bench-" + name, attributes=dict_to_struct({
+            "mxid": "SIMSTREAMS", "fps": args.fps, "sensor_resolution": args.isp_resolution, "stream": stream,
+        }))
+
+    preview = OakCamera.new(config("preview", "preview"), {})
+    isp = OakCamera.new(config("isp", "isp"), {})
+    await preview.wait_ready(timeout=30)
+    await isp.get_image("image/jpeg", timeout=5)
+    await asyncio.sleep(1.0)
+
+    results = []
+    for readers in (0, args.isp_readers):
+        end = time.monotonic() + args.seconds
+        isp_reads = 0
+
+        async def read_isp() -> None:
+            nonlocal isp_reads
+            while time.monotonic() < end:
+                await isp.get_image("image/png", timeout=5)
+                isp_reads += 1
+
+        meter = CpuMeter()
+        readers_done = asyncio.gather(*[read_isp() for _ in range(readers)])
+        samples = await call_repeatedly(lambda: preview.get_image("image/jpeg", timeout=5), 1, args.seconds, 1.0 / args.fps)
+        await readers_done
+        result = meter.stop()
+        results.append(dict(result, **{
+            "benchmark": "streams",
+            "isp_resolution": args.isp_resolution,
+            "isp_size": list(isp.worker.frames.latest.view.shape[1::-1]) if isp.worker.frames.latest is not None else None,
+            "isp_readers": readers,
+            "isp_reads_per_second": round(isp_reads / result["seconds"], 1),
+            "preview_calls_per_second": round(len(samples) / result["seconds"], 1),
+        }, **latencies(samples)))
+    preview.stop()
+    isp.stop()
+    return results
+
+
+# run in a fresh interpreter, the module is already imported here
+IMPORT_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.load_resources()
+print(json.dumps({"import_main_ms": (imported - start) * 1000.0, "load_resources_ms": (time.perf_counter() - imported) * 1000.0}))
+"""
+
+
+async def bench_startup(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    imports = json.loads(output.strip().splitlines()[-1])
+
+    boot_seconds = SimulatedDevice.settings.boot_seconds
+    SimulatedDevice.settings.boot_seconds = args.boot_seconds
+    start = time.perf_counter()
+    camera = OakCamera.new(camera_config("SIMSTART", args), {})
+    created = time.perf_counter()
+    try:
+        await camera.get_image("image/jpeg")
+        not_ready = False
+    except TimeoutError:
+        not_ready = True
+    await camera.wait_ready(timeout=30)
+    ready = time.perf_counter()
+    await camera.get_image("image/jpeg", timeout=5)
+    first_frame = time.perf_counter()
+    camera.stop()
+    SimulatedDevice.settings.boot_seconds = boot_seconds
+
+    return [{
+        "benchmark": "startup",
+        "import_main_ms": round(imports["import_main_ms"], 1),
+        "load_resources_ms": round(imports["load_resources_ms"], 1),
+        "boot_seconds_per_device": args.boot_seconds,
+        "debounce_seconds": OakCameraFactory.BOOT_DEBOUNCE_SECONDS,
+        "new_camera_ms": round((created - start) * 1000.0, 3),
+        "not_ready_before_boot": not_ready,
+        "ready_ms": round((ready - start) * 1000.0, 1),
+        "first_frame_ms": round((first_frame - start) * 1000.0, 1),
+    }]
+
+
+# reads frames in another process for seconds, like a co-located consumer would.
+# argv: mode (grpc, shm_copy or shm_view), socket or ring path, seconds, camera name, mime type
+READER_SCRIPT = """
+import asyncio, json, sys, time
+import numpy as np
+mode, target, seconds = sys.argv[1], sys.argv[2], float(sys.argv[3])
+reads, ages, sequences, size = [], [], set(), 0
+cpu = time.process_time()
+start = time.monotonic()
+if mode == "grpc":
+    from grpclib.client import Channel
+    from viam.components.camera import CameraClient
+    async def read():
+        global size
+        channel = Channel(path=target)
+        camera = CameraClient(sys.argv[4], channel)
+        while time.monotonic() - start < seconds:
+            begin = time.perf_counter()
+            image = await camera.get_image(sys.argv[5])
+            if hasattr(image, "load"):
+                # the client hands out decoded images, which PIL only decodes on first use
+                image.load()
+                size = image.width * image.height * len(image.getbands())
+            else:
+                size = len(image.data)
+            reads.append(time.perf_counter() - begin)
+        channel.close()
+    asyncio.run(read())
+else:
+    from oakd.shared_frames import SharedFrameReader
+    reader = SharedFrameReader(target)
+    sequence = None
+    while time.monotonic() - start < seconds:
+        if reader.next(sequence, timeout=1.0) is None:
+            continue
+        # only the read itself is timed, not the wait for the next frame
+        begin = time.perf_counter()
+        frame = reader.read() if mode == "shm_copy" else reader.latest()
+        # a zero-copy reader touches the whole frame once, like a consumer handing it on would
+        checksum = int(frame.array[::8].sum()) if mode == "shm_view" else 0
+        valid = frame.valid()
+        reads.append(time.perf_counter() - begin)
+        ages.append(time.monotonic() - frame.timestamp)
+        if valid:
+            sequences.add(frame.sequence)
+        sequence = frame.sequence
+        size = frame.array.nbytes
+wall = time.monotonic() - start
+values = np.asarray(reads) * 1000.0
+print(json.dumps({
+    "reads_per_second": round(len(reads) / wall, 1),
+    "distinct_frames_per_second": round(len(sequences) / wall, 1) if sequences else None,
+    "bytes_per_read": size,
+    "read_p50_ms": round(float(np.percentile(values, 50)), 4),
+    "read_p99_ms": round(float(np.percentile(values, 99)), 4),
+    "capture_to_read_p50_ms": round(float(np.percentile(ages, 50)) * 1000.0, 3) if ages else None,
+    "reader_cpu_percent": round(100.0 * (time.process_time() - cpu) / wall, 1),
+}))
+"""
+
+
+async def bench_shared_memory(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    # the gRPC path is a real CameraRPCService on a unix socket, like the RDK talks to the module
+    camera = OakCamera.new(camera_config("SIMSHM", args), {})
+    await camera.wait_ready(timeout=30)
+    await camera.get_image("image/jpeg", timeout=5)
+    socket_path = os.path.join(tempfile.mkdtemp(), "camera.sock")
+    server = GRPCServer([CameraRPCService(ResourceManager([camera]))])
+    await server.start(path=socket_path)
+
+    async def read(mode: str, target: str, mime_type: str = "") -> Dict[str, Any]:
+        reader = await asyncio.create_subprocess_exec(sys.executable, "-c", READER_SCRIPT, mode, target, str(args.seconds), camera.name, mime_type,
+                                                      cwd=ROOT, stdout=asyncio.subprocess.PIPE)
+        output, _ = await reader.communicate()
+        return json.loads(output.decode().strip().splitlines()[-1])
+
+    results = []
+    for mode, mime_type in (("grpc", "image/jpeg"), ("grpc", "image/vnd.viam.rgba"), ("shm_copy", ""), ("shm_view", "")):
+        shared = mode.startswith("shm")
+        camera.reconfigure(camera_config("SIMSHM", args, shared_memory=shared), {})
+        await asyncio.sleep(0.5)
+        meter = CpuMeter()
+        result = await read(mode, camera.worker.shared_path() if shared else socket_path, mime_type)
+        results.append(dict({
+            "benchmark": "shared_memory",
+            "mode": mode,
+            "mime_type": mime_type or None,
+            "fps": args.fps,
+            "resolution": [args.width, args.height],
+            "module_cpu_percent": meter.stop()["host_cpu_percent"],
+        }, **result))
+    server.close()
+    await server.wait_closed()
+    camera.stop()
+    return results
+
+
+async def bench_record_replay(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    directory = tempfile.mkdtemp()
+    detections = DETECTION_THREADS.acquire("SIMREC", OakCamera.CameraFactory)
+    results = []
+    for record in (False, True):
+        attributes = {"record_dir": directory} if record else {"jpeg_encoder": "device"}
+        camera = OakCamera.new(camera_config("SIMREC", args, **attributes), {})
+        await camera.wait_ready(timeout=30)
+        await camera.get_image("image/jpeg", timeout=5)
+        await asyncio.sleep(1.0)
+        status = await camera.do_command({"command": "recording"})
+        written = status.get("bytes", 0)
+        meter = CpuMeter()
+        await asyncio.sleep(args.seconds)
+        result = meter.stop()
+        status = await camera.do_command({"command": "recording"})
+        stage = camera.worker.stats.stage("record").snapshot()
+        results.append(dict(result, **{
+            "benchmark": "record_replay",
+            "mode": "record" if record else "encode_only",
+            "fps": args.fps,
+            "resolution": [args.width, args.height],
+            "written_mb_per_second": round((status.get("bytes", 0) - written) / result["seconds"] / 1e6, 2) if record else None,
+            "record_mean_ms": round(stage["mean_ms"], 4) if record and stage["count"] else None,
+        }))
+        camera.stop()
+    DETECTION_THREADS.release(detections, timeout=1)
+    await asyncio.sleep(0.5)
+
+    # the same camera on a device playing the recording back, frames are decoded from the MJPEG
+    OakCameraFactory.useDeviceClass(ReplayDevice)
+    for speed in (1.0, 0.0):
+        ReplayDevice.settings = ReplaySettings(directory, speed=speed, boot_seconds=0.2)
+        camera = OakCamera.new(camera_config("SIMREC", args), {})
+        await camera.wait_ready(timeout=30)
+        await camera.get_image("image/jpeg", timeout=5)
+        queue = camera.worker.stats.queue("rgb")
+        received = queue.received
+        meter = CpuMeter()
+        await asyncio.sleep(args.seconds)
+        result = meter.stop()
+        received = queue.received - received
+        position = await camera.do_command({"command": "replay"})
+        seeks = []
+        for target in np.linspace(position["first"], position["last"], 20).astype(int).tolist():
+            start = time.perf_counter()
+            await camera.do_command({"command": "replay", "seek": target})
+            # the frame of the new position, a replay sends it right away
+            camera.worker.frames.release(await camera.worker.next_frame())
+            seeks.append(time.perf_counter() - start)
+        results.append(dict(result, **{
+            "benchmark": "record_replay",
+            "mode": "replay",
+            "speed": speed,
+            "resolution": [args.width, args.height],
+            "frames_per_second": round(received / result["seconds"], 1),
+            "seek_to_frame_p50_ms": round(float(np.percentile(seeks, 50)) * 1000.0, 3),
+        }))
+        camera.stop()
+        await asyncio.sleep(0.5)
+    OakCameraFactory.useDeviceClass(SimulatedDevice)
+    return results
+
+
+class SimulatedTrialRunner(FactoryTrialRunner):
+    """Runs trials on the simulator's modelled NN, which takes its knobs from SimulationSettings instead of a blob."""
+    RESOURCE = "bench-tuning"
+
+    def apply(self, config: TuningConfig, stopped: Event) -> Any:
+        # the knobs only change the pipeline through the blob on a device, so the simulated one is closed to pick them up
+        self.factory.withdraw(self.mxid, self.RESOURCE)
+        deadline = time.monotonic() + self.BOOT_TIMEOUT_SECONDS
+        while self.factory.getDevice(self.mxid) is not None:
+            if stopped.wait(0.05) or time.monotonic() > deadline:
+                return "device did not stop"
+        settings = SimulatedDevice.settings
+        settings.nn_shaves = config.shaves if config.shaves is not None else 6
+        settings.nn_threads = config.threads
+        settings.nn_nce = config.nce if config.nce is not None else 1
+        settings.nn_queue_size = config.queue_size if config.queue_size is not None else 5
+        fields = dict(self.fields, **config.fields())
+        self.submit(PipelineRequirement(self.options, **fields))
+        return fields
+
+
+async def bench_tuning(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    settings = SimulatedDevice.settings
+    settings.nn_inference_seconds = args.inference_ms / 1000.0
+    mxid = "SIMTUNE"
+    factory = OakVisionService.CameraFactory
+    store = TuningStore(os.path.join(tempfile.mkdtemp(), "tuning.json"))
+    runner = SimulatedTrialRunner(factory, mxid, lambda requirement: factory.submit(mxid, SimulatedTrialRunner.RESOURCE, requirement) is not None,
+                                  None, None, None, {"fps": args.fps, "streams": ("rgb",)}, args.seconds)
+    loop = asyncio.get_running_loop()
+    # what a zoo model ran with before tuning
+    baseline = await loop.run_in_executor(None, runner, TuningConfig(6, 1), Event())
+
+    def done(tuner: NNTuner) -> None:
+        store.remember_device(mxid, settings.device_name)
+        store.save("bench-model", settings.device_name, {}, tuner.best, tuner.results)
+
+    configs, queue_sizes = sweep({})
+    tuner = NNTuner(runner, configs, queue_sizes, done)
+    meter = CpuMeter()
+    tuner.start()
+    await loop.run_in_executor(None, tuner.join)
+    result = meter.stop()
+    factory.withdraw(mxid, SimulatedTrialRunner.RESOURCE)
+
+    # a restart finds the device type and the settings in the file without running anything
+    start = time.perf_counter()
+    restarted = TuningStore(store.path)
+    device_name = restarted.device_name(mxid)
+    stored = None if device_name is None else restarted.lookup("bench-model", device_name, {})
+    lookup = time.perf_counter() - start
+
+    settings.nn_inference_seconds = None
+    settings.nn_shaves, settings.nn_threads, settings.nn_nce, settings.nn_queue_size = 6, 1, 1, 5
+    best = tuner.best
+    return [dict(result, **{
+        "benchmark": "tuning",
+        "fps": args.fps,
+        "inference_ms": args.inference_ms,
+        "trial_seconds": args.seconds,
+        "trials": [trial.to_dict() for trial in tuner.results],
+        "baseline": baseline.to_dict(),
+        "best": None if best is None else best.to_dict(),
+        "restart_applies_best": stored is not None and best is not None and stored.config == best.config,
+        "restart_lookup_ms": round(lookup * 1000.0, 3),
+    })]
+
+
+BENCHMARKS = {
+    "camera_thread": bench_camera_thread,
+    "get_image": bench_get_image,
+    "detections": bench_detections,
+    "tracking": bench_tracking,
+    "host_inference": bench_host_inference,
+    "idle": bench_idle,
+    "boot": bench_boot,
+    "startup": bench_startup,
+    "streams": bench_streams,
+    "shared_memory": bench_shared_memory,
+    "record_replay": bench_record_replay,
+    "tuning": bench_tuning,
+}
+
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    for name in args.benchmarks:
+        print("running benchmark ", name, file=sys.stderr)
+        results.extend(await BENCHMARKS[name](args))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--benchmarks", type=lambda value: value.split(","), default=list(BENCHMARKS.keys()))
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--cameras", type=int, default=2)
+    parser.add_argument("--callers", type=lambda value: [int(count) for count in value.split(",")], default=[1, 8])
+    parser.add_argument("--interval-ms", type=float, default=0, help="pause of each caller between calls")
+    parser.add_argument("--nn-fps", type=float, default=10, help="NN rate of the tracking benchmark")
+    parser.add_argument("--inference-threads", type=int, default=2, help="host inference requests in flight in the host_inference benchmark")
+    parser.add_argument("--idle-fps", type=float, default=1)
+    parser.add_argument("--isp-resolution", default="4k", help="sensor_resolution of the streams benchmark")
+    parser.add_argument("--isp-readers", type=int, default=2, help="callers reading the ISP stream in the streams benchmark")
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--boot-seconds", type=float, default=1.0)
+    parser.add_argument("--nn-latency-ms", type=float, default=30)
+    parser.add_argument("--inference-ms", type=float, default=45, help="inference time of the modelled NN in the tuning benchmark, at 6 shaves")
+    parser.add_argument("--output", help="also write the results to this file")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmarks: " + ", ".join(unknown))
+
+    # the camera pipeline has no NN without a compiled model, the simulator adds its output
+    SimulatedDevice.settings = SimulationSettings(boot_seconds=0.2, nn="yolo", nn_latency=args.nn_latency_ms / 1000.0)
+    OakCameraFactory.useDeviceClass(SimulatedDevice)
+    factory = OakCameraFactory()
+    OakCamera.CameraFactory = factory
+    OakVisionService.CameraFactory = factory
+
+    # the module's diagnostics go to stderr, so stdout is only the report
+    with contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.run(run(args))
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "depthai": dai.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,70 @@
 import asyncio
+import os
 import sys
-from typing import Any, Mapping, Union
+import time
+from threading import Lock, Thread
+from typing import Any, Mapping, Tuple, Union
 
+from viam.components.camera import Camera
 from viam.logging import logging
-from viam.module.types import Stoppable
 from viam.module.module import Module
-from oakd.oak_camera import OakCamera
-from oakd.oak_vision_service import OakVisionService
-from oakd.oak_camera_factory import OakCameraFactory
-from viam.resource.registry import Registry, ResourceCreatorRegistration, ResourceRegistration
+from viam.resource.registry import Registry, ResourceCreatorRegistration
+from viam.services.vision import Vision
+
+from oakd.models import CAMERA_MODEL, VISION_MODEL
+
+# the resources import depthai, numpy and cv2, which takes a while. They are loaded in the
+# background once the module is up, or by the first resource the RDK creates before that.
+resources_lock = Lock()
+resources: Union[Tuple[Any, Any], None] = None
+
+def load_resources() -> Tuple[Any, Any]:
+    """Import and set up the camera and the vision service, returns their classes."""
+    global resources
+    with resources_lock:
+        if resources is not None:
+            return resources
+        start = time.monotonic()
+        from oakd.blob_cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_BYTES, BlobCache
+        from oakd.nn_tuning import DEFAULT_TUNING_FILE, TuningStore
+        from oakd.oak_camera import OakCamera
+        from oakd.oak_camera_factory import OakCameraFactory
+        from oakd.oak_vision_service import OakVisionService
+
+        # runs the module without hardware, the listed mxids stand in for devices
+        simulated = os.environ.get("OAK_SIMULATED_DEVICES")
+        if simulated:
+            from oakd.simulated_device import SimulatedDevice, SimulationSettings
+            print("using simulated devices ", simulated)
+            SimulatedDevice.settings = SimulationSettings(mxids=simulated.split(","), nn=os.environ.get("OAK_SIMULATED_NN"))
+            OakCameraFactory.useDeviceClass(SimulatedDevice)
+        # or plays back what cameras with record_dir recorded there
+        replay = os.environ.get("OAK_REPLAY_DIR")
+        if replay:
+            from oakd.replay_device import ReplayDevice, ReplaySettings
+            print("replaying recordings in ", replay)
+            ReplayDevice.settings = ReplaySettings(replay, speed=float(os.environ.get("OAK_REPLAY_SPEED", "1.0")))
+            OakCameraFactory.useDeviceClass(ReplayDevice)
+        cameraFactory = OakCameraFactory()
+        OakVisionService.CameraFactory = cameraFactory
+        OakCamera.CameraFactory = cameraFactory
+
+        # compiled blobs are kept across restarts so sites without network can still load their models
+        cache_dir = os.environ.get("OAK_BLOB_CACHE_DIR", DEFAULT_CACHE_DIR)
+        cache_max_bytes = int(os.environ.get("OAK_BLOB_CACHE_MAX_MB", DEFAULT_CACHE_MAX_BYTES // (1024 * 1024))) * 1024 * 1024
+        OakVisionService.BlobCache = BlobCache(cache_dir, cache_max_bytes)
+        # NN settings found by auto_tune, applied again on the next start
+        OakVisionService.Tuning = TuningStore(os.environ.get("OAK_TUNING_FILE", DEFAULT_TUNING_FILE))
+
+        print("loaded oak resources in ", time.monotonic() - start, "s")
+        resources = (OakCamera, OakVisionService)
+        return resources
+
+def new_camera(config, dependencies):
+    return load_resources()[0].new(config, dependencies)
+
+def new_vision_service(config, dependencies):
+    return load_resources()[1].new(config, dependencies)
 
 async def main(address: str):
     """This function creates and starts a new oak module. It adds support for a Vision Service and a Camera Component.
@@ -17,19 +73,17 @@ async def main(address: str):
         address (str): The address to serve the module on
     """
     print("initializing oak module")
-    cameraFactory = OakCameraFactory()
-    OakVisionService.CameraFactory = cameraFactory
-    OakCamera.CameraFactory = cameraFactory
 
     print("adding creators")
-    Registry.register_resource_creator(OakVisionService.SUBTYPE, OakVisionService.MODEL, ResourceCreatorRegistration(OakVisionService.new))
-    Registry.register_resource_creator(OakCamera.SUBTYPE, OakCamera.MODEL, ResourceCreatorRegistration(OakCamera.new))
+    Registry.register_resource_creator(Vision.SUBTYPE, VISION_MODEL, ResourceCreatorRegistration(new_vision_service))
+    Registry.register_resource_creator(Camera.SUBTYPE, CAMERA_MODEL, ResourceCreatorRegistration(new_camera))
 
     module = Module(address, log_level=logging.DEBUG)
     print("registering types")
-    module.add_model_from_registry(OakVisionService.SUBTYPE, OakVisionService.MODEL)
-    module.add_model_from_registry(OakCamera.SUBTYPE, OakCamera.MODEL)
-    
+    module.add_model_from_registry(Vision.SUBTYPE, VISION_MODEL)
+    module.add_model_from_registry(Camera.SUBTYPE, CAMERA_MODEL)
+
+    Thread(target=load_resources, name="oak-load", daemon=True).start()
     print("starting module")
     await module.start()
 
@@ -0,0 +1,213 @@
+import copy
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Callable, List, Union
+
+# zoo blobs are compiled for 6 shaves unless tuning picked another count
+ZOO_SHAVES = 6
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "viam-oak", "blobs")
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+
+class ModelSpec:
+    """Everything that determines the blob compiled for a model."""
+    model_type: str
+    model_path: Union[str, None]
+    data_type: Union[str, None]
+    shaves: Union[int, None]
+    zoo_type: Union[str, None]
+    tf_optimizer_params: List[str]
+    caffe_proto: Union[str, None]
+    openvino_xml: Union[str, None]
+    openvino_bin: Union[str, None]
+    raw_config_path: Union[str, None]
+    raw_name: Union[str, None]
+
+    def __init__(self, model_type: Union[str, None], model_path: Union[str, None] = None, data_type: Union[str, None] = None,
+                 shaves: Union[int, None] = None, zoo_type: Union[str, None] = None, tf_optimizer_params: Union[List[str], None] = None,
+                 caffe_proto: Union[str, None] = None, openvino_xml: Union[str, None] = None, openvino_bin: Union[str, None] = None,
+                 raw_config_path: Union[str, None] = None, raw_name: Union[str, None] = None) -> None:
+        self.model_type = "" if model_type is None else model_type.lower()
+        if self.model_type not in ("zoo", "caffe", "tf", "onnx", "openvino", "raw"):
+            raise ValueError("invalid model_type")
+        self.model_path = model_path
+        self.data_type = data_type
+        self.shaves = ZOO_SHAVES if self.model_type == "zoo" and shaves is None else shaves
+        self.zoo_type = zoo_type
+        self.tf_optimizer_params = [] if tf_optimizer_params is None else list(tf_optimizer_params)
+        self.caffe_proto = caffe_proto
+        self.openvino_xml = openvino_xml
+        self.openvino_bin = openvino_bin
+        self.raw_config_path = raw_config_path
+        self.raw_name = raw_name
+
+    def model_files(self) -> List[str]:
+        """Local files the blob is compiled from. Zoo models are referenced by name only."""
+        if self.model_type == "zoo":
+            return []
+        if self.model_type == "openvino":
+            candidates = [self.openvino_xml, self.openvino_bin]
+        elif self.model_type == "raw":
+            candidates = [self.raw_config_path]
+        elif self.model_type == "caffe":
+            candidates = [self.caffe_proto, self.model_path]
+        else:
+            candidates = [self.model_path]
+        return [c for c in candidates if c is not None]
+
+    def with_shaves(self, shaves: Union[int, None]) -> "ModelSpec":
+        spec = copy.copy(self)
+        spec.shaves = ZOO_SHAVES if self.model_type == "zoo" and shaves is None else shaves
+        return spec
+
+    def cache_key(self) -> str:
+        return self._digest(include_shaves=True)
+
+    def tuning_key(self) -> str:
+        """Identifies the model whatever shave count it is compiled for, tuned settings are stored under it."""
+        return self._digest(include_shaves=False)
+
+    def _digest(self, include_shaves: bool) -> str:
+        # content addressed: renaming or copying a model keeps its key, editing it in place does not
+        digest = hashlib.sha256()
+        for path in self.model_files():
+            digest.update(_file_digest(path).encode())
+        settings = {
+            "model_type": self.model_type,
+            "data_type": self.data_type,
+            "zoo_type": self.zoo_type,
+            "tf_optimizer_params": self.tf_optimizer_params,
+            "raw_name": self.raw_name,
+            # a zoo model has no file to hash, its name is its identity
+            "zoo_name": self.model_path if self.model_type == "zoo" else None,
+        }
+        if include_shaves:
+            settings["shaves"] = self.shaves
+        digest.update(json.dumps(settings, sort_keys=True).encode())
+        return digest.hexdigest()
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compile_with_blobconverter(spec: ModelSpec) -> Path:
+    """Compile a model through blobconverter, which may need network access."""
+    # only imported when something actually has to be compiled
+    import blobconverter
+
+    if spec.model_type == "zoo":
+        return blobconverter.from_zoo(name=spec.model_path, shaves=spec.shaves, zoo_type=spec.zoo_type)
+    elif spec.model_type == "caffe":
+        return blobconverter.from_caffe(proto=spec.caffe_proto, model=spec.model_path, data_type=spec.data_type, shaves=spec.shaves)
+    elif spec.model_type == "tf":
+        return blobconverter.from_tf(frozen_pb=spec.model_path, data_type=spec.data_type, shaves=spec.shaves, optimizer_params=spec.tf_optimizer_params)
+    elif spec.model_type == "onnx":
+        return blobconverter.from_onnx(model=spec.model_path, data_type=spec.data_type, shaves=spec.shaves)
+    elif spec.model_type == "openvino":
+        return blobconverter.from_openvino(xml=spec.openvino_xml, bin=spec.openvino_bin, data_type=spec.data_type, shaves=spec.shaves)
+    elif spec.model_type == "raw":
+        return blobconverter.from_config(name=spec.raw_name, path=spec.raw_config_path, data_type=spec.data_type, shaves=spec.shaves)
+    raise ValueError("invalid model_type")
+
+
+class BlobCache:
+    """Compiled blobs stored on local disk under their ModelSpec cache key, evicted least recently used first.
+
+    A hit needs neither network nor compiler. Misses are compiled on a single background worker,
+    so a burst of resources does not start several compiles at once.
+    """
+    directory: str
+    max_bytes: int
+    converter: Callable[[ModelSpec], Path]
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+                 converter: Callable[[ModelSpec], Path] = compile_with_blobconverter) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.converter = converter
+        self.lock = Lock()
+        self.pending: dict[str, "Future[Path]"] = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="blob-compiler")
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".blob")
+
+    def get(self, key: str) -> Union[Path, None]:
+        path = self._path(key)
+        try:
+            # the modification time doubles as the last use for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return Path(path)
+
+    def put(self, key: str, blob: Path) -> Path:
+        # copy to a temporary file first so a crash never leaves a truncated blob under the key
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            shutil.copyfile(blob, tmp)
+            os.replace(tmp, self._path(key))
+        except:
+            os.unlink(tmp)
+            raise
+        self.evict(keep=key)
+        return Path(self._path(key))
+
+    def evict(self, keep: Union[str, None] = None):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".blob"):
+                    continue
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            keep_path = None if keep is None else self._path(keep)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == keep_path:
+                    continue
+                print("evicting cached blob ", path)
+                os.unlink(path)
+                total -= size
+
+    def resolve(self, spec: ModelSpec) -> "Future[Path]":
+        """Get the blob for a model, already resolved on a cache hit, compiled in the background otherwise."""
+        key = spec.cache_key()
+        blob = self.get(key)
+        if blob is not None:
+            future: "Future[Path]" = Future()
+            future.set_result(blob)
+            return future
+
+        with self.lock:
+            # several resources asking for the same model share one compile
+            future = self.pending.get(key)
+            if future is None:
+                print("blob cache miss, compiling ", spec.model_type, " model in the background")
+                future = self.executor.submit(self._compile, key, spec)
+                self.pending[key] = future
+            return future
+
+    def _compile(self, key: str, spec: ModelSpec) -> Path:
+        try:
+            return self.put(key, self.converter(spec))
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
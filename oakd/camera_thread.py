@@ -1,53 +1,311 @@
+import asyncio
 import time
-from threading import Lock, Thread
-from typing import ClassVar, Union, cast
+import weakref
+from functools import partial
+from threading import Event, Lock, Thread
+from typing import ClassVar, Dict, List, Union, cast
 
 import cv2
+import numpy as np
 import PIL.Image as img
-from depthai import DataOutputQueue, Device, ImgFrame
+from depthai import Clock, DataOutputQueue, Device, ImgFrame
 from viam.logging import logging
 
-from oakd.oak_camera_factory import OakCameraFactory
+from oakd.frame_ring import FrameRing, FrameSlot, LazyFrameRing
+from oakd.image_cache import EncodedFrameCache, EncodedPacket
+from oakd.oak_camera_factory import FRAME_STREAMS, MONO_SOCKETS, OakCameraFactory
+from oakd.queue_watch import QueueWatch, Waiters, WorkerRegistry
+from oakd.rate_limited_log import RateLimitedLogger
+from oakd.recording import RECORDINGS
+from oakd.shared_frames import SharedFrameWriter, shared_frame_path
+from oakd.stats import DeviceStats, Timer, device_stats
 
-# LOGGER: logging.Logger = logging.getLogger(__name__)
+LOGGER = RateLimitedLogger(__name__)
 
 class CameraThread(Thread):
+    """Consumes one frame stream of a device, see FRAME_STREAMS.
+
+    The thread of the 'rgb' stream also consumes the device encoded JPEGs and depth.
+    """
+    # how long to block waiting for the device before checking for a stop request or a replaced queue
+    QUEUE_WAIT_SECONDS: ClassVar[float] = 0.5
+
     running:bool
-    current_image: Union[img.Image, None] = None
+    stream: str
+    frames: FrameRing
+    # depth frames in millimeters, only filled when the pipeline has stereo depth
+    depth: FrameRing
+    encoded: EncodedFrameCache
+    jpeg: Union[EncodedPacket, None]
     camera_factory: OakCameraFactory
     stop_request: bool
+    stats: DeviceStats
+    # ring slots every resource asked for in shared memory, the largest request wins
+    exports: Dict[str, int]
+    # host JPEG quality every resource asked for, the highest wins
+    qualities: Dict[str, int]
+    # only touched by the thread itself
+    shared: Union[SharedFrameWriter, None]
 
-    def __init__(self, mxid:str, camera_factory:OakCameraFactory) -> None:
+    def __init__(self, mxid:str, camera_factory:OakCameraFactory, ring_size:int = 4, jpeg_quality:int = 75, stream:str = "rgb") -> None:
         """
 
         """
-        print("init new thread for ", mxid)
+        print("init new thread for ", mxid, " ", stream)
         if camera_factory is None:
             raise ValueError("camera_factory cannot be none")
         if mxid is None or mxid == "":
             raise ValueError("mxid must be set")
-        
+
         self.running = False
         self.camera_factory = camera_factory
         self.mxid = mxid
+        self.stream = stream
         self.lock = Lock()
         self.stop_request = False
+        self.frames = FrameRing(ring_size)
+        self.depth = FrameRing(3)
+        self.stats = device_stats(mxid)
+        # the 'rgb' stream keeps the stage names it had before there were other streams
+        prefix = "" if stream == "rgb" else stream + "_"
+        self.encoded = EncodedFrameCache(self.frames, jpeg_quality, self.stats.stage(prefix + "encode"))
+        # packets are only copied into the rings when somebody reads them
+        convert = _gray_array if stream in MONO_SOCKETS else _yuv_array if stream == "isp" else _rgb_array
+        self.lazy_frames = LazyFrameRing(self.frames, convert, self.stats.stage(prefix + "convert"), lambda slot: self.encoded.invalidate())
+        self.lazy_depth = LazyFrameRing(self.depth, _depth_array)
+        self.convert = convert
+        self.exports = {}
+        self.qualities = {}
+        self.shared = None
+        self.export_stage = self.stats.stage(prefix + "export")
+        self.record_stage = self.stats.stage("record")
+        self.jpeg = None
+        self.frame_available = Event()
+        self.watches = [QueueWatch(stream, partial(camera_factory.getQueue, name=stream))]
+        if stream == "rgb":
+            self.watches += [
+                QueueWatch("jpeg", camera_factory.getJpegQueue),
+                QueueWatch("depth", camera_factory.getDepthQueue),
+            ]
+        self.waiters = {stream: Waiters(), "jpeg": Waiters(), "depth": Waiters()}
         super().__init__()
 
     def get_image(self):
         """
+        Get the most recent frame, or None if no frame has arrived yet.
+
+        :return:
+        """
+        slot = self.acquire_frame()
+        return None if slot is None else self._to_image(slot)
+
+    def acquire_frame(self, max_age: Union[float, None] = None) -> Union[FrameSlot, None]:
+        """
+        Pin and return the slot of the latest rgb frame if it was received within max_age seconds.
+        The caller must release it with frames.release.
+
+        :return:
+        """
+        self.camera_factory.demand(self.mxid)
+        return self.lazy_frames.acquire_latest(max_age)
+
+    def acquire_frame_sequence(self, sequence: int) -> Union[FrameSlot, None]:
+        """
+        Pin and return the slot of the rgb frame with this device sequence number if it is still held.
+        The caller must release it with frames.release.
+
+        :return:
+        """
+        self.camera_factory.demand(self.mxid)
+        return self.lazy_frames.acquire_sequence(sequence)
+
+    def latest_frame_sequence(self) -> int:
+        return self.lazy_frames.latest_sequence()
+
+    def acquire_depth(self, max_age: Union[float, None] = None) -> Union[FrameSlot, None]:
+        """
+        Like acquire_frame for the depth stream, the caller must release the slot with depth.release.
 
         :return:
         """
-        # return self.current_image
-        if self.current_image is not None:
-            return self.current_image.copy()
-        else:
+        self.camera_factory.demand(self.mxid)
+        return self.lazy_depth.acquire_latest(max_age)
+
+    def acquire_depth_at(self, timestamp: float, tolerance: float) -> Union[FrameSlot, None]:
+        """
+        Pin and return the slot of the held depth frame captured closest to timestamp, if within tolerance seconds.
+        The caller must release it with depth.release.
+
+        :return:
+        """
+        self.camera_factory.demand(self.mxid)
+        return self.lazy_depth.acquire_timestamp(timestamp, tolerance)
+
+    def latest_depth_timestamp(self) -> float:
+        return self.lazy_depth.latest_timestamp()
+
+    def get_jpeg(self, max_age: float) -> Union[EncodedPacket, None]:
+        """
+        Get the most recent device encoded JPEG if it was received within max_age seconds.
+
+        :return:
+        """
+        self.camera_factory.demand(self.mxid)
+        packet = self.jpeg
+        if packet is None or time.monotonic() - packet.received > max_age:
             return None
-    
+        return packet
+
+    # asks the factory rather than the watches, which follow a new device a moment after it booted
+    def has_frame_stream(self) -> bool:
+        return self.camera_factory.getQueue(self.mxid, self.stream) is not None
+
+    def has_jpeg_stream(self) -> bool:
+        return self.stream == "rgb" and self.camera_factory.getJpegQueue(self.mxid) is not None
+
+    def has_depth_stream(self) -> bool:
+        return self.stream == "rgb" and self.camera_factory.getDepthQueue(self.mxid) is not None
+
+    def next_frame(self) -> "asyncio.Future[FrameSlot]":
+        """
+        Get a future on the running event loop that resolves with the slot of the next frame.
+        The slot is acquired for the caller, who must release it.
+
+        :return:
+        """
+        self.camera_factory.demand(self.mxid)
+        return self.waiters[self.stream].wait()
+
+    def next_jpeg(self) -> "asyncio.Future[EncodedPacket]":
+        """
+        Get a future on the running event loop that resolves with the next device encoded JPEG.
+
+        :return:
+        """
+        self.camera_factory.demand(self.mxid)
+        return self.waiters["jpeg"].wait()
+
+    def next_depth(self) -> "asyncio.Future[FrameSlot]":
+        """
+        Get a future on the running event loop that resolves with the slot of the next depth frame.
+        The slot is acquired for the caller, who must release it with depth.release.
+
+        :return:
+        """
+        self.camera_factory.demand(self.mxid)
+        return self.waiters["depth"].wait()
+
+    def export_frames(self, owner: str, slots: int) -> str:
+        """Also write every frame into a shared memory ring for other processes, until owner calls unexport_frames.
+
+        Returns the path readers open, see oakd.shared_frames.
+        """
+        with self.lock:
+            self.exports[owner] = slots
+        return self.shared_path()
+
+    def unexport_frames(self, owner: str) -> None:
+        with self.lock:
+            self.exports.pop(owner, None)
+
+    def request_jpeg_quality(self, owner: str, quality: Union[int, None]) -> None:
+        """Ask for at least this quality from the host encoder, None withdraws the owner's request."""
+        with self.lock:
+            if quality is None:
+                self.qualities.pop(owner, None)
+            else:
+                self.qualities[owner] = quality
+            if len(self.qualities) > 0 and max(self.qualities.values()) != self.encoded.jpeg_quality:
+                self.encoded.jpeg_quality = max(self.qualities.values())
+                # frames encoded at the old quality must not be handed out any more
+                self.encoded.invalidate()
+
+    def shared_path(self) -> str:
+        return shared_frame_path(self.mxid, self.stream)
+
     def stop(self):
         self.stop_request = True
-    
+        self.frame_available.set()
+
+    def _on_frame(self, *args) -> None:
+        # called from the depthai queue thread, only wakes the camera thread up
+        self.frame_available.set()
+
+    def _to_image(self, slot: FrameSlot) -> img.Image:
+        # wraps an acquired slot without copying; the slot stays pinned until the image is collected
+        mode = "L" if slot.view.ndim == 2 else "RGB"
+        image = img.frombuffer(mode, (slot.width, slot.height), slot.view, "raw", mode, 0, 1)
+        weakref.finalize(image, self.frames.release, slot)
+        return image
+
+    def _received(self, name: str, frame: ImgFrame, skipped: int) -> float:
+        # device timestamps are on the host's synced clock, so this is the capture to host latency
+        timestamp = frame.getTimestamp().total_seconds()
+        self.stats.stage(name + "_to_host").record(Clock.now().total_seconds() - timestamp)
+        self.stats.queue(name).packet(frame.getSequenceNum(), skipped)
+        return timestamp
+
+    def _publish(self, frame: ImgFrame, skipped: int = 0) -> None:
+        timestamp = self._received(self.stream, frame, skipped)
+        self.lazy_frames.push(frame, timestamp)
+        if self.exports:
+            self._export(frame, timestamp)
+        if not self.waiters[self.stream].waiting():
+            return
+        slot = self.lazy_frames.convert_newest()
+        if slot is None:
+            return
+        self.waiters[self.stream].notify(lambda: self.frames.acquire(slot), self.frames.release)
+
+    def _export(self, frame: ImgFrame, timestamp: float) -> None:
+        # straight from the packet into shared memory, the frame rings are left alone
+        with self.lock:
+            slots = max(self.exports.values(), default=0)
+        if slots == 0:
+            return
+        with Timer(self.export_stage):
+            data = self.convert(frame)
+            shared = self.shared
+            if shared is None or shared.slots != slots or data.nbytes > shared.capacity:
+                # a new ring replaces the file, readers of the old one move over by themselves
+                self.shared = SharedFrameWriter(self.shared_path(), slots, data.nbytes)
+                if shared is not None:
+                    shared.close(unlink=False)
+                shared = self.shared
+            shared.write(data, frame.getSequenceNum(), timestamp)
+        # readers in other processes are invisible to the factory, so an export keeps the device from idling
+        self.camera_factory.demand(self.mxid)
+
+    def _close_export(self) -> None:
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
+
+    def _publish_jpeg(self, frame: ImgFrame, skipped: int = 0) -> None:
+        packet = EncodedPacket(frame.getData(), frame.getSequenceNum(), self._received("jpeg", frame, skipped))
+        self.jpeg = packet
+        self.waiters["jpeg"].notify(lambda: packet)
+
+    def _record(self, packets: List[ImgFrame]) -> None:
+        # every encoded frame goes to the recording, the device already did the expensive part
+        recorder = RECORDINGS.get(self.mxid)
+        if recorder is None:
+            return
+        with Timer(self.record_stage):
+            for packet in packets:
+                recorder.write("jpeg", "jpeg", packet.getSequenceNum(), packet.getTimestamp().total_seconds(), packet.getData())
+        # like an export, a recording has no reader the factory could see
+        self.camera_factory.demand(self.mxid)
+
+    def _publish_depth(self, frame: ImgFrame, skipped: int = 0) -> None:
+        self.lazy_depth.push(frame, self._received("depth", frame, skipped))
+        if not self.waiters["depth"].waiting():
+            return
+        slot = self.lazy_depth.convert_newest()
+        if slot is None:
+            return
+        self.waiters["depth"].notify(lambda: self.depth.acquire(slot), self.depth.release)
+
     def run(self) -> None:
         print("Starting camera thread for ", self.mxid)
         self.lock.acquire()
@@ -57,36 +315,70 @@ class CameraThread(Thread):
             self.running = True
         finally:
             self.lock.release()
-        print("Camera thread now running", self.mxid)
+        print("Camera thread now running", self.mxid, self.stream)
+        publishers = (self._publish, self._publish_jpeg, self._publish_depth)
+        # picks up the queues of a freshly booted device without waiting for QUEUE_WAIT_SECONDS
+        self.camera_factory.addBootListener(self.mxid, self.frame_available.set)
         try:
             while not self.stop_request:
                 try:
-                    queue = self.camera_factory.getRbgQueue(self.mxid)
-                    if queue is not None:
-                        try:
-                            while not queue.has() and queue.isClosed() == False:
-                                time.sleep(0.00001)
-                        except RuntimeError:
-                            # this is kind of expected when reconfiguring queues?
-                            continue
-
-                        if queue.isClosed():
-                            print("queue is closed")
-                            continue
-                        
-                        frame = cast(ImgFrame, queue.get())
-                        c = frame.getCvFrame()
-                        cvFrame = cv2.cvtColor(cast(cv2.Mat, c), cv2.COLOR_BGR2RGB)
-                        current_image = self.current_image
-                        self.current_image = img.fromarray(cvFrame)
-                        if current_image is not None:
-                            try:
-                                current_image.close()
-                            except:
-                                #eat it
-                                pass
-                except:
-                    print("thread crash")
+                    for watch in self.watches:
+                        if watch.update(self.mxid, self._on_frame):
+                            self.frame_available.set()
+                    if len(self.watches) > 1 and self.watches[1].queue is None:
+                        self.jpeg = None
+                    self.camera_factory.checkIdle(self.mxid)
+                    if not self.exports:
+                        self._close_export()
+                    if not self.frame_available.wait(self.QUEUE_WAIT_SECONDS):
+                        continue
+                    self.frame_available.clear()
+
+                    # only the newest frame is worth keeping, older ones are already stale
+                    for watch, publish in zip(self.watches, publishers):
+                        packets = watch.drain()
+                        if watch.name == "jpeg" and len(packets) > 0:
+                            self._record(packets)
+                        if len(packets) > 0:
+                            publish(cast(ImgFrame, packets[-1]), len(packets) - 1)
+                except Exception as e:
+                    LOGGER.error("camera thread for %s crashed: %s", self.mxid, e)
         finally:
             print("thread exiting")
+            self.camera_factory.removeBootListener(self.mxid, self.frame_available.set)
+            for watch in self.watches:
+                watch.attach(None, self._on_frame)
+            self._close_export()
             self.running = False
+
+
+def _rgb_array(frame: ImgFrame) -> np.ndarray:
+    # the pipeline emits interleaved RGB, so the packet data is already in the layout PIL wants
+    return frame.getData().reshape(frame.getHeight(), frame.getWidth(), 3)
+
+
+def _yuv_array(frame: ImgFrame) -> np.ndarray:
+    # the 'isp' stream is the ISP's planar YUV420
+    width, height = frame.getWidth(), frame.getHeight()
+    return cv2.cvtColor(frame.getData().reshape(height * 3 // 2, width), cv2.COLOR_YUV2RGB_I420)
+
+
+def _gray_array(frame: ImgFrame) -> np.ndarray:
+    # GRAY8 frames of the mono cameras
+    return frame.getData().reshape(frame.getHeight(), frame.getWidth())
+
+
+def _depth_array(frame: ImgFrame) -> np.ndarray:
+    # RAW16 depth in millimeters
+    return frame.getData().view(np.uint16).reshape(frame.getHeight(), frame.getWidth())
+
+
+# camera and vision resources on the same device share its camera thread
+CAMERA_THREADS = WorkerRegistry(CameraThread)
+# every other stream has a thread of its own, so a slow stream never holds up the others
+STREAM_THREADS = {stream: WorkerRegistry(partial(CameraThread, stream=stream)) for stream in FRAME_STREAMS if stream != "rgb"}
+
+
+def camera_threads(stream: str) -> WorkerRegistry:
+    """The registry of the threads consuming a stream."""
+    return CAMERA_THREADS if stream == "rgb" else STREAM_THREADS[stream]
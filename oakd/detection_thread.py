@@ -0,0 +1,346 @@
+import asyncio
+import time
+from functools import partial
+from threading import Event, Lock, Thread
+from typing import Any, ClassVar, Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+from depthai import (Clock, ImgDetections, NNData, SpatialImgDetections,
+                     TensorInfo, Tracklet, Tracklets)
+from viam.proto.service.vision import Classification, Detection
+
+from oakd.oak_camera_factory import OakCameraFactory
+from oakd.queue_watch import QueueWatch, Waiters, WorkerRegistry
+from oakd.rate_limited_log import RateLimitedLogger
+from oakd.recording import RECORDINGS, Recorder
+from oakd.stats import Timer, device_stats
+
+LOGGER = RateLimitedLogger(__name__)
+
+TENSOR_DTYPES = {
+    TensorInfo.DataType.FP16: np.float16,
+    TensorInfo.DataType.FP32: np.float32,
+    TensorInfo.DataType.U8F: np.uint8,
+    TensorInfo.DataType.I8: np.int8,
+    TensorInfo.DataType.INT: np.int32,
+}
+
+
+Labels = Sequence[str]
+
+
+def load_labels(path: Union[str, None]) -> Union[Labels, None]:
+    """One class name per line, the line number is the class index."""
+    if path is None or path == "":
+        return None
+    with open(path) as f:
+        return [line.strip() for line in f]
+
+
+def label_name(labels: Union[Labels, None], index: int) -> str:
+    if labels is None or index < 0 or index >= len(labels):
+        return str(index)
+    return labels[index]
+
+
+class DetectionResult:
+    """One NN packet as arrays: boxes are normalized (xmin, ymin, xmax, ymax) rows.
+
+    A spatial NN also reports the (x, y, z) centroid of every box in millimeters.
+    """
+    sequence: int
+    timestamp: float
+    received: float
+    boxes: np.ndarray
+    confidences: np.ndarray
+    labels: np.ndarray
+    spatial: Union[np.ndarray, None]
+
+    def __init__(self, sequence: int, timestamp: float, boxes: np.ndarray, confidences: np.ndarray, labels: np.ndarray, spatial: Union[np.ndarray, None] = None) -> None:
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.received = time.monotonic()
+        self.boxes = boxes
+        self.confidences = confidences
+        self.labels = labels
+        self.spatial = spatial
+        self._detections: Union[Tuple[Tuple[bytes, bytes, int], List[Detection]], None] = None
+
+    @classmethod
+    def from_packet(cls, packet: Union[ImgDetections, SpatialImgDetections]) -> "DetectionResult":
+        detections = packet.detections
+        if isinstance(packet, SpatialImgDetections):
+            values = np.array([(d.xmin, d.ymin, d.xmax, d.ymax, d.confidence, d.label, d.spatialCoordinates.x, d.spatialCoordinates.y, d.spatialCoordinates.z)
+                               for d in detections], dtype=np.float32).reshape(len(detections), 9)
+            spatial = values[:, 6:]
+        else:
+            values = np.array([(d.xmin, d.ymin, d.xmax, d.ymax, d.confidence, d.label) for d in detections], dtype=np.float32).reshape(len(detections), 6)
+            spatial = None
+        return cls(packet.getSequenceNum(), packet.getTimestamp().total_seconds(), values[:, :4], values[:, 4], values[:, 5].astype(np.int32), spatial)
+
+    def detections(self, offset: np.ndarray, scale: np.ndarray, label_names: Union[Labels, None] = None) -> List[Detection]:
+        """The detections as protos, boxes mapped to pixels with offset + box * scale.
+
+        Converted once per result, every caller of the same result gets the same list.
+        """
+        key = (offset.tobytes(), scale.tobytes(), id(label_names))
+        if self._detections is not None and self._detections[0] == key:
+            return self._detections[1]
+        pixels = (offset + np.clip(self.boxes, 0, 1) * scale).astype(np.int64).tolist()
+        confidences = self.confidences.tolist()
+        labels = self.labels.tolist()
+        detections = [
+            Detection(x_min=box[0], y_min=box[1], x_max=box[2], y_max=box[3], confidence=confidence, class_name=label_name(label_names, label))
+            for box, confidence, label in zip(pixels, confidences, labels)
+        ]
+        self._detections = (key, detections)
+        return detections
+
+    def rows(self) -> Tuple[str, np.ndarray]:
+        """The result as the float32 rows a recording stores, with the kind of packet they were."""
+        columns = [self.boxes, self.confidences[:, None], self.labels[:, None]]
+        if self.spatial is None:
+            return "yolo", np.hstack(columns).astype(np.float32)
+        return "spatial", np.hstack(columns + [self.spatial]).astype(np.float32)
+
+
+# names of Tracklet.TrackingStatus, by value
+TRACKING_STATUSES = ("new", "tracked", "lost", "removed")
+
+
+class TrackingResult(DetectionResult):
+    """The objects an ObjectTracker follows on one frame, as a DetectionResult with a track id and status per box.
+
+    Boxes come from the tracker, so they move on every frame while the NN may only run on some of them.
+    """
+    track_ids: np.ndarray
+    statuses: np.ndarray
+    ages: np.ndarray
+
+    def __init__(self, sequence: int, timestamp: float, boxes: np.ndarray, confidences: np.ndarray, labels: np.ndarray,
+                 spatial: Union[np.ndarray, None], track_ids: np.ndarray, statuses: np.ndarray, ages: np.ndarray) -> None:
+        super().__init__(sequence, timestamp, boxes, confidences, labels, spatial)
+        self.track_ids = track_ids
+        self.statuses = statuses
+        self.ages = ages
+
+    @classmethod
+    def from_packet(cls, packet: Tracklets) -> "TrackingResult":
+        # a removed track is reported once more with its last box, it is no longer in the picture
+        tracklets = [t for t in packet.tracklets if t.status != Tracklet.TrackingStatus.REMOVED]
+        values = np.array([(t.roi.topLeft().x, t.roi.topLeft().y, t.roi.bottomRight().x, t.roi.bottomRight().y,
+                            t.srcImgDetection.confidence, t.label, t.spatialCoordinates.x, t.spatialCoordinates.y, t.spatialCoordinates.z,
+                            t.id, int(t.status), t.age) for t in tracklets], dtype=np.float64).reshape(len(tracklets), 12)
+        # only a tracker fed by a spatial NN locates its objects
+        spatial = values[:, 6:9].astype(np.float32) if np.any(values[:, 8] != 0) else None
+        integers = values[:, 9:].astype(np.int64)
+        return cls(packet.getSequenceNum(), packet.getTimestamp().total_seconds(), values[:, :4].astype(np.float32),
+                   values[:, 4].astype(np.float32), values[:, 5].astype(np.int32), spatial, integers[:, 0], integers[:, 1], integers[:, 2])
+
+    def tracks(self, offset: np.ndarray, scale: np.ndarray, label_names: Union[Labels, None] = None) -> List[Dict[str, Any]]:
+        """Every tracked object with its box in pixels, like detections, plus its track id, status and age in frames."""
+        detections = self.detections(offset, scale, label_names)
+        return [
+            {"track_id": track_id, "status": TRACKING_STATUSES[status], "age": age,
+             "x_min": d.x_min, "y_min": d.y_min, "x_max": d.x_max, "y_max": d.y_max, "confidence": d.confidence, "class_name": d.class_name}
+            for d, track_id, status, age in zip(detections, self.track_ids.tolist(), self.statuses.tolist(), self.ages.tolist())
+        ]
+
+    def rows(self) -> Tuple[str, np.ndarray]:
+        spatial = np.zeros((len(self.boxes), 3), dtype=np.float32) if self.spatial is None else self.spatial
+        columns = [self.boxes, self.confidences[:, None], self.labels[:, None], spatial,
+                   self.track_ids[:, None], self.statuses[:, None], self.ages[:, None]]
+        return "tracklets", np.hstack(columns).astype(np.float32)
+
+
+class ClassificationResult:
+    """One packet of a classification NN: a score per class, read straight from the output tensor."""
+    sequence: int
+    timestamp: float
+    received: float
+    scores: np.ndarray
+
+    def __init__(self, sequence: int, timestamp: float, scores: np.ndarray) -> None:
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.received = time.monotonic()
+        self.scores = scores
+        self._probabilities: Union[np.ndarray, None] = None
+        self._classifications: Dict[Tuple[int, int], List[Classification]] = {}
+
+    @classmethod
+    def from_packet(cls, packet: NNData) -> "ClassificationResult":
+        layers = packet.getAllLayers()
+        if len(layers) == 0:
+            scores = np.asarray(packet.getFirstLayerFp16(), dtype=np.float32)
+        else:
+            # a view onto the packet's bytes instead of a list of Python floats
+            layer = layers[0]
+            dtype = TENSOR_DTYPES.get(layer.dataType, np.float16)
+            count = int(np.prod(layer.dims))
+            scores = np.frombuffer(packet.getData(), dtype=dtype, count=count, offset=layer.offset)
+        return cls(packet.getSequenceNum(), packet.getTimestamp().total_seconds(), scores.reshape(-1))
+
+    def probabilities(self) -> np.ndarray:
+        if self._probabilities is None:
+            scores = self.scores.astype(np.float32)
+            if len(scores) == 0:
+                self._probabilities = scores
+            elif scores.min() >= 0 and abs(scores.sum() - 1.0) < 0.01:
+                # the model already ends in a softmax
+                self._probabilities = scores
+            else:
+                exp = np.exp(scores - scores.max())
+                self._probabilities = exp / exp.sum()
+        return self._probabilities
+
+    def classifications(self, count: int, label_names: Union[Labels, None] = None) -> List[Classification]:
+        """The count most likely classes, best first. Computed once per result and count."""
+        key = (count, id(label_names))
+        cached = self._classifications.get(key)
+        if cached is not None:
+            return cached
+        probabilities = self.probabilities()
+        count = max(0, min(count, len(probabilities)))
+        if count == 0:
+            return []
+        # argpartition finds the top count in linear time, only those few are sorted
+        top = np.argpartition(probabilities, -count)[-count:]
+        top = top[np.argsort(probabilities[top])[::-1]]
+        classifications = [
+            Classification(class_name=label_name(label_names, index), confidence=confidence)
+            for index, confidence in zip(top.tolist(), probabilities[top].tolist())
+        ]
+        self._classifications[key] = classifications
+        return classifications
+
+    def rows(self) -> Tuple[str, np.ndarray]:
+        return "classifier", self.scores.astype(np.float32).reshape(1, -1)
+
+
+NNResult = Union[DetectionResult, ClassificationResult]
+
+
+def nn_result_from_packet(packet: Union[ImgDetections, SpatialImgDetections, NNData, Tracklets]) -> NNResult:
+    if isinstance(packet, NNData):
+        return ClassificationResult.from_packet(packet)
+    if isinstance(packet, Tracklets):
+        return TrackingResult.from_packet(packet)
+    return DetectionResult.from_packet(packet)
+
+
+class DetectionThread(Thread):
+    """Consumes the NN queue of one device in the background and keeps the latest result.
+
+    Results are DetectionResults for a YOLO network and ClassificationResults for a generic one.
+    On the 'tracklets' stream of an ObjectTracker they are TrackingResults.
+    """
+    # how long to block waiting for the device before checking for a stop request or a replaced queue
+    QUEUE_WAIT_SECONDS: ClassVar[float] = 0.5
+
+    running: bool
+    latest: Union[NNResult, None]
+    camera_factory: OakCameraFactory
+    stop_request: bool
+
+    def __init__(self, mxid: str, camera_factory: OakCameraFactory, stream: str = "nn") -> None:
+        if camera_factory is None:
+            raise ValueError("camera_factory cannot be none")
+        if mxid is None or mxid == "":
+            raise ValueError("mxid must be set")
+
+        self.running = False
+        self.camera_factory = camera_factory
+        self.mxid = mxid
+        self.stream = stream
+        self.lock = Lock()
+        self.stop_request = False
+        self.latest = None
+        self.packet_available = Event()
+        self.watch = QueueWatch(stream, partial(camera_factory.getQueue, name=stream))
+        self.waiters = Waiters()
+        self.stats = device_stats(mxid)
+        self.record_stage = self.stats.stage(stream + "_record")
+        super().__init__(daemon=True)
+
+    def has_queue(self) -> bool:
+        return self.camera_factory.getQueue(self.mxid, self.stream) is not None
+
+    def get_latest(self, max_age: Union[float, None] = None, after_sequence: Union[int, None] = None) -> Union[NNResult, None]:
+        """The latest result if it arrived within max_age seconds and is newer than after_sequence."""
+        self.camera_factory.demand(self.mxid)
+        result = self.latest
+        if result is None:
+            return None
+        if max_age is not None and time.monotonic() - result.received > max_age:
+            return None
+        if after_sequence is not None and result.sequence <= after_sequence:
+            return None
+        return result
+
+    def next_result(self) -> "asyncio.Future[NNResult]":
+        """Get a future on the running event loop that resolves with the next result."""
+        self.camera_factory.demand(self.mxid)
+        return self.waiters.wait()
+
+    def stop(self):
+        self.stop_request = True
+        self.packet_available.set()
+
+    def _on_packet(self, *args) -> None:
+        # called from the depthai queue thread, only wakes this thread up
+        self.packet_available.set()
+
+    def _record(self, recorder: Recorder, result: NNResult) -> None:
+        kind, rows = result.rows()
+        recorder.write(self.stream, kind, result.sequence, result.timestamp, rows)
+
+    def run(self) -> None:
+        with self.lock:
+            if self.running:
+                raise RuntimeError("Detection thread is already running")
+            self.running = True
+        self.camera_factory.addBootListener(self.mxid, self.packet_available.set)
+        try:
+            while not self.stop_request:
+                try:
+                    if self.watch.update(self.mxid, self._on_packet):
+                        self.latest = None
+                        self.packet_available.set()
+                    self.camera_factory.checkIdle(self.mxid)
+                    if not self.packet_available.wait(self.QUEUE_WAIT_SECONDS):
+                        continue
+                    self.packet_available.clear()
+
+                    packets = self.watch.drain()
+                    if len(packets) == 0:
+                        continue
+                    result = nn_result_from_packet(packets[-1])
+                    recorder = RECORDINGS.get(self.mxid)
+                    if recorder is not None:
+                        # a recording keeps every result, not just the newest
+                        with Timer(self.record_stage):
+                            for packet in packets[:-1]:
+                                self._record(recorder, nn_result_from_packet(packet))
+                            self._record(recorder, result)
+                    # the NN output carries the capture time of its input frame, so this includes inference
+                    self.stats.stage(self.stream + "_to_host").record(Clock.now().total_seconds() - result.timestamp)
+                    self.stats.queue(self.stream).packet(result.sequence, len(packets) - 1)
+                    self.latest = result
+                    self.waiters.notify(lambda: result)
+                except Exception as e:
+                    LOGGER.error("detection thread for %s crashed: %s", self.mxid, e)
+        finally:
+            self.camera_factory.removeBootListener(self.mxid, self.packet_available.set)
+            self.watch.attach(None, self._on_packet)
+            self.running = False
+
+
+# every vision service on the same device shares its detection thread
+DETECTION_THREADS = WorkerRegistry(DetectionThread)
+# and with tracking the thread reading the tracker's output
+TRACKING_THREADS = WorkerRegistry(partial(DetectionThread, stream="tracklets"))
+
+
+def detection_threads(tracking: bool) -> WorkerRegistry:
+    return TRACKING_THREADS if tracking else DETECTION_THREADS
@@ -0,0 +1,235 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Callable, Deque, Iterator, List, Tuple, Union
+
+import numpy as np
+
+from oakd.stats import Histogram, Timer
+
+
+class FrameSlot:
+    """A preallocated frame buffer plus the metadata of the frame it currently holds.
+
+    Readers only ever see `view`, a read-only view onto the buffer. A slot is not
+    overwritten while `readers` is above zero.
+    """
+    buffer: np.ndarray
+    view: np.ndarray
+    sequence: int
+    timestamp: float
+    received: float
+    readers: int
+
+    def __init__(self, shape: Tuple[int, ...], dtype: np.dtype) -> None:
+        self.buffer = np.empty(shape, dtype=dtype)
+        self.view = self.buffer.view()
+        self.view.flags.writeable = False
+        self.sequence = -1
+        self.timestamp = 0.0
+        self.received = 0.0
+        self.readers = 0
+
+    @property
+    def width(self) -> int:
+        return self.buffer.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.buffer.shape[0]
+
+
+class FrameRing:
+    """Fixed-size ring of frame buffers holding the most recent frames from one stream.
+
+    The writer copies each frame into the next free slot, so after the first frame
+    (or a resolution change) no memory is allocated per frame. Readers acquire a slot,
+    which pins it until released.
+    """
+    size: int
+    slots: List[FrameSlot]
+    latest: Union[FrameSlot, None]
+    dropped: int
+
+    def __init__(self, size: int = 4) -> None:
+        if size < 2:
+            raise ValueError("frame ring needs at least 2 slots")
+        self.size = size
+        self.slots = []
+        self.latest = None
+        self.dropped = 0
+        self.next_index = 0
+        self.lock = Lock()
+
+    def _allocate(self, shape: Tuple[int, ...], dtype: np.dtype) -> None:
+        # only runs for the first frame or when the stream resolution changes
+        self.slots = [FrameSlot(shape, dtype) for _ in range(self.size)]
+        self.latest = None
+        self.next_index = 0
+
+    def _claim(self) -> Union[FrameSlot, None]:
+        for _ in range(self.size):
+            slot = self.slots[self.next_index]
+            self.next_index = (self.next_index + 1) % self.size
+            if slot.readers == 0 and slot is not self.latest:
+                return slot
+        return None
+
+    def write(self, data: np.ndarray, sequence: int, timestamp: float, received: Union[float, None] = None, newest: bool = True) -> Union[FrameSlot, None]:
+        """Copy a frame into the ring, and make it the latest one unless newest is False.
+
+        received is when the host got the frame, by default now. Returns the slot
+        written, or None if every slot is pinned by a reader and the frame had to be dropped.
+        """
+        with self.lock:
+            if len(self.slots) == 0 or self.slots[0].buffer.shape != data.shape or self.slots[0].buffer.dtype != data.dtype:
+                self._allocate(data.shape, data.dtype)
+            slot = self._claim()
+            if slot is None:
+                self.dropped += 1
+                return None
+            # pin the slot while copying so nobody else claims it, and forget its old
+            # sequence number so nobody looks the half written frame up by it
+            slot.readers += 1
+            slot.sequence = -1
+
+        np.copyto(slot.buffer, data)
+        slot.sequence = sequence
+        slot.timestamp = timestamp
+        slot.received = time.monotonic() if received is None else received
+
+        with self.lock:
+            slot.readers -= 1
+            if newest:
+                self.latest = slot
+        return slot
+
+    def acquire(self, slot: FrameSlot) -> FrameSlot:
+        with self.lock:
+            slot.readers += 1
+        return slot
+
+    def acquire_latest(self, max_age: Union[float, None] = None) -> Union[FrameSlot, None]:
+        """Pin and return the latest slot, optionally only if it arrived within max_age seconds."""
+        with self.lock:
+            slot = self.latest
+            if slot is None:
+                return None
+            if max_age is not None and time.monotonic() - slot.received > max_age:
+                return None
+            slot.readers += 1
+            return slot
+
+    def acquire_sequence(self, sequence: int) -> Union[FrameSlot, None]:
+        """Pin and return the slot holding the frame with this device sequence number, if it is still in the ring."""
+        with self.lock:
+            for slot in self.slots:
+                if slot.sequence == sequence and sequence >= 0:
+                    slot.readers += 1
+                    return slot
+            return None
+
+    def latest_sequence(self) -> int:
+        with self.lock:
+            return -1 if self.latest is None else self.latest.sequence
+
+    def release(self, slot: FrameSlot) -> None:
+        with self.lock:
+            slot.readers -= 1
+
+    @contextmanager
+    def latest_frame(self, max_age: Union[float, None] = None) -> Iterator[Union[FrameSlot, None]]:
+        slot = self.acquire_latest(max_age)
+        try:
+            yield slot
+        finally:
+            if slot is not None:
+                self.release(slot)
+
+
+class LazyFrameRing:
+    """Keeps the latest packets of a stream and copies them into a FrameRing only when somebody reads them.
+
+    Most of the time nobody reads a frame before the next one arrives, so holding on to
+    the packet is all the work done per frame. convert turns a packet into the array
+    written to the ring, packets need getSequenceNum.
+    """
+    frames: FrameRing
+
+    def __init__(self, frames: FrameRing, convert: Callable[[Any], np.ndarray], convert_time: Union[Histogram, None] = None,
+                 on_newest: Union[Callable[[FrameSlot], None], None] = None) -> None:
+        self.frames = frames
+        self.convert = convert
+        self.convert_time = convert_time
+        # called with every slot that becomes the ring's latest, with the lock held
+        self.on_newest = on_newest
+        self.lock = Lock()
+        # (packet, capture timestamp, host receive time), newest last
+        self.packets: Deque[Tuple[Any, float, float]] = deque(maxlen=frames.size)
+        self.converted: Any = None
+
+    def push(self, packet: Any, timestamp: float) -> None:
+        with self.lock:
+            self.packets.append((packet, timestamp, time.monotonic()))
+
+    def _write(self, entry: Tuple[Any, float, float], newest: bool) -> Union[FrameSlot, None]:
+        # called with the lock held
+        packet, timestamp, received = entry
+        with Timer(self.convert_time):
+            slot = self.frames.write(self.convert(packet), packet.getSequenceNum(), timestamp, received, newest)
+        if newest:
+            self.converted = packet
+            if slot is not None and self.on_newest is not None:
+                self.on_newest(slot)
+        return slot
+
+    def convert_newest(self) -> Union[FrameSlot, None]:
+        """Make sure the newest packet is in the ring and return its slot, None if there is none or it was dropped."""
+        with self.lock:
+            if len(self.packets) == 0:
+                return None
+            entry = self.packets[-1]
+            if entry[0] is self.converted:
+                return self.frames.latest
+            return self._write(entry, True)
+
+    def acquire_latest(self, max_age: Union[float, None] = None) -> Union[FrameSlot, None]:
+        """Like FrameRing.acquire_latest, converting the newest packet first if it has not been read yet."""
+        with self.lock:
+            if len(self.packets) > 0 and self.packets[-1][0] is not self.converted:
+                entry = self.packets[-1]
+                # a packet that is already too old is not worth converting
+                if max_age is None or time.monotonic() - entry[2] <= max_age:
+                    self._write(entry, True)
+        return self.frames.acquire_latest(max_age)
+
+    def acquire_sequence(self, sequence: int) -> Union[FrameSlot, None]:
+        """Like FrameRing.acquire_sequence, converting the packet with that sequence number if it is still held."""
+        slot = self.frames.acquire_sequence(sequence)
+        if slot is not None:
+            return slot
+        with self.lock:
+            for index, entry in enumerate(self.packets):
+                if entry[0].getSequenceNum() == sequence:
+                    slot = self._write(entry, index == len(self.packets) - 1)
+                    # nothing else writes while the lock is held, so the slot cannot be reclaimed before this
+                    return None if slot is None else self.frames.acquire(slot)
+        return None
+
+    def acquire_timestamp(self, timestamp: float, tolerance: float) -> Union[FrameSlot, None]:
+        """Like acquire_sequence for the held packet captured closest to timestamp, None if none is within tolerance seconds."""
+        with self.lock:
+            held = [(abs(entry[1] - timestamp), entry[0].getSequenceNum()) for entry in self.packets]
+        if len(held) == 0:
+            return None
+        distance, sequence = min(held)
+        return self.acquire_sequence(sequence) if distance <= tolerance else None
+
+    def latest_timestamp(self) -> float:
+        with self.lock:
+            return float("-inf") if len(self.packets) == 0 else self.packets[-1][1]
+
+    def latest_sequence(self) -> int:
+        with self.lock:
+            return -1 if len(self.packets) == 0 else self.packets[-1][0].getSequenceNum()
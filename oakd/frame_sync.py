@@ -0,0 +1,63 @@
+import asyncio
+import time
+from typing import Optional, Tuple
+
+from oakd.camera_thread import CameraThread
+from oakd.detection_thread import DetectionResult, DetectionThread
+from oakd.frame_ring import FrameSlot
+
+
+async def synced_frame(frames: CameraThread, detections: DetectionThread, max_age: Optional[float] = None, timeout: Optional[float] = None) -> Tuple[FrameSlot, DetectionResult]:
+    """Pair an NN result with the rgb frame it was computed on.
+
+    The NN output and the rgb stream carry the sequence number of the camera frame they
+    came from, so the frame is looked up by sequence among the camera thread's recent
+    frames. If the frame has not arrived yet this waits for it, if it already left the ring
+    the next NN result is tried instead. The returned slot is acquired and must be released
+    with frames.frames.release.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    async def wait(future: asyncio.Future):
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            return await asyncio.wait_for(future, remaining)
+        except asyncio.TimeoutError:
+            raise TimeoutError("no synchronized frame and detections from camera " + frames.mxid + " within " + str(timeout) + "s")
+
+    result = detections.get_latest(max_age)
+    if result is None:
+        result = await wait(detections.next_result())
+    while True:
+        slot = frames.acquire_frame_sequence(result.sequence)
+        if slot is not None:
+            return slot, result
+        if frames.latest_frame_sequence() < result.sequence:
+            # the rgb stream goes through an extra ImageManip and may trail the NN by a frame
+            frames.frames.release(await wait(frames.next_frame()))
+        else:
+            result = await wait(detections.next_result())
+
+
+async def synced_depth(frames: CameraThread, timestamp: float, period: float, timeout: Optional[float] = None) -> FrameSlot:
+    """Get the depth frame captured at the same time as the rgb frame or NN result with this capture timestamp.
+
+    The colour and mono cameras count their frames separately, so frames are matched by capture
+    time, which every stream takes from the same device clock. A depth frame counts if it was
+    captured within half a frame period. Stereo depth passes more nodes than the colour camera,
+    so this waits until a depth frame from after that window has arrived. Raises RuntimeError if
+    none matched. The returned slot is acquired and must be released with frames.depth.release.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    tolerance = period / 2
+    while True:
+        slot = frames.acquire_depth_at(timestamp, tolerance)
+        if slot is not None:
+            return slot
+        if frames.latest_depth_timestamp() > timestamp + tolerance:
+            raise RuntimeError("no depth frame of camera " + frames.mxid + " was captured within " + str(round(tolerance * 1000, 1)) + "ms of the frame")
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            frames.depth.release(await asyncio.wait_for(frames.next_depth(), remaining))
+        except asyncio.TimeoutError:
+            raise TimeoutError("no depth received from camera " + frames.mxid + " within " + str(timeout) + "s")
@@ -0,0 +1,181 @@
+import asyncio
+import io
+import itertools
+import struct
+from threading import Event, Lock, Thread
+from typing import ClassVar, Dict, Tuple, Union
+
+import numpy as np
+from depthai import DataInputQueue, ImgFrame
+from PIL import Image
+from viam.media.video import CameraMimeType, RawImage
+
+from oakd.detection_thread import NNResult, nn_result_from_packet
+from oakd.oak_camera_factory import OakCameraFactory
+from oakd.queue_watch import QueueWatch, WorkerRegistry
+from oakd.rate_limited_log import RateLimitedLogger
+from oakd.stats import Timer, device_stats
+
+LOGGER = RateLimitedLogger(__name__)
+
+
+def decode_image(image: Union[Image.Image, RawImage]) -> Image.Image:
+    if isinstance(image, Image.Image):
+        return image
+    if image.mime_type == CameraMimeType.VIAM_RGBA.value:
+        width, height = struct.unpack(">II", image.data[4:12])
+        return Image.frombuffer("RGBA", (width, height), image.data[12:], "raw", "RGBA", 0, 1)
+    # PIL only reads the header here, the pixels are decoded when they are used
+    return Image.open(io.BytesIO(image.data))
+
+
+def image_size(image: Union[Image.Image, RawImage]) -> Tuple[int, int]:
+    return decode_image(image).size
+
+
+def to_rgb_array(image: Union[Image.Image, RawImage], size: Tuple[int, int]) -> np.ndarray:
+    """Decode an image and resize it to the NN input as interleaved RGB.
+
+    The whole image is stretched to the NN input, so normalized boxes map straight back onto it.
+    """
+    image = decode_image(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if image.size != size:
+        image = image.resize(size, Image.BILINEAR)
+    return np.asarray(image)
+
+
+class HostInferenceThread(Thread):
+    """Runs images sent by the host through the device NN.
+
+    Every request gets its own sequence number, which the device carries through to the
+    NN output, so several requests can be in flight and replies still find their caller.
+    """
+    QUEUE_WAIT_SECONDS: ClassVar[float] = 0.5
+
+    running: bool
+    camera_factory: OakCameraFactory
+    stop_request: bool
+
+    def __init__(self, mxid: str, camera_factory: OakCameraFactory) -> None:
+        if camera_factory is None:
+            raise ValueError("camera_factory cannot be none")
+        if mxid is None or mxid == "":
+            raise ValueError("mxid must be set")
+
+        self.running = False
+        self.camera_factory = camera_factory
+        self.mxid = mxid
+        self.lock = Lock()
+        self.stop_request = False
+        self.packet_available = Event()
+        self.watch = QueueWatch("nn_host", camera_factory.getHostNnQueue)
+        self.sequence = itertools.count()
+        self.pending: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+        # (in flight limit, semaphore enforcing it), replaced when the limit changes
+        self.in_flight: Union[Tuple[int, asyncio.Semaphore], None] = None
+        self.stats = device_stats(mxid)
+        super().__init__(daemon=True)
+
+    def has_queue(self) -> bool:
+        return self.camera_factory.getHostNnQueue(self.mxid) is not None
+
+    def _semaphore(self, limit: int) -> asyncio.Semaphore:
+        if self.in_flight is None or self.in_flight[0] != limit:
+            self.in_flight = (limit, asyncio.Semaphore(limit))
+        return self.in_flight[1]
+
+    async def infer(self, image: Union[Image.Image, RawImage], timeout: Union[float, None] = None) -> NNResult:
+        """Run one image through the NN, detection boxes are normalized to the image."""
+        settings = self.camera_factory.getPipelineSettings(self.mxid)
+        input_queue = None if settings is None else self.camera_factory.getInputQueue(self.mxid, "nn_in", settings.inferenceThreads)
+        if settings is None or input_queue is None or not settings.hostInference:
+            raise RuntimeError("host inference is not running on camera " + self.mxid)
+
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, to_rgb_array, image, settings.previewSize)
+
+        # more requests than the NN has threads would only queue up on the device
+        async with self._semaphore(settings.inferenceThreads):
+            sequence = next(self.sequence)
+            future = loop.create_future()
+            with self.lock:
+                self.pending[sequence] = (loop, future)
+            try:
+                with Timer(self.stats.stage("host_inference")):
+                    await loop.run_in_executor(None, self._send, input_queue, data, sequence)
+                    return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("no inference result from camera " + self.mxid + " within " + str(timeout) + "s")
+            finally:
+                with self.lock:
+                    self.pending.pop(sequence, None)
+
+    def _send(self, input_queue: DataInputQueue, data: np.ndarray, sequence: int) -> None:
+        frame = ImgFrame()
+        frame.setType(ImgFrame.Type.RGB888i)
+        frame.setWidth(data.shape[1])
+        frame.setHeight(data.shape[0])
+        frame.setData(data.reshape(-1))
+        frame.setSequenceNum(sequence)
+        input_queue.send(frame)
+
+    def _fail_pending(self, error: Exception) -> None:
+        with self.lock:
+            pending = list(self.pending.values())
+        for loop, future in pending:
+            loop.call_soon_threadsafe(_fail, future, error)
+
+    def stop(self):
+        self.stop_request = True
+        self.packet_available.set()
+
+    def _on_packet(self, *args) -> None:
+        self.packet_available.set()
+
+    def run(self) -> None:
+        with self.lock:
+            if self.running:
+                raise RuntimeError("Host inference thread is already running")
+            self.running = True
+        self.camera_factory.addBootListener(self.mxid, self.packet_available.set)
+        try:
+            while not self.stop_request:
+                try:
+                    if self.watch.update(self.mxid, self._on_packet):
+                        # requests sent to the old device will never be answered
+                        self._fail_pending(ConnectionError("camera " + self.mxid + " was reconfigured"))
+                    if not self.packet_available.wait(self.QUEUE_WAIT_SECONDS):
+                        continue
+                    self.packet_available.clear()
+
+                    # unlike the live NN every packet is somebody's answer
+                    for packet in self.watch.drain():
+                        result = nn_result_from_packet(packet)
+                        self.stats.queue("nn_host").packet(result.sequence)
+                        with self.lock:
+                            waiter = self.pending.get(result.sequence)
+                        if waiter is not None:
+                            waiter[0].call_soon_threadsafe(_answer, waiter[1], result)
+                except Exception as e:
+                    LOGGER.error("host inference thread for %s crashed: %s", self.mxid, e)
+        finally:
+            self.camera_factory.removeBootListener(self.mxid, self.packet_available.set)
+            self.watch.attach(None, self._on_packet)
+            self._fail_pending(ConnectionError("host inference for camera " + self.mxid + " stopped"))
+            self.running = False
+
+
+def _answer(future: asyncio.Future, result: NNResult) -> None:
+    if not future.done():
+        future.set_result(result)
+
+
+def _fail(future: asyncio.Future, error: Exception) -> None:
+    if not future.done():
+        future.set_exception(error)
+
+
+# every vision service on the same device shares its host inference thread
+HOST_INFERENCE_THREADS = WorkerRegistry(HostInferenceThread)
@@ -0,0 +1,117 @@
+import asyncio
+import time
+from functools import partial
+from io import BytesIO
+from threading import Lock
+from typing import Dict, Tuple, Union
+
+import numpy as np
+import PIL.Image as img
+from viam.media.video import CameraMimeType
+from viam.media.viam_rgba_plugin import RGBA_MAGIC_NUMBER
+
+from oakd.frame_ring import FrameRing, FrameSlot
+from oakd.stats import Histogram, Timer
+
+ENCODABLE_MIME_TYPES = (CameraMimeType.JPEG, CameraMimeType.PNG, CameraMimeType.VIAM_RGBA)
+
+
+def encode_frame(frame: np.ndarray, mime_type: CameraMimeType, jpeg_quality: int = 75) -> bytes:
+    """Encode an interleaved RGB frame, or a grey one of shape (height, width), into the given mime type."""
+    height, width = frame.shape[0], frame.shape[1]
+    if mime_type == CameraMimeType.VIAM_RGBA:
+        rgba = np.empty((height, width, 4), dtype=np.uint8)
+        rgba[:, :, :3] = frame if frame.ndim == 3 else frame[:, :, np.newaxis]
+        rgba[:, :, 3] = 255
+        return RGBA_MAGIC_NUMBER + width.to_bytes(4, byteorder="big") + height.to_bytes(4, byteorder="big") + rgba.tobytes()
+
+    mode = "L" if frame.ndim == 2 else "RGB"
+    image = img.frombuffer(mode, (width, height), frame, "raw", mode, 0, 1)
+    buffer = BytesIO()
+    if mime_type == CameraMimeType.JPEG:
+        image.save(buffer, format="JPEG", quality=jpeg_quality)
+    elif mime_type == CameraMimeType.PNG:
+        # favour speed, PNG is lossless at any level
+        image.save(buffer, format="PNG", compress_level=1)
+    else:
+        raise ValueError("cannot encode frame as " + str(mime_type))
+    return buffer.getvalue()
+
+
+class EncodedPacket:
+    """A frame encoded on the device, e.g. by the VideoEncoder node."""
+    sequence: int
+    timestamp: float
+    received: float
+
+    def __init__(self, data: np.ndarray, sequence: int, timestamp: float) -> None:
+        self._data = data
+        self._bytes: Union[bytes, None] = None
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.received = time.monotonic()
+
+    @property
+    def data(self) -> bytes:
+        # converted on first use, most packets are never asked for
+        if self._bytes is None:
+            self._bytes = self._data.tobytes()
+        return self._bytes
+
+
+class EncodedFrameCache:
+    """Encoded bytes of the latest frame, one entry per mime type.
+
+    Every caller asking for the same frame and mime type shares a single encode,
+    which runs off the event loop. Entries are dropped as soon as a newer frame
+    is published, the JPEG quality changes or their encode failed.
+    """
+    frames: FrameRing
+    jpeg_quality: int
+    encodes: int
+    hits: int
+
+    def __init__(self, frames: FrameRing, jpeg_quality: int = 75, encode_time: Union[Histogram, None] = None) -> None:
+        self.frames = frames
+        self.jpeg_quality = jpeg_quality
+        self.encode_time = encode_time
+        self.lock = Lock()
+        self.entries: Dict[Tuple[int, float, CameraMimeType], "asyncio.Future[bytes]"] = {}
+        self.encodes = 0
+        self.hits = 0
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.entries = {}
+
+    def _encode(self, slot: FrameSlot, mime_type: CameraMimeType) -> bytes:
+        try:
+            with Timer(self.encode_time):
+                return encode_frame(slot.view, mime_type, self.jpeg_quality)
+        finally:
+            self.frames.release(slot)
+
+    def _drop_failed(self, key: Tuple[int, float, CameraMimeType], future: "asyncio.Future[bytes]") -> None:
+        # a failed encode is not kept, the next caller tries again
+        if future.cancelled() or future.exception() is not None:
+            with self.lock:
+                if self.entries.get(key) is future:
+                    del self.entries[key]
+
+    async def get(self, slot: FrameSlot, mime_type: CameraMimeType) -> bytes:
+        """Get the frame held by an acquired slot encoded as mime_type."""
+        # the host receive time tells apart frames that share a sequence number across device reboots
+        key = (slot.sequence, slot.received, mime_type)
+        with self.lock:
+            future = self.entries.get(key)
+            if future is None:
+                loop = asyncio.get_running_loop()
+                # the encode holds its own pin on the slot, callers may give up and release theirs
+                future = loop.run_in_executor(None, self._encode, self.frames.acquire(slot), mime_type)
+                future.add_done_callback(partial(self._drop_failed, key))
+                self.entries[key] = future
+                self.encodes += 1
+            else:
+                self.hits += 1
+        # a caller timing out must not cancel the encode other callers are waiting on
+        return await asyncio.shield(future)
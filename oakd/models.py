@@ -0,0 +1,5 @@
+from viam.resource.types import Model
+
+# kept apart from the resources so main.py can register them without importing depthai
+CAMERA_MODEL = Model.from_string("oak:camera:d")
+VISION_MODEL = Model.from_string("oak:vision:d")
@@ -0,0 +1,350 @@
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Any, Callable, ClassVar, Dict, List, Tuple, Union
+
+from oakd.blob_cache import BlobCache, ModelSpec
+from oakd.detection_thread import DETECTION_THREADS
+from oakd.oak_camera_factory import (ColorCameraOptions, OakCameraFactory,
+                                     PipelineRequirement, PipelineSettings)
+from oakd.stats import device_stats
+
+DEFAULT_TUNING_FILE = os.path.join(os.path.expanduser("~"), ".cache", "viam-oak", "tuning.json")
+
+# shave counts a model is compiled for while tuning
+TUNE_SHAVES: List[int] = [4, 6, 8]
+# (inference threads, NCEs per thread) tried, an RVC2 device has two neural compute engines
+TUNE_ENGINES: List[Tuple[int, int]] = [(1, 1), (1, 2), (2, 1)]
+# NN input queue depths, only tried on the best of the rest since a deeper queue trades latency, not frame rate
+TUNE_QUEUE_SIZES: List[int] = [1, 2, 4]
+# configs within this fraction of the best frame rate are ranked by latency instead
+FPS_TOLERANCE = 0.02
+
+
+class TuningConfig:
+    """The NN knobs of one trial, None leaves a knob to depthai."""
+    shaves: Union[int, None]
+    threads: int
+    nce: Union[int, None]
+    queue_size: Union[int, None]
+
+    def __init__(self, shaves: Union[int, None] = None, threads: int = 1, nce: Union[int, None] = None, queue_size: Union[int, None] = None) -> None:
+        self.shaves = shaves
+        self.threads = threads
+        self.nce = nce
+        self.queue_size = queue_size
+
+    def fields(self) -> Dict[str, Any]:
+        """The PipelineSettings fields of the knobs, shaves are a property of the blob."""
+        return {"inferenceThreads": self.threads, "ncePerThread": self.nce, "nnQueueSize": self.queue_size}
+
+    def with_queue_size(self, queue_size: Union[int, None]) -> "TuningConfig":
+        return TuningConfig(self.shaves, self.threads, self.nce, queue_size)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"shaves": self.shaves, "threads": self.threads, "nce": self.nce, "queue_size": self.queue_size}
+
+    @classmethod
+    def from_dict(cls, values: Dict[str, Any]) -> "TuningConfig":
+        return cls(values.get("shaves"), int(values.get("threads", 1)), values.get("nce"), values.get("queue_size"))
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, TuningConfig) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return "TuningConfig(" + ", ".join(name + "=" + str(value) for name, value in self.to_dict().items()) + ")"
+
+
+class TrialResult:
+    """NN results per second reaching the host and their median latency from capture, or why the trial failed."""
+    config: TuningConfig
+    fps: float
+    latency: Union[float, None]
+    error: Union[str, None]
+
+    def __init__(self, config: TuningConfig, fps: float = 0.0, latency: Union[float, None] = None, error: Union[str, None] = None) -> None:
+        self.config = config
+        self.fps = fps
+        self.latency = latency
+        self.error = error
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = {"config": self.config.to_dict(), "fps": round(self.fps, 2),
+                  "latency_ms": None if self.latency is None else round(self.latency * 1000, 2)}
+        if self.error is not None:
+            result["error"] = self.error
+        return result
+
+    @classmethod
+    def from_dict(cls, values: Dict[str, Any]) -> "TrialResult":
+        latency = values.get("latency_ms")
+        return cls(TuningConfig.from_dict(values["config"]), float(values.get("fps", 0.0)),
+                   None if latency is None else latency / 1000, values.get("error"))
+
+
+def best_result(results: List[TrialResult]) -> Union[TrialResult, None]:
+    """The highest frame rate, and among those within FPS_TOLERANCE of it the lowest latency."""
+    usable = [result for result in results if result.error is None and result.fps > 0]
+    if len(usable) == 0:
+        return None
+    fastest = max(result.fps for result in usable)
+    contenders = [result for result in usable if result.fps >= fastest * (1 - FPS_TOLERANCE)]
+    return min(contenders, key=lambda result: float("inf") if result.latency is None else result.latency)
+
+
+def sweep(fixed: Dict[str, Any], shaves: Union[List[int], None] = None) -> Tuple[List[TuningConfig], List[int]]:
+    """The configs tried first and the queue depths tried on the best of them afterwards.
+
+    Knobs in fixed, by TuningConfig attribute, were set in the config and are never changed.
+    """
+    shave_counts = [fixed["shaves"]] if "shaves" in fixed else list(TUNE_SHAVES if shaves is None else shaves)
+    engines = [(threads, nce) for threads, nce in TUNE_ENGINES
+               if fixed.get("threads", threads) == threads and fixed.get("nce", nce) == nce]
+    if len(engines) == 0:
+        engines = [(fixed.get("threads", 1), fixed.get("nce"))]
+    queue_size = fixed.get("queue_size")
+    configs = [TuningConfig(count, threads, nce, queue_size) for count in shave_counts for threads, nce in engines]
+    return configs, [] if "queue_size" in fixed else list(TUNE_QUEUE_SIZES)
+
+
+class TuningStore:
+    """Best NN settings by model and device type, kept in a JSON file across restarts.
+
+    Tuned settings are looked up by device name, like OAK-D-LITE, so every device of a type shares
+    them. The name of every device seen is kept too, a restart can then apply them before the first boot.
+    """
+    path: str
+
+    def __init__(self, path: str = DEFAULT_TUNING_FILE) -> None:
+        self.path = path
+        self.lock = Lock()
+        self.data: Union[Dict[str, Any], None] = None
+
+    def _load(self) -> Dict[str, Any]:
+        # called with lock held
+        if self.data is None:
+            try:
+                with open(self.path) as f:
+                    self.data = json.load(f)
+            except FileNotFoundError:
+                self.data = {}
+            except ValueError as e:
+                print("ignoring unreadable tuning file ", self.path, ": ", e)
+                self.data = {}
+            self.data.setdefault("devices", {})
+            self.data.setdefault("models", {})
+        return self.data
+
+    def _save(self) -> None:
+        # called with lock held, written to a temporary file first so a crash never leaves half a file
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.data, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def device_name(self, mxid: str) -> Union[str, None]:
+        with self.lock:
+            return self._load()["devices"].get(mxid)
+
+    def remember_device(self, mxid: str, name: str) -> None:
+        with self.lock:
+            devices = self._load()["devices"]
+            if devices.get(mxid) == name:
+                return
+            devices[mxid] = name
+            self._save()
+
+    def lookup(self, model: str, device_name: str, fixed: Dict[str, Any]) -> Union[TrialResult, None]:
+        """The tuned settings of a model on a device type, if they were tuned with the same knobs fixed."""
+        with self.lock:
+            entry = self._load()["models"].get(model, {}).get(device_name)
+        if entry is None or entry.get("fixed", {}) != fixed:
+            return None
+        return TrialResult.from_dict(entry["best"])
+
+    def save(self, model: str, device_name: str, fixed: Dict[str, Any], best: TrialResult, results: List[TrialResult]) -> None:
+        with self.lock:
+            self._load()["models"].setdefault(model, {})[device_name] = {
+                "fixed": fixed,
+                "best": best.to_dict(),
+                "trials": [result.to_dict() for result in results],
+                "tuned": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            }
+            self._save()
+
+
+class NNTuner(Thread):
+    """Runs trials one after the other in the background, then hands the best one to on_done.
+
+    The configs from sweep run first, then the queue depths on the best of them. If stored returns
+    a result nothing is tried and that result is the best.
+    """
+    status: str
+    results: List[TrialResult]
+    best: Union[TrialResult, None]
+    # the best result came from the store instead of trials
+    from_store: bool
+
+    def __init__(self, run_trial: Callable[[TuningConfig, Event], TrialResult], configs: List[TuningConfig], queue_sizes: List[int],
+                 on_done: Callable[["NNTuner"], None], stored: Callable[[], Union[TrialResult, None]] = lambda: None) -> None:
+        self.run_trial = run_trial
+        self.configs = configs
+        self.queue_sizes = queue_sizes
+        self.on_done = on_done
+        self.stored = stored
+        self.stopped = Event()
+        self.status = "pending"
+        self.results = []
+        self.best = None
+        self.from_store = False
+        self.started_at = 0.0
+        self.finished_at: Union[float, None] = None
+        super().__init__(name="nn-tuner", daemon=True)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def _trial(self, config: TuningConfig) -> None:
+        print("tuning trial ", config)
+        result = self.run_trial(config, self.stopped)
+        if not self.stopped.is_set():
+            print("tuning trial ", config, " fps ", round(result.fps, 1), " latency ", result.latency, " error ", result.error)
+            self.results.append(result)
+
+    def run(self) -> None:
+        self.started_at = time.monotonic()
+        self.status = "running"
+        try:
+            self.best = self.stored()
+            if self.best is not None:
+                self.from_store = True
+            else:
+                for config in self.configs:
+                    if self.stopped.is_set():
+                        break
+                    self._trial(config)
+                best = best_result(self.results)
+                for queue_size in self.queue_sizes:
+                    if self.stopped.is_set() or best is None:
+                        break
+                    config = best.config.with_queue_size(queue_size)
+                    if not any(result.config == config for result in self.results):
+                        self._trial(config)
+                self.best = best_result(self.results)
+        except Exception as e:
+            print("NN tuning failed: ", e)
+            self.results.append(TrialResult(TuningConfig(), error=str(e)))
+        self.finished_at = time.monotonic()
+        if self.stopped.is_set():
+            self.status = "stopped"
+            return
+        self.status = "done" if self.best is not None else "failed"
+        self.on_done(self)
+
+    def snapshot(self) -> Dict[str, Any]:
+        end = time.monotonic() if self.finished_at is None else self.finished_at
+        return {
+            "status": self.status,
+            "from_store": self.from_store,
+            "best": None if self.best is None else self.best.to_dict(),
+            "trials": [result.to_dict() for result in self.results],
+            "pending": max(0, len(self.configs) + len(self.queue_sizes) - len(self.results)) if self.status == "running" else 0,
+            "seconds": round(end - self.started_at, 2) if self.started_at > 0 else 0.0,
+        }
+
+
+class FactoryTrialRunner:
+    """Runs a trial on a device through the camera factory, under the requirement of the resource being tuned.
+
+    A trial reboots the device with its knobs, waits for the pipeline to settle and then measures the
+    NN results reaching the 'nn' queue and the median latency from capture to the host over `seconds`.
+    """
+    BOOT_TIMEOUT_SECONDS: ClassVar[float] = 60.0
+    # results after a boot are left out while the pipeline settles
+    WARMUP_SECONDS: ClassVar[float] = 1.0
+
+    def __init__(self, factory: OakCameraFactory, mxid: str, submit: Callable[[PipelineRequirement], bool], blob_cache: BlobCache,
+                 spec: ModelSpec, options: ColorCameraOptions, fields: Dict[str, Any], seconds: float = 3.0) -> None:
+        self.factory = factory
+        self.mxid = mxid
+        self.submit = submit
+        self.blob_cache = blob_cache
+        self.spec = spec
+        self.options = options
+        self.fields = fields
+        self.seconds = seconds
+
+    def requirement(self, config: TuningConfig) -> PipelineRequirement:
+        """The requirement running config, compiles the model for its shaves if that was not done before."""
+        blob: Path = self.blob_cache.resolve(self.spec.with_shaves(config.shaves)).result()
+        return PipelineRequirement(self.options, blob=blob, **{**self.fields, **config.fields()})
+
+    def apply(self, config: TuningConfig, stopped: Event) -> Union[Dict[str, Any], str]:
+        """Bring the device to config, returns the fields its running pipeline must have or an error."""
+        try:
+            requirement = self.requirement(config)
+        except Exception as e:
+            return "cannot compile for " + str(config.shaves) + " shaves: " + str(e)
+        if not self.submit(requirement):
+            return "stopped"
+        return requirement.fields
+
+    def wait_running(self, fields: Dict[str, Any], stopped: Event) -> Union[str, None]:
+        """Wait for the device to run a pipeline with fields, returns why it does not."""
+        deadline = time.monotonic() + self.BOOT_TIMEOUT_SECONDS
+        while not stopped.is_set() and time.monotonic() < deadline:
+            status, error = self.factory.getStatus(self.mxid)
+            settings = self.factory.getPipelineSettings(self.mxid)
+            if status == OakCameraFactory.FAILED:
+                return "boot failed: " + str(error)
+            if status == OakCameraFactory.RUNNING and settings is not None and all(
+                    getattr(settings, name) == value for name, value in fields.items()
+                    if name in PipelineSettings.BUILD_FIELDS and name not in PipelineSettings.MERGED_FIELDS):
+                return None
+            stopped.wait(0.05)
+        return "stopped" if stopped.is_set() else "device did not boot within " + str(self.BOOT_TIMEOUT_SECONDS) + "s"
+
+    def _run_for(self, seconds: float, stopped: Event) -> None:
+        deadline = time.monotonic() + seconds
+        while not stopped.is_set() and time.monotonic() < deadline:
+            # keeps an idle throttle from slowing the device down
+            self.factory.demand(self.mxid)
+            stopped.wait(min(0.1, max(0.0, deadline - time.monotonic())))
+
+    def __call__(self, config: TuningConfig, stopped: Event) -> TrialResult:
+        fields = self.apply(config, stopped)
+        if isinstance(fields, str):
+            return TrialResult(config, error=fields)
+        error = self.wait_running(fields, stopped)
+        if error is not None:
+            return TrialResult(config, error=error)
+
+        # the NN queue is read even when the resource itself reads the tracker's output
+        worker = DETECTION_THREADS.acquire(self.mxid, self.factory)
+        try:
+            self._run_for(self.WARMUP_SECONDS, stopped)
+            stats = device_stats(self.mxid)
+            queue = stats.queue("nn")
+            histogram = stats.stage("nn_to_host")
+            received = queue.received
+            before = histogram.copy()
+            start = time.monotonic()
+            self._run_for(self.seconds, stopped)
+            elapsed = time.monotonic() - start
+            window = histogram.since(before)
+            fps = (queue.received - received) / elapsed if elapsed > 0 else 0.0
+        finally:
+            DETECTION_THREADS.release(worker, timeout=1)
+        if fps == 0:
+            return TrialResult(config, error="no NN results")
+        return TrialResult(config, fps, window.percentile(0.5) if window.count > 0 else None)
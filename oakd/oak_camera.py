@@ -1,33 +1,52 @@
 import asyncio
 import time
+from functools import partial
 from timeit import default_timer as timer
-from typing import Any, ClassVar, Mapping, Optional, Tuple, Union
+from typing import Any, ClassVar, Dict, Mapping, Optional, Tuple, Union, cast
 
-import cv2
 import PIL.Image as img
+import depthai as dai
 from depthai import Device, ImgFrame
 from typing_extensions import Self
+from viam.utils import ValueTypes
 from viam.components.camera import (Camera, DistortionParameters,
                                     IntrinsicParameters, RawImage)
 from viam.components.component_base import ComponentBase
 from viam.logging import logging
+from viam.media.video import CameraMimeType
 from viam.module.types import Reconfigurable, Stoppable
 from viam.proto.app.robot import ComponentConfig
 from viam.proto.common import ResourceName
 from viam.resource.base import ResourceBase
 from viam.resource.types import Model
 
-from oakd.camera_thread import CameraThread
-from oakd.oak_camera_factory import OakCameraFactory
+from oakd.camera_thread import CameraThread, camera_threads
+from oakd.frame_ring import FrameSlot
+from oakd.frame_sync import synced_depth
+from oakd.image_cache import ENCODABLE_MIME_TYPES
+from oakd.models import CAMERA_MODEL
+from oakd.oak_camera_factory import (FRAME_STREAMS, JPEG_SOURCES,
+                                     MONO_RESOLUTIONS, ColorCameraOptions,
+                                     NotReadyError, OakCameraFactory,
+                                     PipelineRequirement, PipelineSettings)
+from oakd.point_cloud import Intrinsics, depth_to_pcd
+from oakd.recording import RECORDINGS
+from oakd.stats import Timer, device_stats
 
 # LOGGER: logging.Logger = logging.getLogger(__name__)
 
 class OakCamera(Camera, Reconfigurable, Stoppable):
-    MODEL: ClassVar[Model] = Model.from_string("oak:camera:d")
+    MODEL: ClassVar[Model] = CAMERA_MODEL
 
     CameraFactory: ClassVar[OakCameraFactory]
     cameraProperties: Camera.Properties
+    mxid: str
+    # which stream of the device this camera shows, see FRAME_STREAMS
+    stream: str = "rgb"
     worker: CameraThread
+    # frames older than this are not handed out, get_image waits for the next one instead
+    max_frame_age: float = 0.05
+    depth: bool = False
 
     @classmethod
     def new(cls, config: ComponentConfig, dependencies: Mapping[ResourceName, ResourceBase]) -> Self:
@@ -38,53 +57,318 @@ class OakCamera(Camera, Reconfigurable, Stoppable):
         """
         model = cls(config.name)
         print("creating new Oak camera")
-        print("creating new Oak camera")
 
+        model.cameraProperties = Camera.Properties(
+            supports_pcd=False,
+            distortion_parameters=None,
+            intrinsic_parameters=None
+        )
+        model.mxid = ""
+        model._configure(config)
+
+        print("build oak camera complete")
+        return model
+
+    def _configure(self, config: ComponentConfig):
         mxid = None
         if "mxid" in config.attributes.fields:
             mxid = config.attributes.fields["mxid"].string_value
         
         if mxid is None:
             raise ValueError("mxid is required")
-        
-        print("creating camera")
-        OakCamera.CameraFactory.createDevice(mxid)
-        print("adding neural net to pipeline")
-        OakCamera.CameraFactory.addRgbCameraToPipeline(mxid)
 
-        model.cameraProperties = Camera.Properties(
-            supports_pcd=False,
-            distortion_parameters=None,
-            intrinsic_parameters=None
+        if "max_frame_age_ms" in config.attributes.fields:
+            self.max_frame_age = config.attributes.fields["max_frame_age_ms"].number_value / 1000.0
+
+        jpeg_quality = 75
+        if "jpeg_quality" in config.attributes.fields:
+            jpeg_quality = int(config.attributes.fields["jpeg_quality"].number_value)
+
+        # "host" encodes JPEGs from the rgb stream, "device" uses the on-device VideoEncoder
+        jpeg_encoder = "host"
+        if "jpeg_encoder" in config.attributes.fields:
+            jpeg_encoder = config.attributes.fields["jpeg_encoder"].string_value
+        if jpeg_encoder not in ("host", "device"):
+            raise ValueError("jpeg_encoder must be host or device")
+
+        jpeg_source = "video"
+        if "jpeg_source" in config.attributes.fields:
+            jpeg_source = config.attributes.fields["jpeg_source"].string_value
+        if jpeg_source not in JPEG_SOURCES:
+            raise ValueError("jpeg_source must be one of " + ", ".join(JPEG_SOURCES))
+
+        # "width_px"/"height_px" scale the full ISP frame for the stream, otherwise the NN preview is streamed
+        stream_size = None
+        if "width_px" in config.attributes.fields or "height_px" in config.attributes.fields:
+            if "width_px" not in config.attributes.fields or "height_px" not in config.attributes.fields:
+                raise ValueError("width_px and height_px must be set together")
+            stream_size = (int(config.attributes.fields["width_px"].number_value), int(config.attributes.fields["height_px"].number_value))
+
+        # "stream" picks what get_image returns: "rgb", "preview", "isp", "left" or "right"
+        stream = "rgb"
+        if "stream" in config.attributes.fields:
+            stream = config.attributes.fields["stream"].string_value
+        if stream not in FRAME_STREAMS:
+            raise ValueError("stream must be one of " + ", ".join(FRAME_STREAMS))
+        if stream != "rgb" and jpeg_encoder == "device":
+            raise ValueError("jpeg_encoder device only works with stream rgb")
+
+        fields: Dict[str, Any] = {"streams": (stream,)}
+        if "mono_resolution" in config.attributes.fields:
+            fields["monoResolution"] = config.attributes.fields["mono_resolution"].string_value.lower()
+            if fields["monoResolution"] not in MONO_RESOLUTIONS:
+                raise ValueError("mono_resolution must be one of " + ", ".join(MONO_RESOLUTIONS))
+
+        # "depth" adds stereo depth aligned to the colour camera, which get_point_cloud needs
+        self.depth = False
+        if "depth" in config.attributes.fields:
+            self.depth = config.attributes.fields["depth"].bool_value
+        if self.depth and stream != "rgb":
+            raise ValueError("depth only works with stream rgb")
+        if self.depth:
+            fields["depth"] = True
+            if "depth_decimation" in config.attributes.fields:
+                fields["depthDecimation"] = int(config.attributes.fields["depth_decimation"].number_value)
+            if "depth_median" in config.attributes.fields:
+                fields["depthMedian"] = int(config.attributes.fields["depth_median"].number_value)
+
+        # "idle_seconds" without reads drop the device to "idle_fps" until the next read
+        if "idle_seconds" in config.attributes.fields:
+            fields["idleSeconds"] = config.attributes.fields["idle_seconds"].number_value
+            if fields["idleSeconds"] <= 0:
+                raise ValueError("idle_seconds must be positive")
+            if "idle_fps" in config.attributes.fields:
+                fields["idleFps"] = config.attributes.fields["idle_fps"].number_value
+                if fields["idleFps"] <= 0:
+                    raise ValueError("idle_fps must be positive")
+                fps = config.attributes.fields["fps"].number_value if "fps" in config.attributes.fields else PipelineSettings.fps
+                if fields["idleFps"] < fps / PipelineSettings.MAX_THROTTLE_DIVISOR:
+                    raise ValueError("idle_fps must be at least fps / " + str(PipelineSettings.MAX_THROTTLE_DIVISOR))
+
+        # "shared_memory" also writes every frame of the stream into a ring of "shared_memory_slots" for local processes
+        shared_slots = 0
+        if "shared_memory" in config.attributes.fields and config.attributes.fields["shared_memory"].bool_value:
+            shared_slots = 4
+            if "shared_memory_slots" in config.attributes.fields:
+                shared_slots = int(config.attributes.fields["shared_memory_slots"].number_value)
+            if shared_slots < 2:
+                raise ValueError("shared_memory_slots must be at least 2")
+
+        # "record_dir" records the device's encoded video and the results of its NN, see oakd/recording.py
+        record_dir = None
+        if "record_dir" in config.attributes.fields and config.attributes.fields["record_dir"].string_value != "":
+            record_dir = config.attributes.fields["record_dir"].string_value
+        if record_dir is not None and stream != "rgb":
+            raise ValueError("record_dir only works with stream rgb")
+
+        if stream == "rgb":
+            # the other streams leave the 'rgb' stream to the cameras showing it, a recording needs the device encoder
+            fields.update(streamSize=stream_size, jpegEncoder=jpeg_encoder == "device" or record_dir is not None, jpegQuality=jpeg_quality, jpegSource=jpeg_source)
+        requirement = PipelineRequirement(
+            ColorCameraOptions.fromAttributes(config.attributes.fields),
+            cameraSockets=[dai.CameraBoardSocket.CENTER],
+            **fields,
         )
-        print("creating camera thread for ", mxid)
-        model.worker = CameraThread(mxid, model.CameraFactory)
-        print("starting camera thread for ", mxid)
-        model.worker.start()
 
-        print("build oak camera complete")
-        return model
+        if mxid != self.mxid or stream != self.stream:
+            if self.mxid != "":
+                self.CameraFactory.withdraw(self.mxid, self._requirement_key())
+                self._stop_worker()
+            self.mxid = mxid
+            self.stream = stream
+            self.worker = camera_threads(stream).acquire(mxid, self.CameraFactory)
+        self.worker.request_jpeg_quality(self.name, jpeg_quality)
+        if shared_slots > 0:
+            print("camera ", self.name, " shares its frames at ", self.worker.export_frames(self.name, shared_slots))
+        else:
+            self.worker.unexport_frames(self.name)
+        if record_dir is not None:
+            RECORDINGS.acquire(mxid, self.name, record_dir, partial(self.CameraFactory.getCalibration, mxid))
+        else:
+            RECORDINGS.release(mxid, self.name)
+
+        change = self.CameraFactory.submit(mxid, self._requirement_key(), requirement)
+        print("camera ", self.name, " pipeline change: ", change)
+
+    def _requirement_key(self) -> str:
+        return "camera/" + self.name
+
+    def _stop_worker(self):
+        # the thread keeps running while a vision service on the same device still uses it
+        self.worker.unexport_frames(self.name)
+        self.worker.request_jpeg_quality(self.name, None)
+        RECORDINGS.release(self.mxid, self.name)
+        camera_threads(self.stream).release(self.worker, timeout=1)
+
+    async def wait_ready(self, timeout: Optional[float] = None):
+        """Wait until the device is running, raises NotReadyError if it is not within timeout."""
+        await self.CameraFactory.waitReady(self.mxid, timeout)
+
+    async def _wait_ready(self, timeout: Optional[float]) -> Optional[float]:
+        """Wait within the timeout of a call for the device to stream, returns what is left of the timeout.
+
+        A call without a timeout made while the device boots fails right away instead of hanging.
+        """
+        if self.worker.has_frame_stream():
+            return timeout
+        start = time.monotonic()
+        await self.CameraFactory.waitReady(self.mxid, 0 if timeout is None else timeout)
+        return None if timeout is None else max(0.0, timeout - (time.monotonic() - start))
+
+    async def get_frame(self, timeout: Optional[float] = None) -> FrameSlot:
+        """Get the latest frame if it is fresh enough, otherwise wait for the next one.
+        The returned slot is acquired and must be released with worker.frames.release.
+        """
+        slot = self.worker.acquire_frame(self.max_frame_age)
+        if slot is not None:
+            return slot
+        try:
+            return await asyncio.wait_for(self.worker.next_frame(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("no frame received from camera " + self.worker.mxid + " within " + str(timeout) + "s")
+
+    async def get_device_jpeg(self, timeout: Optional[float] = None) -> bytes:
+        """Get the latest JPEG encoded on the device if it is fresh enough, otherwise wait for the next one."""
+        packet = self.worker.get_jpeg(self.max_frame_age)
+        if packet is None:
+            try:
+                packet = await asyncio.wait_for(self.worker.next_jpeg(), timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("no jpeg received from camera " + self.worker.mxid + " within " + str(timeout) + "s")
+        self.worker.stats.stage("jpeg_to_return").record(dai.Clock.now().total_seconds() - packet.timestamp)
+        return packet.data
 
     async def get_image(self, mime_type: str = "", *, timeout: Optional[float] = None, **kwargs) -> Union[img.Image, RawImage, None]:
-        while True:
-            image = self.worker.get_image()
-            if image is not None:
-                return image
-            await asyncio.sleep(0)
+        # the SDK encodes to JPEG when no mime type is requested
+        mime, _ = CameraMimeType.from_lazy(mime_type) if mime_type else (CameraMimeType.JPEG, False)
+        if mime not in ENCODABLE_MIME_TYPES:
+            raise ValueError("unsupported mime type: " + mime_type)
+        timeout = await self._wait_ready(timeout)
+
+        with Timer(self.worker.stats.stage("get_image")):
+            if mime == CameraMimeType.JPEG and self.worker.has_jpeg_stream():
+                return RawImage(data=await self.get_device_jpeg(timeout), mime_type=mime.value)
+
+            slot = await self.get_frame(timeout)
+            try:
+                data = await self.worker.encoded.get(slot, mime)
+                self.worker.stats.stage(self.stream + "_to_return").record(dai.Clock.now().total_seconds() - slot.timestamp)
+            finally:
+                self.worker.frames.release(slot)
+            return RawImage(data=data, mime_type=mime.value)
+
+    def _intrinsics(self) -> Union[Tuple[PipelineSettings, Intrinsics, Intrinsics], None]:
+        """The running pipeline with the intrinsics of its ISP frame and of this camera's stream, None until the device booted."""
+        settings = self.CameraFactory.getPipelineSettings(self.mxid)
+        calibration = self.CameraFactory.getCalibration(self.mxid)
+        if settings is None or calibration is None:
+            return None
+        try:
+            isp, _ = settings.colorIntrinsics(calibration)
+            stream = settings.streamIntrinsics(calibration, self.stream)
+        except RuntimeError as e:
+            # uncalibrated devices have no intrinsics to report
+            print("no calibration for camera ", self.mxid, ": ", e)
+            return None
+        return settings, isp, stream
+
+    async def get_depth_frame(self, timeout: Optional[float] = None) -> FrameSlot:
+        """Like get_frame for the depth stream, the slot must be released with worker.depth.release."""
+        slot = self.worker.acquire_depth(self.max_frame_age)
+        if slot is not None:
+            return slot
+        try:
+            return await asyncio.wait_for(self.worker.next_depth(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("no depth frame received from camera " + self.worker.mxid + " within " + str(timeout) + "s")
 
     async def get_point_cloud(self, *, timeout: Optional[float] = None, **kwargs) -> Tuple[bytes, str]:
-        raise NotImplemented()
+        if not self.depth:
+            raise ValueError("point clouds need depth: true in the camera config")
+        timeout = await self._wait_ready(timeout)
+        intrinsics = self._intrinsics()
+        if intrinsics is None or not self.worker.has_depth_stream():
+            raise TimeoutError("camera " + self.mxid + " is not running depth yet")
+        settings, isp, _ = intrinsics
+
+        color = self.worker.acquire_frame()
+        try:
+            # colour the points from the frame the depth was computed from
+            depth = await (self.get_depth_frame(timeout) if color is None else synced_depth(self.worker, color.timestamp, 1.0 / settings.fps, timeout))
+        except BaseException:
+            if color is not None:
+                self.worker.frames.release(color)
+            raise
+        try:
+            # depth is aligned to the whole ISP frame, the rgb stream may only show part of it
+            offset, scale = settings.streamTransform()
+            with Timer(self.worker.stats.stage("point_cloud")):
+                data = await asyncio.get_running_loop().run_in_executor(
+                    None, depth_to_pcd, depth.view, isp, None if color is None else color.view, offset, scale)
+        finally:
+            self.worker.depth.release(depth)
+            if color is not None:
+                self.worker.frames.release(color)
+        return data, CameraMimeType.PCD.value
 
     async def get_properties(self, *, timeout: Optional[float] = None, **kwargs) -> Camera.Properties:
-        return self.cameraProperties
+        intrinsics = self._intrinsics()
+        if intrinsics is None:
+            return self.cameraProperties._replace(supports_pcd=self.depth)
+        settings, _, stream = intrinsics
+        calibration = cast(dai.CalibrationHandler, self.CameraFactory.getCalibration(self.mxid))
+        # depthai orders the coefficients k1, k2, p1, p2, k3, ...
+        k1, k2, p1, p2, k3 = calibration.getDistortionCoefficients(settings.streamSocket(self.stream))[:5]
+        return Camera.Properties(
+            supports_pcd=self.depth,
+            intrinsic_parameters=IntrinsicParameters(
+                width_px=stream.width, height_px=stream.height,
+                focal_x_px=stream.fx, focal_y_px=stream.fy,
+                center_x_px=stream.cx, center_y_px=stream.cy,
+            ),
+            distortion_parameters=DistortionParameters(model="brown_conrady", parameters=[k1, k2, k3, p1, p2]),
+        )
         
+    async def do_command(self, command: Mapping[str, ValueTypes], *, timeout: Optional[float] = None, **kwargs) -> Mapping[str, ValueTypes]:
+        name = command.get("command")
+        if name == "stats":
+            stats = device_stats(self.mxid).snapshot()
+            stats["frames"] = {"dropped": self.worker.frames.dropped}
+            stats["encoder"] = {"encodes": self.worker.encoded.encodes, "cache_hits": self.worker.encoded.hits}
+            return stats
+        if name == "ready":
+            # with "wait": true this returns once the device runs or the call times out
+            if command.get("wait"):
+                try:
+                    await self.wait_ready(timeout)
+                except NotReadyError:
+                    pass
+            return self.CameraFactory.readiness(self.mxid)
+        if name == "shared_memory":
+            # where local processes find the frames, see oakd/shared_frames.py
+            slots = self.worker.exports.get(self.name)
+            return {"enabled": slots is not None, "path": self.worker.shared_path(), "slots": slots or 0}
+        if name == "recording":
+            recorder = RECORDINGS.get(self.mxid)
+            if recorder is None:
+                return {"enabled": False}
+            return {"enabled": True, "directory": recorder.directory, **recorder.status()}
+        if name == "replay":
+            # only devices playing back a recording can seek, see oakd/replay_device.py
+            device = self.CameraFactory.getDevice(self.mxid)
+            if device is None or not hasattr(device, "seek"):
+                raise ValueError("camera " + self.name + " is not replaying a recording")
+            if "seek" in command:
+                device.seek(int(cast(float, command["seek"])))
+            return device.position()
+        raise ValueError("unknown command: " + str(name))
+
     def reconfigure(self, config: ComponentConfig, dependencies: Mapping[ResourceName, ComponentBase]):
         print("reconfigure called...")
-        pass
+        self._configure(config)
     
     def stop(self, *, extra: Optional[Mapping[str, Any]] = None, timeout: Optional[float] = None, **kwargs):
         print("Stop called in camera")
-        while self.worker.running:
-            self.worker.stop()
-            time.sleep(1)
+        self._stop_worker()
+        self.CameraFactory.withdraw(self.mxid, self._requirement_key())
         return super().stop(extra=extra, timeout=timeout, **kwargs)
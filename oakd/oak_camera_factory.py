@@ -1,156 +1,1211 @@
+import asyncio
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from threading import Lock
-from typing import ClassVar, Union
+from threading import Lock, RLock, Timer
+from typing import Any, Callable, ClassVar, Tuple, Union
 
 import depthai as dai
+import numpy as np
 from viam.logging import logging
 
+from oakd.point_cloud import Intrinsics
+from oakd.queue_watch import Waiters
+from oakd.stats import device_stats
+from oakd import stats
+
 # LOGGER: logging.Logger = logging.getLogger(__name__)
 
+SENSOR_RESOLUTIONS: dict[str, dai.ColorCameraProperties.SensorResolution] = {
+    "720p": dai.ColorCameraProperties.SensorResolution.THE_720_P,
+    "800p": dai.ColorCameraProperties.SensorResolution.THE_800_P,
+    "1080p": dai.ColorCameraProperties.SensorResolution.THE_1080_P,
+    "1200p": dai.ColorCameraProperties.SensorResolution.THE_1200_P,
+    "4k": dai.ColorCameraProperties.SensorResolution.THE_4_K,
+    "5mp": dai.ColorCameraProperties.SensorResolution.THE_5_MP,
+    "12mp": dai.ColorCameraProperties.SensorResolution.THE_12_MP,
+    "13mp": dai.ColorCameraProperties.SensorResolution.THE_13_MP,
+}
+
+# the largest frame the ColorCamera video output can carry
+MAX_VIDEO_SIZE = (3840, 2160)
+
+# resolutions of the mono cameras, which feed the 'left' and 'right' streams and stereo depth
+MONO_RESOLUTIONS: dict[str, dai.MonoCameraProperties.SensorResolution] = {
+    "400p": dai.MonoCameraProperties.SensorResolution.THE_400_P,
+    "480p": dai.MonoCameraProperties.SensorResolution.THE_480_P,
+    "720p": dai.MonoCameraProperties.SensorResolution.THE_720_P,
+    "800p": dai.MonoCameraProperties.SensorResolution.THE_800_P,
+}
+
+# frame streams a pipeline can send to the host:
+# 'rgb' the preview, or the ISP frame scaled to streamSize, 'preview' always the NN input,
+# 'isp' the full ISP frame, 'left' and 'right' the grey frames of the mono cameras
+FRAME_STREAMS = ("rgb", "preview", "isp", "left", "right")
+# colour camera outputs the on-device JPEG encoder can take its frames from
+JPEG_SOURCES = ("video", "preview")
+MONO_SOCKETS: dict[str, dai.CameraBoardSocket] = {"left": dai.CameraBoardSocket.LEFT, "right": dai.CameraBoardSocket.RIGHT}
+
+# on-device median filter applied to the stereo disparity, by kernel size
+DEPTH_MEDIAN_FILTERS: dict[int, dai.MedianFilter] = {
+    0: dai.MedianFilter.MEDIAN_OFF,
+    3: dai.MedianFilter.KERNEL_3x3,
+    5: dai.MedianFilter.KERNEL_5x5,
+    7: dai.MedianFilter.KERNEL_7x7,
+}
+
+# ObjectTracker algorithms by tracker_type. The short term trackers follow objects on the frames
+# between NN results, the zero term ones only match boxes of consecutive NN results.
+TRACKER_TYPES: dict[str, dai.TrackerType] = {
+    "short_term_imageless": dai.TrackerType.SHORT_TERM_IMAGELESS,
+    "short_term_kcf": dai.TrackerType.SHORT_TERM_KCF,
+    "zero_term_imageless": dai.TrackerType.ZERO_TERM_IMAGELESS,
+    "zero_term_color_histogram": dai.TrackerType.ZERO_TERM_COLOR_HISTOGRAM,
+}
+
+# passes every divisor-th frame of its input on, the divisor is sent by the host on 'nn_rate'
+THROTTLE_SCRIPT = """
+divisor = 1
+while True:
+    frame = node.io['in'].get()
+    update = node.io['throttle'].tryGet()
+    if update is not None:
+        divisor = max(1, update.getData()[0])
+    if frame.getSequenceNum() % divisor == 0:
+        node.io['out'].send(frame)
+"""
+
+# one script for every stream of an idle device, each input goes out on the output of the same name.
+# The colour and mono cameras number their frames separately, so only the colour outputs, which share
+# one counter, pass every divisor-th frame. A mono frame passes when a colour frame captured within half
+# a frame period passed, which keeps rgb, left, right and depth at the same instants. COLOUR, MONO and
+# HALF_PERIOD are prepended by OakCameraFactory.build, the divisor is sent by the host on 'throttle'.
+IDLE_SCRIPT = """
+import time
+divisor = 1
+# capture time of the newest colour frame, and of the last colour frames that passed
+newest = None
+passed = []
+# mono frames wait here until the colour frame of their instant was seen
+held = {name: [] for name in MONO}
+while True:
+    update = node.io['throttle'].tryGet()
+    if update is not None:
+        divisor = max(1, update.getData()[0])
+    waiting = True
+    for name in COLOUR:
+        frame = node.io[name].tryGet()
+        if frame is None:
+            continue
+        waiting = False
+        captured = frame.getTimestamp().total_seconds()
+        keep = frame.getSequenceNum() % divisor == 0
+        if newest is None or captured > newest:
+            newest = captured
+            if keep:
+                passed = passed[-3:] + [captured]
+        if keep:
+            node.io[name].send(frame)
+    for name in MONO:
+        frame = node.io[name].tryGet()
+        if frame is not None:
+            waiting = False
+            held[name].append(frame)
+        # the oldest are dropped if colour frames stop coming
+        del held[name][:-4]
+        while len(held[name]) > 0:
+            frame = held[name][0]
+            captured = frame.getTimestamp().total_seconds()
+            if divisor == 1:
+                keep = True
+            elif len(COLOUR) == 0:
+                keep = frame.getSequenceNum() % divisor == 0
+            elif newest is None or newest < captured - HALF_PERIOD:
+                break
+            else:
+                keep = any(abs(at - captured) <= HALF_PERIOD for at in passed)
+            held[name].pop(0)
+            if keep:
+                node.io[name].send(frame)
+    if waiting:
+        time.sleep(0.001)
+"""
+
+# camera controls that can be changed on a running device without rebuilding the pipeline
+CAMERA_CONTROL_ATTRIBUTES = ("exposure_us", "iso", "focus", "white_balance_k", "brightness", "contrast", "saturation", "sharpness")
+
+def buildCameraControl(controls: dict[str, float], control: Union[dai.CameraControl, None] = None,
+                       previous: Union[dict[str, float], None] = None) -> dai.CameraControl:
+    """A CameraControl applying controls. Controls in previous that are no longer set go back to auto or their default."""
+    if control is None:
+        control = dai.CameraControl()
+    removed = set() if previous is None else set(previous) - set(controls)
+    if removed & {"exposure_us", "iso"} and not ("exposure_us" in controls or "iso" in controls):
+        control.setAutoExposureEnable()
+    if "focus" in removed:
+        control.setAutoFocusMode(dai.CameraControl.AutoFocusMode.CONTINUOUS_VIDEO)
+    if "white_balance_k" in removed:
+        control.setAutoWhiteBalanceMode(dai.CameraControl.AutoWhiteBalanceMode.AUTO)
+    # image controls have no auto mode, a removed one goes back to the sensor default
+    if "brightness" in removed:
+        control.setBrightness(0)
+    if "contrast" in removed:
+        control.setContrast(0)
+    if "saturation" in removed:
+        control.setSaturation(0)
+    if "sharpness" in removed:
+        control.setSharpness(1)
+    if "exposure_us" in controls or "iso" in controls:
+        control.setManualExposure(int(controls.get("exposure_us", 20000)), int(controls.get("iso", 800)))
+    if "focus" in controls:
+        control.setManualFocus(int(controls["focus"]))
+    if "white_balance_k" in controls:
+        control.setManualWhiteBalance(int(controls["white_balance_k"]))
+    if "brightness" in controls:
+        control.setBrightness(int(controls["brightness"]))
+    if "contrast" in controls:
+        control.setContrast(int(controls["contrast"]))
+    if "saturation" in controls:
+        control.setSaturation(int(controls["saturation"]))
+    if "sharpness" in controls:
+        control.setSharpness(int(controls["sharpness"]))
+    return control
+
+class ColorCameraOptions:
+    """Colour camera settings a resource asked for in its config, None leaves the current setting alone."""
+    sensorResolution: Union[str, None] = None
+    ispScale: Union[Tuple[int, int], None] = None
+    fps: Union[float, None] = None
+    controls: dict[str, float]
+
+    def __init__(self) -> None:
+        self.controls = {}
+
+    @classmethod
+    def fromAttributes(cls, fields) -> "ColorCameraOptions":
+        # "sensor_resolution": "720p|800p|1080p|1200p|4k|5mp|12mp|13mp"
+        # "isp_scale": [numerator, denominator]
+        # "fps": float
+        # CAMERA_CONTROL_ATTRIBUTES: numbers, applied without a reboot when they change
+        options = cls()
+        for name in CAMERA_CONTROL_ATTRIBUTES:
+            if name in fields:
+                options.controls[name] = fields[name].number_value
+        if "sensor_resolution" in fields:
+            options.sensorResolution = fields["sensor_resolution"].string_value.lower()
+            if options.sensorResolution not in SENSOR_RESOLUTIONS:
+                raise ValueError("sensor_resolution must be one of " + ", ".join(SENSOR_RESOLUTIONS))
+        if "isp_scale" in fields:
+            scale = [int(v.number_value) for v in fields["isp_scale"].list_value.values]
+            if len(scale) != 2 or scale[0] <= 0 or scale[1] <= 0:
+                raise ValueError("isp_scale must be [numerator, denominator]")
+            options.ispScale = (scale[0], scale[1])
+        if "fps" in fields:
+            options.fps = fields["fps"].number_value
+            if options.fps <= 0:
+                raise ValueError("fps must be positive")
+        return options
+
+    def apply(self, settings: "PipelineSettings"):
+        if self.sensorResolution is not None:
+            settings.sensorResolution = self.sensorResolution
+        if self.ispScale is not None:
+            settings.ispScale = self.ispScale
+        if self.fps is not None:
+            settings.fps = self.fps
+        if len(self.controls) > 0:
+            settings.controls = {**settings.controls, **self.controls}
+
+
+class PipelineRequirement:
+    """What one resource needs from the pipeline of its device.
+
+    `fields` are PipelineSettings attributes, anything not set is left to the other resources on the device.
+    """
+    fields: dict[str, Any]
+    options: ColorCameraOptions
+
+    def __init__(self, options: Union[ColorCameraOptions, None] = None, **fields) -> None:
+        for name in fields:
+            if name not in PipelineSettings.BUILD_FIELDS and name not in PipelineSettings.RUNTIME_FIELDS:
+                raise ValueError("unknown pipeline setting", name)
+        self.fields = fields
+        self.options = ColorCameraOptions() if options is None else options
+
+    def apply(self, settings: "PipelineSettings"):
+        for name, value in self.fields.items():
+            if name in PipelineSettings.MERGED_FIELDS:
+                value = PipelineSettings.MERGED_FIELDS[name](getattr(settings, name), value)
+            setattr(settings, name, value)
+        self.options.apply(settings)
+
+
 class PipelineSettings:
     blob: Union[Path, None] = None
     cameraSockets: list[dai.CameraBoardSocket] = [dai.CameraBoardSocket.CENTER]
+    sensorResolution: str = "1080p"
+    # (numerator, denominator) applied by the ISP to the sensor frame, None keeps the full sensor resolution
+    ispScale: Union[Tuple[int, int], None] = None
+    fps: float = 20
+    # preview frames feed the neural net, so this is the NN input size
+    previewSize: Tuple[int, int] = (416, 416)
+    # frame streams sent to the host, see FRAME_STREAMS. Every resource adds the ones it reads.
+    streams: Tuple[str, ...] = ()
+    # size of the 'rgb' stream sent to the host, None sends the preview itself
+    streamSize: Union[Tuple[int, int], None] = None
+    # see MONO_RESOLUTIONS
+    monoResolution: str = "400p"
+    # on-device MJPEG encoding of the colour camera, published on the 'jpeg' stream
+    jpegEncoder: bool = False
+    # the highest quality any resource asked for, None uses the encoder default
+    jpegQuality: Union[int, None] = None
+    # 'video' encodes the full sensor frame, 'preview' the same frame the 'rgb' stream carries
+    jpegSource: str = "video"
+    # stereo depth aligned to the colour camera, published on the 'depth' stream in millimeters
+    depth: bool = False
+    # the device shrinks the depth frame by this factor (1-4) before sending it
+    depthDecimation: int = 2
+    # median filter kernel size, see DEPTH_MEDIAN_FILTERS
+    depthMedian: int = 5
+    # run the NN as a YoloSpatialDetectionNetwork, which also locates every detection in 3D
+    spatial: bool = False
+    # "yolo" decodes boxes on the device, "classifier" sends the raw output tensor of a generic NeuralNetwork
+    nnType: str = "yolo"
+    # how many frames each NN works on at the same time
+    inferenceThreads: int = 1
+    # neural compute engines per inference thread, None leaves it to depthai. threads * engines must fit the device's two.
+    ncePerThread: Union[int, None] = None
+    # frames waiting at the input of the detection NN, the oldest is dropped when it is full. None leaves it to depthai.
+    nnQueueSize: Union[int, None] = None
+    # NN frame rate, None runs the NN on every frame. Whether it is set changes the pipeline, its value does not.
+    nnFps: Union[float, None] = None
+    # an ObjectTracker follows the NN's detections on every frame and publishes them with track ids on 'tracklets'
+    tracking: bool = False
+    # see TRACKER_TYPES
+    trackerType: str = "short_term_imageless"
+    # a second NN fed with images sent by the host on 'nn_in', results on 'nn_host'
+    hostInference: bool = False
+    # seconds without anybody reading frames or NN results before the device only sends idleFps,
+    # None never throttles. Whether it is set changes the pipeline, its value does not.
+    idleSeconds: Union[float, None] = None
+    idleFps: float = 1.0
+    # runtime camera controls, see CAMERA_CONTROL_ATTRIBUTES
+    controls: dict[str, float] = {}
 
-    def build(self) -> dai.Pipeline:
-        print("building pipeline")
-        pipeline = dai.Pipeline()
-        print("including RBG in pipeline")
+    # everything that needs a new pipeline, and therefore a device reboot, when it changes
+    BUILD_FIELDS: ClassVar[Tuple[str, ...]] = ("blob", "cameraSockets", "sensorResolution", "ispScale", "fps", "previewSize",
+                                               "streams", "streamSize", "monoResolution", "jpegEncoder", "jpegQuality", "jpegSource",
+                                               "depth", "depthDecimation", "depthMedian", "spatial",
+                                               "nnType", "inferenceThreads", "ncePerThread", "nnQueueSize", "tracking", "trackerType",
+                                               "hostInference")
+
+    # settings a running device picks up without a reboot
+    RUNTIME_FIELDS: ClassVar[Tuple[str, ...]] = ("idleSeconds", "idleFps", "nnFps")
+
+    # settings that collect what every requirement asks for instead of taking the last one,
+    # each function merges a requirement's value into the one so far
+    MERGED_FIELDS: ClassVar[dict[str, Callable[[Any, Any], Any]]] = {
+        "streams": lambda merged, value: tuple(sorted(set(merged) | set(value))),
+        "jpegQuality": lambda merged, value: value if merged is None else max(merged, value),
+    }
+
+    def buildKey(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, name) for name in self.BUILD_FIELDS) + (self.idleSeconds is not None, self.nnFps is not None)
+
+    def runtimeKey(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, name) for name in self.RUNTIME_FIELDS)
+
+    # the throttle scripts read their divisor from a single byte
+    MAX_THROTTLE_DIVISOR: ClassVar[int] = 255
+
+    def idleDivisor(self) -> int:
+        """Every how many frames the device sends one while idle."""
+        return self._divisor(self.idleFps)
+
+    def nnDivisor(self) -> int:
+        """On every how many frames the NN runs."""
+        if self.nnFps is None:
+            return 1
+        return self._divisor(self.nnFps)
+
+    def _divisor(self, rate: float) -> int:
+        return min(self.MAX_THROTTLE_DIVISOR, max(1, int(round(self.fps / rate))))
+
+    def hasNnRate(self) -> bool:
+        """Whether the NN sits behind a THROTTLE_SCRIPT that takes its divisor on 'nn_rate'."""
+        return self.blob is not None and self.nnFps is not None
+
+    def _throttle(self, pipeline: dai.Pipeline, output: dai.Node.Output, throttle: Union[dai.node.XLinkIn, None]) -> dai.Node.Output:
+        # frames from output pass a THROTTLE_SCRIPT to lower the NN rate
+        if throttle is None:
+            return output
+        script = pipeline.create(dai.node.Script)
+        script.setScript(THROTTLE_SCRIPT)
+        output.link(script.inputs['in'])
+        script.inputs['in'].setBlocking(False)
+        script.inputs['in'].setQueueSize(2)
+        throttle.out.link(script.inputs['throttle'])
+        script.inputs['throttle'].setBlocking(False)
+        script.inputs['throttle'].setQueueSize(1)
+        return script.outputs['out']
+
+    def _idleGate(self, idle: Union[dai.node.Script, None], output: dai.Node.Output, name: str) -> dai.Node.Output:
+        # frames from output pass the IDLE_SCRIPT as name when the device may idle
+        if idle is None:
+            return output
+        output.link(idle.inputs[name])
+        idle.inputs[name].setBlocking(False)
+        idle.inputs[name].setQueueSize(2)
+        return idle.outputs[name]
+
+    def _idleScript(self, idle: dai.node.Script) -> str:
+        names = [input.name for input in idle.getInputs() if input.name != 'throttle']
+        colour = [name for name in names if name not in MONO_SOCKETS]
+        mono = [name for name in names if name in MONO_SOCKETS]
+        return "COLOUR = %r\nMONO = %r\nHALF_PERIOD = %r\n" % (colour, mono, 0.5 / self.fps) + IDLE_SCRIPT
+
+    def _createColorCamera(self, pipeline: dai.Pipeline) -> dai.node.ColorCamera:
+        if self.sensorResolution not in SENSOR_RESOLUTIONS:
+            raise ValueError("invalid sensor resolution", self.sensorResolution)
         color_camera = pipeline.create(dai.node.ColorCamera)
-        color_camera.setPreviewSize(416, 416)
+        color_camera.setPreviewSize(*self.previewSize)
         color_camera.setBoardSocket(self.cameraSockets[0])
-        color_camera.setResolution(dai.ColorCameraProperties.SensorResolution.THE_1080_P)
+        color_camera.setResolution(SENSOR_RESOLUTIONS[self.sensorResolution])
+        if self.ispScale is not None:
+            color_camera.setIspScale(*self.ispScale)
+        isp_width, isp_height = color_camera.getIspSize()
+        if isp_width <= MAX_VIDEO_SIZE[0] and isp_height <= MAX_VIDEO_SIZE[1]:
+            # keep the video output uncropped so it covers the same field of view as the ISP frame
+            color_camera.setVideoSize(isp_width, isp_height)
         color_camera.setInterleaved(False)
         color_camera.setColorOrder(dai.ColorCameraProperties.ColorOrder.BGR)
-        color_camera.setFps(20)
-        
-        xout_rgb = pipeline.createXLinkOut()
-        xout_rgb.setStreamName('rgb')
-        color_camera.preview.link(xout_rgb.input)
+        color_camera.setFps(self.fps)
+        return color_camera
+
+    def ispSize(self) -> Tuple[int, int]:
+        # let depthai do the rounding, the same way it will on the device
+        return self._createColorCamera(dai.Pipeline()).getIspSize()
+
+    def monoSize(self) -> Tuple[int, int]:
+        if self.monoResolution not in MONO_RESOLUTIONS:
+            raise ValueError("invalid mono resolution", self.monoResolution)
+        mono = dai.Pipeline().create(dai.node.MonoCamera)
+        mono.setResolution(MONO_RESOLUTIONS[self.monoResolution])
+        return mono.getResolutionSize()
+
+    def rgbStreamSize(self) -> Tuple[int, int]:
+        return self.previewSize if self.streamSize is None else self.streamSize
+
+    def frameStreamSize(self, stream: str) -> Tuple[int, int]:
+        if stream == "rgb":
+            return self.rgbStreamSize()
+        if stream == "preview":
+            return self.previewSize
+        if stream == "isp":
+            return self.ispSize()
+        return self.monoSize()
+
+    def streamSocket(self, stream: str) -> dai.CameraBoardSocket:
+        return MONO_SOCKETS.get(stream, self.cameraSockets[0])
+
+    def detectionTransform(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Offset and scale that map normalized NN (xmin, ymin, xmax, ymax) into 'rgb' stream pixels."""
+        # asked for on every detection call, while it only changes with the build settings
+        key = self.buildKey()
+        cached = self.__dict__.get("_detectionTransform")
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        transform = self._computeDetectionTransform()
+        self._detectionTransform = (key, transform)
+        return transform
+
+    def _previewCrop(self) -> Tuple[float, float]:
+        # the preview keeps its aspect ratio by center-cropping the ISP frame,
+        # returns the cropped width and height as fractions of the ISP frame
+        isp_width, isp_height = self.ispSize()
+        preview_width, preview_height = self.previewSize
+        crop_width = min(1.0, (isp_height * preview_width / preview_height) / isp_width)
+        crop_height = min(1.0, (isp_width * preview_height / preview_width) / isp_height)
+        return crop_width, crop_height
+
+    def previewToIsp(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Offset and scale that map normalized NN (xmin, ymin, xmax, ymax) into the normalized ISP frame, which depth is aligned to."""
+        crop_width, crop_height = self._previewCrop()
+        x0 = (1.0 - crop_width) / 2
+        y0 = (1.0 - crop_height) / 2
+        return np.array([x0, y0, x0, y0]), np.array([crop_width, crop_height, crop_width, crop_height])
+
+    def streamTransform(self, stream: str = "rgb") -> Tuple[Tuple[float, float], Tuple[float, float]]:
+        """Offset and scale that map normalized ISP frame (x, y) into pixels of a colour stream."""
+        stream_width, stream_height = self.frameStreamSize(stream)
+        if stream == "isp" or (stream == "rgb" and self.streamSize is not None):
+            return (0.0, 0.0), (float(stream_width), float(stream_height))
+        crop_width, crop_height = self._previewCrop()
+        scale = (stream_width / crop_width, stream_height / crop_height)
+        return ((crop_width - 1.0) / 2 * scale[0], (crop_height - 1.0) / 2 * scale[1]), scale
+
+    def colorIntrinsics(self, calibration: dai.CalibrationHandler) -> Tuple[Intrinsics, Intrinsics]:
+        """Intrinsics of the full ISP frame, which aligned depth frames cover, and of the 'rgb' stream."""
+        # needed for every point cloud, while it only changes with the calibration and build settings
+        key = (id(calibration), self.buildKey())
+        cached = self.__dict__.get("_colorIntrinsics")
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        intrinsics = self._computeColorIntrinsics(calibration)
+        self._colorIntrinsics = (key, intrinsics)
+        return intrinsics
+
+    def _computeColorIntrinsics(self, calibration: dai.CalibrationHandler, stream: str = "rgb") -> Tuple[Intrinsics, Intrinsics]:
+        isp_width, isp_height = self.ispSize()
+        isp = Intrinsics.from_matrix(calibration.getCameraIntrinsics(self.cameraSockets[0], isp_width, isp_height), isp_width, isp_height)
+        offset, scale = self.streamTransform(stream)
+        stream_width, stream_height = self.frameStreamSize(stream)
+        return isp, isp.scaled(stream_width, stream_height, offset, (scale[0] / isp_width, scale[1] / isp_height))
+
+    def streamIntrinsics(self, calibration: dai.CalibrationHandler, stream: str) -> Intrinsics:
+        """Intrinsics of the frames of any stream in FRAME_STREAMS."""
+        if stream == "rgb":
+            return self.colorIntrinsics(calibration)[1]
+        if stream in MONO_SOCKETS:
+            width, height = self.monoSize()
+            return Intrinsics.from_matrix(calibration.getCameraIntrinsics(MONO_SOCKETS[stream], width, height), width, height)
+        return self._computeColorIntrinsics(calibration, stream)[1]
+
+    def _computeDetectionTransform(self) -> Tuple[np.ndarray, np.ndarray]:
+        stream_width, stream_height = self.rgbStreamSize()
+        if self.streamSize is None:
+            # the stream is the NN input itself
+            return np.zeros(4), np.array([stream_width, stream_height, stream_width, stream_height], dtype=float)
+
+        # the stream is the whole ISP frame, so the NN only sees a region of the stream
+        crop_width, crop_height = self._previewCrop()
+        x0 = (1.0 - crop_width) / 2 * stream_width
+        y0 = (1.0 - crop_height) / 2 * stream_height
+        offset = np.array([x0, y0, x0, y0])
+        scale = np.array([crop_width * stream_width, crop_height * stream_height, crop_width * stream_width, crop_height * stream_height])
+        return offset, scale
+
+    def _createMonoCameras(self, pipeline: dai.Pipeline, idle: Union[dai.node.Script, None] = None) -> dict[str, dai.Node.Output]:
+        # one camera node per socket, shared by stereo depth and the 'left' and 'right' streams
+        if self.monoResolution not in MONO_RESOLUTIONS:
+            raise ValueError("invalid mono resolution", self.monoResolution)
+        outputs = {}
+        for name, socket in MONO_SOCKETS.items():
+            mono = pipeline.create(dai.node.MonoCamera)
+            mono.setBoardSocket(socket)
+            mono.setResolution(MONO_RESOLUTIONS[self.monoResolution])
+            mono.setFps(self.fps)
+            outputs[name] = self._idleGate(idle, mono.out, name)
+        return outputs
+
+    def _createFrameStream(self, pipeline: dai.Pipeline, name: str, source: dai.Node.Output, size: Tuple[int, int], resize: bool = False):
+        # the host wants interleaved RGB, the conversion is done on the device
+        manip = pipeline.create(dai.node.ImageManip)
+        manip.initialConfig.setFrameType(dai.ImgFrame.Type.RGB888i)
+        manip.setMaxOutputFrameSize(size[0] * size[1] * 3)
+        if resize:
+            manip.initialConfig.setResize(*size)
+            manip.initialConfig.setKeepAspectRatio(False)
+        source.link(manip.inputImage)
+        xout = pipeline.createXLinkOut()
+        xout.setStreamName(name)
+        manip.out.link(xout.input)
+
+    def _createStereoDepth(self, pipeline: dai.Pipeline, monos: dict[str, dai.Node.Output]) -> dai.node.StereoDepth:
+        print("including stereo depth in pipeline")
+        if self.depthMedian not in DEPTH_MEDIAN_FILTERS:
+            raise ValueError("invalid depth median filter", self.depthMedian)
+        if self.depthDecimation < 1 or self.depthDecimation > 4:
+            raise ValueError("depth decimation must be between 1 and 4", self.depthDecimation)
+        stereo = pipeline.create(dai.node.StereoDepth)
+        stereo.setDefaultProfilePreset(dai.node.StereoDepth.PresetMode.HIGH_DENSITY)
+        # aligning to the colour camera needs the left-right check
+        stereo.setLeftRightCheck(True)
+        stereo.setDepthAlign(self.cameraSockets[0])
+        stereo.initialConfig.setMedianFilter(DEPTH_MEDIAN_FILTERS[self.depthMedian])
+        # filtering and decimating on the device keeps the depth stream small over XLink
+        config = stereo.initialConfig.get()
+        config.postProcessing.decimationFilter.decimationFactor = self.depthDecimation
+        stereo.initialConfig.set(config)
+
+        monos["left"].link(stereo.left)
+        monos["right"].link(stereo.right)
+
+        xout_depth = pipeline.createXLinkOut()
+        xout_depth.setStreamName('depth')
+        stereo.depth.link(xout_depth.input)
+        return stereo
+
+    def _createNeuralNetwork(self, pipeline: dai.Pipeline) -> Union[dai.node.YoloDetectionNetwork, dai.node.NeuralNetwork]:
+        if self.nnType == "yolo":
+            detection_nn = pipeline.create(dai.node.YoloDetectionNetwork)
+            self._configureDetectionNetwork(detection_nn)
+            return detection_nn
+        if self.nnType == "classifier":
+            # a plain NeuralNetwork hands the raw output tensor to the host
+            classifier_nn = pipeline.create(dai.node.NeuralNetwork)
+            classifier_nn.setBlobPath(self.blob)
+            self._configureInference(classifier_nn)
+            return classifier_nn
+        raise ValueError("invalid nn type", self.nnType)
+
+    def _configureInference(self, nn: dai.node.NeuralNetwork):
+        nn.setNumInferenceThreads(self.inferenceThreads)
+        if self.ncePerThread is not None:
+            nn.setNumNCEPerInferenceThread(self.ncePerThread)
+
+    def _configureDetectionNetwork(self, detection_nn: dai.node.YoloDetectionNetwork):
+        detection_nn.setBlobPath(self.blob)
+        detection_nn.setNumClasses(80)
+        detection_nn.setConfidenceThreshold(0.8)
+        self._configureInference(detection_nn)
+        detection_nn.setCoordinateSize(4)
+        detection_nn.setIouThreshold(0.5)
+        detection_nn.setAnchors([10, 14, 23, 27, 37, 58, 81, 82, 135, 169, 344, 319])
+        detection_nn.setAnchorMasks({"side26": [1, 2, 3], "side13": [3, 4, 5]})
+
+    def _createObjectTracker(self, pipeline: dai.Pipeline, frames: dai.Node.Output, detection_nn: dai.node.YoloDetectionNetwork) -> dai.node.ObjectTracker:
+        # the tracker sees every frame, the NN only the ones it had time for
+        tracker = pipeline.create(dai.node.ObjectTracker)
+        tracker.setTrackerType(TRACKER_TYPES[self.trackerType])
+        # ids are never handed out twice, so a consumer can tell a new object from one seen before
+        tracker.setTrackerIdAssignmentPolicy(dai.TrackerIdAssignmentPolicy.UNIQUE_ID)
+        frames.link(tracker.inputTrackerFrame)
+        tracker.inputTrackerFrame.setBlocking(False)
+        tracker.inputTrackerFrame.setQueueSize(2)
+        detection_nn.passthrough.link(tracker.inputDetectionFrame)
+        detection_nn.out.link(tracker.inputDetections)
+
+        xout_tracklets = pipeline.createXLinkOut()
+        xout_tracklets.setStreamName('tracklets')
+        tracker.out.link(xout_tracklets.input)
+        return tracker
+
+    def _createHostInference(self, pipeline: dai.Pipeline) -> Union[dai.node.YoloDetectionNetwork, dai.node.NeuralNetwork]:
+        # the host sends interleaved RGB frames already resized to the NN input, converting
+        # them to the planar BGR the NN wants is left to the device
+        print("including host image inference in pipeline")
+        width, height = self.previewSize
+        xin_image = pipeline.createXLinkIn()
+        xin_image.setStreamName('nn_in')
+        xin_image.setMaxDataSize(width * height * 3)
+        xin_image.setNumFrames(self.inferenceThreads + 1)
+
+        bgr_manip = pipeline.create(dai.node.ImageManip)
+        bgr_manip.initialConfig.setFrameType(dai.ImgFrame.Type.BGR888p)
+        bgr_manip.setMaxOutputFrameSize(width * height * 3)
+        bgr_manip.setNumFramesPool(self.inferenceThreads + 1)
+        xin_image.out.link(bgr_manip.inputImage)
+
+        host_nn = self._createNeuralNetwork(pipeline)
+        # host requests must not be dropped, the host limits how many are in flight instead
+        host_nn.input.setBlocking(True)
+        host_nn.input.setQueueSize(self.inferenceThreads)
+        bgr_manip.out.link(host_nn.input)
+
+        xout_host = pipeline.createXLinkOut()
+        xout_host.setStreamName('nn_host')
+        host_nn.out.link(xout_host.input)
+        return host_nn
+
+    def build(self) -> dai.Pipeline:
+        print("building pipeline")
+        pipeline = dai.Pipeline()
+        print("including RBG in pipeline")
+        color_camera = self._createColorCamera(pipeline)
+        if len(self.controls) > 0:
+            buildCameraControl(self.controls, color_camera.initialControl)
+
+        # runtime camera controls are sent through here, changing them does not need a reboot
+        xin_control = pipeline.createXLinkIn()
+        xin_control.setStreamName('control')
+        xin_control.out.link(color_camera.inputControl)
+
+        # an idle device only passes some of the camera frames on, see OakCameraFactory.checkIdle
+        idle = None
+        if self.idleSeconds is not None:
+            throttle = pipeline.createXLinkIn()
+            throttle.setStreamName('throttle')
+            idle = pipeline.create(dai.node.Script)
+            throttle.out.link(idle.inputs['throttle'])
+            idle.inputs['throttle'].setBlocking(False)
+            idle.inputs['throttle'].setQueueSize(1)
+        for stream in self.streams:
+            if stream not in FRAME_STREAMS:
+                raise ValueError("invalid stream", stream)
+        if self.tracking and self.nnType != "yolo":
+            raise ValueError("tracking needs a yolo nn", self.nnType)
+        if self.trackerType not in TRACKER_TYPES:
+            raise ValueError("invalid tracker type", self.trackerType)
+        rgb_preview = "rgb" in self.streams and self.streamSize is None
+        rgb_video = "rgb" in self.streams and self.streamSize is not None
+        uses_preview = rgb_preview or "preview" in self.streams or self.blob is not None or (self.jpegEncoder and self.jpegSource == "preview")
+        preview = self._idleGate(idle, color_camera.preview, 'preview') if uses_preview else color_camera.preview
+        uses_video = rgb_video or (self.jpegEncoder and self.jpegSource == "video")
+        video = self._idleGate(idle, color_camera.video, 'video') if uses_video else color_camera.video
+        isp_width, isp_height = color_camera.getIspSize()
+        if rgb_video and (isp_width > MAX_VIDEO_SIZE[0] or isp_height > MAX_VIDEO_SIZE[1]):
+            raise ValueError("ISP output is too large for the video output, set isp_scale", (isp_width, isp_height))
+
+        # every stream has its own XLinkOut and host queue, so a large stream does not hold up a small one.
+        # The NN wants planar BGR from the preview, so the host's interleaved RGB is converted on the device.
+        if rgb_preview:
+            self._createFrameStream(pipeline, 'rgb', preview, self.previewSize)
+        if rgb_video:
+            self._createFrameStream(pipeline, 'rgb', video, self.rgbStreamSize(), resize=True)
+        if "preview" in self.streams:
+            print("including preview stream in pipeline")
+            self._createFrameStream(pipeline, 'preview', preview, self.previewSize)
+        if "isp" in self.streams:
+            print("including full resolution isp stream in pipeline")
+            # the ISP's own YUV420 goes out as it is, half the size of RGB and not limited to 4K like the
+            # video output. The host converts it when the frame is read.
+            xout_isp = pipeline.createXLinkOut()
+            xout_isp.setStreamName('isp')
+            self._idleGate(idle, color_camera.isp, 'isp').link(xout_isp.input)
+
+        if self.jpegEncoder:
+            print("including on-device jpeg encoder in pipeline from ", self.jpegSource)
+            jpeg_encoder = pipeline.create(dai.node.VideoEncoder)
+            jpeg_encoder.setDefaultProfilePreset(self.fps, dai.VideoEncoderProperties.Profile.MJPEG)
+            if self.jpegQuality is not None:
+                jpeg_encoder.setQuality(self.jpegQuality)
+            if self.jpegSource == "preview":
+                # the encoder only takes NV12, which the preview output cannot produce
+                nv12_manip = pipeline.create(dai.node.ImageManip)
+                nv12_manip.initialConfig.setFrameType(dai.ImgFrame.Type.NV12)
+                nv12_manip.setMaxOutputFrameSize(self.previewSize[0] * self.previewSize[1] * 3 // 2)
+                preview.link(nv12_manip.inputImage)
+                nv12_manip.out.link(jpeg_encoder.input)
+            elif self.jpegSource == "video":
+                video.link(jpeg_encoder.input)
+            else:
+                raise ValueError("invalid jpeg source", self.jpegSource)
+
+            xout_jpeg = pipeline.createXLinkOut()
+            xout_jpeg.setStreamName('jpeg')
+            jpeg_encoder.bitstream.link(xout_jpeg.input)
             
+        monos = None
+        if self.depth or self.spatial or any(stream in MONO_SOCKETS for stream in self.streams):
+            monos = self._createMonoCameras(pipeline, idle)
+        for stream in MONO_SOCKETS:
+            if monos is not None and stream in self.streams:
+                print("including mono ", stream, " stream in pipeline")
+                xout_mono = pipeline.createXLinkOut()
+                xout_mono.setStreamName(stream)
+                monos[stream].link(xout_mono.input)
+
+        stereo = None
+        if monos is not None and (self.depth or self.spatial):
+            stereo = self._createStereoDepth(pipeline, monos)
+
         if self.blob is not None:
             print("including neural net in pipeline: ", self.blob)
-            detection_nn = pipeline.create(dai.node.YoloDetectionNetwork)
-
-            detection_nn.setBlobPath(self.blob)
-            detection_nn.setNumClasses(80)
-            detection_nn.setConfidenceThreshold(0.8)
-            detection_nn.setNumInferenceThreads(1)
-            detection_nn.setCoordinateSize(4)
-            detection_nn.setIouThreshold(0.5)
-            detection_nn.setAnchors([10, 14, 23, 27, 37, 58, 81, 82, 135, 169, 344, 319])
-            detection_nn.setAnchorMasks({"side26": [1, 2, 3], "side13": [3, 4, 5]})
-            color_camera.preview.link(detection_nn.input)
+            if stereo is not None and self.spatial and self.nnType == "yolo":
+                # the VPU averages the depth inside each box, only boxes and centroids cross XLink
+                detection_nn = pipeline.create(dai.node.YoloSpatialDetectionNetwork)
+                self._configureDetectionNetwork(detection_nn)
+                detection_nn.setBoundingBoxScaleFactor(0.5)
+                detection_nn.setDepthLowerThreshold(100)
+                detection_nn.setDepthUpperThreshold(10000)
+                stereo.depth.link(detection_nn.inputDepth)
+            else:
+                detection_nn = self._createNeuralNetwork(pipeline)
+            nn_input = preview
+            if self.hasNnRate():
+                # the divisor is sent on 'nn_rate' after boot and whenever nnFps changes
+                nn_rate = pipeline.createXLinkIn()
+                nn_rate.setStreamName('nn_rate')
+                nn_input = self._throttle(pipeline, preview, nn_rate)
+            nn_input.link(detection_nn.input)
             detection_nn.input.setBlocking(False)
-            
+            if self.nnQueueSize is not None:
+                detection_nn.input.setQueueSize(self.nnQueueSize)
+
             xout_nn = pipeline.createXLinkOut()
             xout_nn.setStreamName('nn')
             detection_nn.out.link(xout_nn.input)
 
+            if self.tracking:
+                print("including object tracker in pipeline: ", self.trackerType)
+                self._createObjectTracker(pipeline, preview, detection_nn)
+
+        if self.blob is not None and self.hostInference:
+            self._createHostInference(pipeline)
+
+        if idle is not None:
+            # only now is it known which streams pass the script
+            idle.setScript(self._idleScript(idle))
         print("pipeline build complete")
         return pipeline
     
 
+class NotReadyError(TimeoutError):
+    """Raised by calls made before the device, or the model they need, is ready."""
+
+    def __init__(self, what:str, status:str, error:Union[str, None] = None) -> None:
+        super().__init__(what + " is not ready: " + status + ("" if error is None else " (" + error + ")"))
+        self.status = status
+        self.error = error
+
+
+class DeviceState:
+    """Everything the factory knows about one device, guarded by its own lock.
+
+    Queue lookups only read `queues`, which a boot replaces as a whole, so they never
+    wait on a boot or on another device.
+    """
+    mxid: str
+    lock: Lock
+    # serializes boots of this device, a requirement submitted during a boot schedules another one
+    bootLock: Lock
+    # keeps messages to the device in the order they were decided in, held while writing to XLink instead of lock
+    sendLock: RLock
+    device: Union[dai.Device, None]
+    # the settings the device is currently running
+    pipeline: Union[PipelineSettings, None]
+    requirements: dict[str, PipelineRequirement]
+    queues: dict[str, dai.DataOutputQueue]
+    bootTimer: Union[Timer, None]
+    bootSeconds: Union[float, None]
+    calibration: Union[dai.CalibrationHandler, None]
+    # product name of the device, like OAK-D-LITE, known after its first boot
+    deviceName: Union[str, None]
+    # when somebody last read from the device, and whether it is throttled for being idle since
+    lastDemand: float
+    idle: bool
+    # BOOTING, RUNNING, FAILED or STOPPED, with the error of a failed boot
+    status: str
+    error: Union[str, None]
+    # when a boot was first asked for, until the device runs
+    requested: Union[float, None]
+    # futures waiting for a boot to finish, and callbacks run on the booting thread once the device runs
+    ready: Waiters
+    listeners: list[Callable[[], None]]
+
+    def __init__(self, mxid:str) -> None:
+        self.mxid = mxid
+        self.lock = Lock()
+        self.bootLock = Lock()
+        self.sendLock = RLock()
+        self.device = None
+        self.pipeline = None
+        self.requirements = {}
+        self.queues = {}
+        self.bootTimer = None
+        self.bootSeconds = None
+        self.calibration = None
+        self.deviceName = None
+        self.lastDemand = time.monotonic()
+        self.idle = False
+        self.status = OakCameraFactory.BOOTING
+        self.error = None
+        self.requested = None
+        self.ready = Waiters()
+        self.listeners = []
+
+    def merged(self) -> Union[PipelineSettings, None]:
+        # called with lock held
+        if len(self.requirements) == 0:
+            return None
+        settings = PipelineSettings()
+        for requirement in self.requirements.values():
+            requirement.apply(settings)
+        return settings
+
+
+class DeviceIndex:
+    """Cached result of scanning the host for devices.
+
+    Looking a device up by mxid otherwise searches every XLink device again. Concurrent
+    boots share one scan, and a scan is only repeated once it is older than max_age or
+    a device is missing from it.
+    """
+    max_age: float
+
+    def __init__(self, max_age:float = 30.0, deviceClass:Any = dai.Device) -> None:
+        self.max_age = max_age
+        self.deviceClass = deviceClass
+        self.lock = Lock()
+        self.devices: dict[str, dai.DeviceInfo] = {}
+        self.scanned = 0.0
+        self.scans = 0
+
+    def find(self, mxid:str) -> dai.DeviceInfo:
+        with self.lock:
+            info = self.devices.get(mxid)
+            if info is None or time.monotonic() - self.scanned > self.max_age:
+                self._scan()
+                info = self.devices.get(mxid)
+        # not visible right now, let depthai search for it while booting
+        return info if info is not None else dai.DeviceInfo(mxid)
+
+    def forget(self, mxid:str):
+        # a booted or rebooting device changes its XLink state, the cached entry goes stale
+        with self.lock:
+            self.devices.pop(mxid, None)
+
+    def _scan(self):
+        self.devices = {info.getMxId(): info for info in self.deviceClass.getAllAvailableDevices()}
+        self.scanned = time.monotonic()
+        self.scans += 1
+
+
 class OakCameraFactory:
-    camera_lock: Lock = Lock()
-    cameras: dict[str,dai.Device] = {}
-    pipelines: dict[str, PipelineSettings] = {}
-    rgbQueues: dict[str, dai.DataOutputQueue] = {}
-    nnQueues: dict[str, dai.DataOutputQueue] = {}
+    """Owns the devices and composes one pipeline per device from the requirements of every resource using it.
+
+    Requirements are debounced, so resources configured together boot their device once.
+    Changes that only touch camera controls are sent to the running device instead.
+    Every device has its own state and lock, and boots run on a thread pool, so devices
+    come up in parallel and never wait on each other.
+    """
+    # how long to wait for more requirements before booting a device
+    BOOT_DEBOUNCE_SECONDS: ClassVar[float] = 0.5
+    # how many devices boot at the same time
+    BOOT_WORKERS: ClassVar[int] = 8
+    # host queue depth per stream, the full resolution frames are large and only the newest is read anyway
+    QUEUE_SIZES: ClassVar[dict[str, int]] = {"jpeg": 2, "isp": 2}
+
+    # what submit and withdraw report
+    UNCHANGED: ClassVar[str] = "unchanged"
+    RUNTIME: ClassVar[str] = "runtime"
+    REBOOT: ClassVar[str] = "reboot"
+
+    # what getStatus reports
+    BOOTING: ClassVar[str] = "booting"
+    RUNNING: ClassVar[str] = "running"
+    FAILED: ClassVar[str] = "failed"
+    STOPPED: ClassVar[str] = "stopped"
+
+    # what devices are opened with, anything with the interface of dai.Device, e.g. a SimulatedDevice
+    deviceClass: ClassVar[Any] = dai.Device
+    # only guards adding devices, never held while talking to one
+    devices_lock: Lock = Lock()
+    devices: dict[str, DeviceState] = {}
+    deviceIndex: DeviceIndex = DeviceIndex()
+    bootPool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=BOOT_WORKERS, thread_name_prefix="oak-boot")
+
+    @classmethod
+    def useDeviceClass(cls, deviceClass:Any):
+        """Open devices with deviceClass from now on, devices already open are not touched."""
+        cls.deviceClass = deviceClass
+        cls.deviceIndex = DeviceIndex(deviceClass=deviceClass)
+
+    def _state(self, mxid:str) -> DeviceState:
+        state = self.devices.get(mxid)
+        if state is not None:
+            return state
+        with self.devices_lock:
+            return self.devices.setdefault(mxid, DeviceState(mxid))
 
     def getDevice(self, mxid:str) -> Union[dai.Device,None]:
-        return self.cameras.get(mxid)
-    
-    def getRbgQueue(self, mxid:str) -> Union[dai.DataOutputQueue, None]:
-        self.camera_lock.acquire()
+        state = self.devices.get(mxid)
+        return None if state is None else state.device
+
+    def getPipelineSettings(self, mxid:str) -> Union[PipelineSettings, None]:
+        state = self.devices.get(mxid)
+        return None if state is None else state.pipeline
+
+    def getCalibration(self, mxid:str) -> Union[dai.CalibrationHandler, None]:
+        state = self.devices.get(mxid)
+        return None if state is None else state.calibration
+
+    def getDeviceName(self, mxid:str) -> Union[str, None]:
+        state = self.devices.get(mxid)
+        return None if state is None else state.deviceName
+
+    def getBootSeconds(self, mxid:str) -> Union[float, None]:
+        state = self.devices.get(mxid)
+        return None if state is None else state.bootSeconds
+
+    def getStatus(self, mxid:str) -> Tuple[str, Union[str, None]]:
+        """BOOTING, RUNNING, FAILED or STOPPED, and the error of a failed boot.
+
+        A device with a boot pending reports BOOTING although the old pipeline may still stream.
+        """
+        state = self.devices.get(mxid)
+        return (self.STOPPED, None) if state is None else (state.status, state.error)
+
+    def isReady(self, mxid:str) -> bool:
+        return self.getStatus(mxid)[0] == self.RUNNING
+
+    def whenReady(self, mxid:str) -> "asyncio.Future[None]":
+        """A future on the running event loop that resolves once the device runs its latest pipeline, or failed to boot it."""
+        state = self._state(mxid)
+        with state.lock:
+            if state.status in (self.RUNNING, self.FAILED):
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(None)
+                return future
+            return state.ready.wait()
+
+    async def waitReady(self, mxid:str, timeout:Union[float, None]) -> None:
+        """Wait up to timeout seconds for the device to run, raises NotReadyError if it does not.
+
+        A timeout of 0 only checks.
+        """
+        if self.isReady(mxid):
+            return
         try:
-            return self.rgbQueues.get(mxid, None)
-        finally:
-            self.camera_lock.release()
-    
+            await asyncio.wait_for(self.whenReady(mxid), timeout)
+        except asyncio.TimeoutError:
+            pass
+        status, error = self.getStatus(mxid)
+        if status != self.RUNNING:
+            raise NotReadyError("camera " + mxid, status, error)
+
+    def readiness(self, mxid:str) -> dict[str, Any]:
+        """The readiness of a device as the "ready" command of the resources reports it."""
+        status, error = self.getStatus(mxid)
+        readiness: dict[str, Any] = {"ready": status == self.RUNNING, "status": status}
+        if error is not None:
+            readiness["error"] = error
+        boot_seconds = self.getBootSeconds(mxid)
+        if boot_seconds is not None:
+            readiness["boot_seconds"] = boot_seconds
+        return readiness
+
+    def addBootListener(self, mxid:str, callback:Callable[[], None]):
+        """Call callback from the booting thread every time the device comes up, so workers find its queues at once."""
+        state = self._state(mxid)
+        with state.lock:
+            state.listeners.append(callback)
+
+    def removeBootListener(self, mxid:str, callback:Callable[[], None]):
+        state = self._state(mxid)
+        with state.lock:
+            if callback in state.listeners:
+                state.listeners.remove(callback)
+
+    def getQueue(self, mxid:str, name:str) -> Union[dai.DataOutputQueue, None]:
+        state = self.devices.get(mxid)
+        return None if state is None else state.queues.get(name, None)
+
+    def getRbgQueue(self, mxid:str) -> Union[dai.DataOutputQueue, None]:
+        return self.getQueue(mxid, "rgb")
+
     def getNnQueue(self, mxid:str) -> Union[dai.DataOutputQueue, None]:
-        self.camera_lock.acquire()
-        try:
-            return self.nnQueues.get(mxid, None)
-        finally:
-            self.camera_lock.release()
-    
-    def addRgbCameraToPipeline(self, mxid:str):
-        self.camera_lock.acquire()
-        print("adding rbg camera to pipeline")
-        try:
-            if self.pipelines[mxid] is None:
-                self.pipelines[mxid] = PipelineSettings()
-            self.pipelines[mxid].cameraSockets = [dai.CameraBoardSocket.CENTER]
+        return self.getQueue(mxid, "nn")
 
-            with self.cameras[mxid]:
-                print("closing existing camera ", mxid)
-            
-            print("building new camera ", mxid)
-            camera = dai.Device(self.pipelines[mxid].build(), dai.DeviceInfo(mxid))
-            self.cameras[mxid] = camera
-            
-            existing_queues = camera.getOutputQueueNames()
-            if "nn" in existing_queues and mxid in self.nnQueues:
-                print("there is an existing nn queue, closing ", mxid)
-                self.nnQueues[mxid].close()
-                self.nnQueues[mxid] = camera.getOutputQueue("nn", maxSize=4, blocking=False)
-            if "rgb" in existing_queues and mxid in self.rgbQueues:
-                print("there is an existing rbg queue, closing ", mxid)
-                self.rgbQueues[mxid].close()
-            
-            self.rgbQueues[mxid] = camera.getOutputQueue("rgb", maxSize=4, blocking=False)
-        finally:
-            self.camera_lock.release()
+    def getJpegQueue(self, mxid:str) -> Union[dai.DataOutputQueue, None]:
+        return self.getQueue(mxid, "jpeg")
+
+    def getDepthQueue(self, mxid:str) -> Union[dai.DataOutputQueue, None]:
+        return self.getQueue(mxid, "depth")
+
+    def getHostNnQueue(self, mxid:str) -> Union[dai.DataOutputQueue, None]:
+        return self.getQueue(mxid, "nn_host")
 
-    def addNeuralNetToPipeline(self, mxid:str, blob):
-        self.camera_lock.acquire()
-        print("adding neural net to pipeline")
+    def getInputQueue(self, mxid:str, name:str, maxSize:int = 4) -> Union[dai.DataInputQueue, None]:
+        state = self.devices.get(mxid)
+        device = None if state is None else state.device
+        if device is None or name not in device.getInputQueueNames():
+            return None
+        return device.getInputQueue(name, maxSize=maxSize, blocking=True)
+
+    def submit(self, mxid:str, resource:str, requirement:PipelineRequirement) -> str:
+        """Set what a resource needs from the device. Returns UNCHANGED, RUNTIME or REBOOT."""
+        state = self._state(mxid)
+        with state.lock:
+            state.requirements[resource] = requirement
+            change, sends = self._plan(state)
+        self._deliver(state, sends)
+        return change
+
+    def withdraw(self, mxid:str, resource:str) -> str:
+        """Drop a resource's requirement, the device is closed once nobody needs it."""
+        state = self._state(mxid)
+        with state.lock:
+            if state.requirements.pop(resource, None) is None:
+                return self.UNCHANGED
+            change, sends = self._plan(state)
+        self._deliver(state, sends)
+        return change
+
+    def _plan(self, state:DeviceState) -> Tuple[str, list[Callable[[], None]]]:
+        # called with state.lock held. Messages for the running device are returned instead of sent,
+        # the caller hands them to _deliver once the lock is released so XLink never blocks the lock.
+        settings = state.merged()
+        running = state.pipeline
+        if settings is None or running is None or settings.buildKey() != running.buildKey():
+            self._scheduleBoot(state)
+            print("device ", state.mxid, " needs a reboot")
+            state.status = self.BOOTING if settings is not None else self.STOPPED
+            if state.requested is None and settings is not None:
+                state.requested = time.monotonic()
+            return self.REBOOT, []
+        change = self.UNCHANGED
+        sends: list[Callable[[], None]] = []
+        device = state.device
+        if settings.controls != running.controls:
+            print("applying camera controls to running device ", state.mxid)
+            control = buildCameraControl(settings.controls, previous=running.controls)
+            sends.append(partial(self._sendControl, state.mxid, device, control))
+            running.controls = settings.controls
+            change = self.RUNTIME
+        if settings.runtimeKey() != running.runtimeKey():
+            for name in PipelineSettings.RUNTIME_FIELDS:
+                setattr(running, name, getattr(settings, name))
+            if state.idle:
+                sends.append(partial(self._sendThrottle, device, running.idleDivisor()))
+            if running.hasNnRate():
+                sends.append(partial(self._sendThrottle, device, running.nnDivisor(), "nn_rate"))
+            change = self.RUNTIME
+        return change, sends
+
+    def _deliver(self, state:DeviceState, sends:list[Callable[[], None]]):
+        # a boot may close the device meanwhile, its successor gets the settings in its pipeline
+        with state.sendLock:
+            for send in sends:
+                try:
+                    send()
+                except RuntimeError as e:
+                    print("cannot update device ", state.mxid, ": ", e)
+
+    def _sendControl(self, mxid:str, device:dai.Device, control:dai.CameraControl):
+        with stats.Timer(device_stats(mxid).stage("reconfigure")):
+            device.getInputQueue("control").send(control)
+
+    def demand(self, mxid:str):
+        """Note that somebody reads frames or NN results of a device, which brings an idle device back to full rate.
+
+        Called on every read, so it only takes the lock when the device is idle.
+        """
+        state = self.devices.get(mxid)
+        if state is None:
+            return
+        state.lastDemand = time.monotonic()
+        if state.idle:
+            with state.sendLock:
+                with state.lock:
+                    if not state.idle or state.device is None:
+                        return
+                    print("device ", mxid, " is read again, back to full frame rate")
+                    state.idle = False
+                    device = state.device
+                self._deliver(state, [partial(self._sendThrottle, device, 1)])
+
+    def checkIdle(self, mxid:str):
+        """Throttle a device nobody has read from for idleSeconds, the device workers call this regularly."""
+        state = self.devices.get(mxid)
+        settings = None if state is None else state.pipeline
+        if settings is None or settings.idleSeconds is None or state.idle:
+            return
+        if time.monotonic() - state.lastDemand < settings.idleSeconds:
+            return
+        with state.sendLock:
+            with state.lock:
+                if state.idle or state.device is None or state.pipeline is not settings:
+                    return
+                print("device ", mxid, " is idle, dropping to ", settings.idleFps, " fps")
+                # idle even if the send fails, otherwise every worker loop would retry it
+                state.idle = True
+                device = state.device
+            self._deliver(state, [partial(self._sendThrottle, device, settings.idleDivisor())])
+
+    def _sendThrottle(self, device:dai.Device, divisor:int, name:str = "throttle"):
+        # sends a divisor to the script behind the input name
+        message = dai.Buffer()
+        message.setData([divisor])
+        device.getInputQueue(name, maxSize=1, blocking=False).send(message)
+
+    def _scheduleBoot(self, state:DeviceState):
+        # called with state.lock held, restarts the debounce window
+        if state.bootTimer is not None:
+            state.bootTimer.cancel()
+        state.bootTimer = Timer(self.BOOT_DEBOUNCE_SECONDS, self.bootPool.submit, args=(self._boot, state))
+        state.bootTimer.daemon = True
+        state.bootTimer.start()
+
+    def _boot(self, state:DeviceState):
+        mxid = state.mxid
+        state.bootLock.acquire()
         try:
-            if self.pipelines[mxid] is None:
-                self.pipelines[mxid] = PipelineSettings()
-            if os.path.exists(blob) == False:
-                raise FileNotFoundError("blob not found", blob)
-            self.pipelines[mxid].blob = blob
+            with state.lock:
+                settings = state.merged()
+                running = state.pipeline
+                if settings is not None and running is not None and settings.buildKey() == running.buildKey():
+                    # only controls may have changed while the previous boot was running
+                    _, sends = self._plan(state)
+                    state.status = self.RUNNING
+                    state.requested = None
+                    skip = True
+                else:
+                    skip = False
+                    old_camera = state.device
+                    old_queues = state.queues
+                    state.device = None
+                    state.queues = {}
+                    state.pipeline = None
+                    state.calibration = None
+                    state.status = self.BOOTING if settings is not None else self.STOPPED
+            if skip:
+                self._deliver(state, sends)
+                state.ready.notify(lambda: None)
+                return
 
-            with self.cameras[mxid]:
+            for name, queue in old_queues.items():
+                print("closing existing ", name, " queue ", mxid)
+                queue.close()
+            if old_camera is not None:
                 print("closing existing camera ", mxid)
-            
+                old_camera.close()
+                self.deviceIndex.forget(mxid)
+            if settings is None:
+                return
+
             print("building new camera ", mxid)
-            camera = dai.Device(self.pipelines[mxid].build(), dai.DeviceInfo(mxid))
-            self.cameras[mxid] = camera
-            
-            existing_queues = camera.getOutputQueueNames()
-            if "nn" in existing_queues and mxid in self.nnQueues:
-                print("there is an existing nn queue, closing ", mxid)
-                self.nnQueues[mxid].close()
-                
-            if "rgb" in existing_queues and mxid in self.rgbQueues:
-                print("there is an existing rbg queue, closing ", mxid)
-                self.rgbQueues[mxid].close()
-                self.rgbQueues[mxid] = camera.getOutputQueue("rgb", maxSize=4, blocking=False)
-
-            self.nnQueues[mxid] = camera.getOutputQueue("nn", maxSize=4, blocking=False)
-        finally:
-            self.camera_lock.release()
-    
-    def createDevice(self, mxid:str) -> dai.Device:
-        self.camera_lock.acquire()
-        try:
-            camera = self.cameras.get(mxid)
-            if camera is None:
-                print("creating new camera")
-                
-                if self.pipelines.get(mxid, None) == None:
-                    self.pipelines[mxid] = PipelineSettings()
-                deviceInfo = dai.DeviceInfo(mxid)
-                camera = dai.Device(self.pipelines[mxid].build(), deviceInfo)
-                self.cameras[mxid] = camera
-            else:
-                print("found existing camera")
+            start = time.monotonic()
+            pipeline = settings.build()
+            camera = self.deviceClass(pipeline, self.deviceIndex.find(mxid))
+            queues = {}
+            for name in camera.getOutputQueueNames():
+                queues[name] = camera.getOutputQueue(name, maxSize=self.QUEUE_SIZES.get(name, 4), blocking=False)
+            boot_seconds = time.monotonic() - start
+            print("booted camera ", mxid, " in ", boot_seconds, "s")
+            device_stats(mxid).stage("boot").record(boot_seconds)
+            self.deviceIndex.forget(mxid)
+            # read once per boot, intrinsics are derived from it on demand
+            calibration = camera.readCalibration()
+            try:
+                device_name = camera.getDeviceName()
+            except Exception as e:
+                # older bootloaders have no product name in their EEPROM
+                print("cannot read device name of ", mxid, ": ", e)
+                device_name = "unknown"
 
+            with state.lock:
+                state.device = camera
+                state.queues = queues
+                state.calibration = calibration
+                state.deviceName = device_name
+                state.pipeline = settings
+                state.bootSeconds = boot_seconds
+                # a new pipeline starts at full frame rate
+                state.lastDemand = time.monotonic()
+                state.idle = False
+                state.status = self.RUNNING
+                state.error = None
+                if state.requested is not None:
+                    # includes the debounce and a boot of a previous pipeline that was still running
+                    device_stats(mxid).stage("ready").record(time.monotonic() - state.requested)
+                    state.requested = None
+                listeners = list(state.listeners)
+            if settings.hasNnRate():
+                # the script starts out passing every frame, if this fails the NN runs at the full rate
+                self._deliver(state, [partial(self._sendThrottle, camera, settings.nnDivisor(), "nn_rate")])
+            for listener in listeners:
+                listener()
+            state.ready.notify(lambda: None)
+        except Exception as e:
+            self.deviceIndex.forget(mxid)
+            print("failed to boot camera ", mxid, ": ", e)
+            with state.lock:
+                state.status = self.FAILED
+                state.error = str(e)
+            state.ready.notify(lambda: None)
         finally:
-            self.camera_lock.release()
-
-        return camera
-    
+            state.bootLock.release()
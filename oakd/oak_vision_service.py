@@ -1,34 +1,86 @@
+import asyncio
+import base64
+import os
+import time
+from concurrent.futures import Future
+from functools import partial
 from pathlib import Path
-from typing import Any, ClassVar, Dict, List, Mapping, Optional, Union, cast
+from typing import Any, ClassVar, Dict, List, Mapping, Optional, Tuple, Union, cast
 
-import blobconverter
-import depthai
+import numpy as np
+from depthai import Clock
 from PIL import Image
 from typing_extensions import Self
 from viam.components.component_base import ComponentBase
 from viam.logging import logging
-from viam.media.video import RawImage
+from viam.media.video import CameraMimeType, RawImage
 from viam.module.types import Reconfigurable, Stoppable
 from viam.proto.app.robot import ComponentConfig
-from viam.proto.common import PointCloudObject, ResourceName
+from viam.proto.common import (GeometriesInFrame, Geometry, PointCloudObject,
+                                Pose, RectangularPrism, ResourceName, Vector3)
 from viam.proto.service.vision import Classification, Detection
 from viam.resource.base import ResourceBase
 from viam.resource.types import Model
 from viam.services.vision import Vision
 from viam.utils import ValueTypes
 
-import numpy as np
-
-from oakd.oak_camera_factory import OakCameraFactory
+from oakd.blob_cache import BlobCache, ModelSpec
+from oakd.camera_thread import CAMERA_THREADS, CameraThread
+from oakd.detection_thread import (ClassificationResult, DetectionResult,
+                                   DetectionThread, Labels, NNResult,
+                                   TrackingResult, detection_threads,
+                                   label_name, load_labels)
+from oakd.frame_sync import synced_depth, synced_frame
+from oakd.host_inference import (HOST_INFERENCE_THREADS, HostInferenceThread,
+                                 image_size)
+from oakd.image_cache import ENCODABLE_MIME_TYPES
+from oakd.models import VISION_MODEL
+from oakd.nn_tuning import (FactoryTrialRunner, NNTuner, TrialResult,
+                            TuningStore, sweep)
+from oakd.oak_camera_factory import (TRACKER_TYPES, ColorCameraOptions,
+                                     NotReadyError, OakCameraFactory,
+                                     PipelineRequirement, PipelineSettings)
+from oakd.point_cloud import Intrinsics, deproject_box, encode_pcd
+from oakd.stats import device_stats
 
 # LOGGER: logging.Logger = logging.getLogger(__name__)
 
 class OakVisionService(Vision, Reconfigurable, Stoppable):
-    MODEL: ClassVar[Model] = Model.from_string("oak:vision:d")
+    MODEL: ClassVar[Model] = VISION_MODEL
 
     CameraFactory: ClassVar[OakCameraFactory]
+    BlobCache: ClassVar[BlobCache]
+    Tuning: ClassVar[TuningStore]
 
     mxid: str
+    worker: DetectionThread
+    # only acquired once a caller asks for frames paired with detections or for depth
+    frames: Union[CameraThread, None] = None
+    spatial: bool = False
+    # results come from the device's ObjectTracker, with a track id for every box
+    tracking: bool = False
+    # only set with host_inference, runs the images passed to get_detections on the device
+    host_worker: Union[HostInferenceThread, None] = None
+    # class names from label_path, indexed by the NN's class index
+    labels: Union[Labels, None] = None
+    # object point clouds keep depth within this many millimeters of the detection's centroid
+    OBJECT_DEPTH_BAND_MM: ClassVar[float] = 500
+    # results older than this are not handed out, callers wait for the next one instead
+    max_detection_age: float = 0.1
+    # bumped on every (re)configure so a slow compile cannot override a newer config
+    generation: int = 0
+    # the blob of the current config, and why it could not be loaded
+    compiled: "Future[Path]"
+    model_error: Union[str, None] = None
+    # with auto_tune, the tuned settings applied at configure and the sweep looking for them otherwise
+    tuned: Union[TrialResult, None] = None
+    tuner: Union[NNTuner, None] = None
+    # what _start_tuner sweeps with, None without auto_tune
+    tuning_args: Union[Tuple[Any, ...], None] = None
+    # the 'rgb' stream is only requested once get_detections_with_image asked for a frame
+    wants_image: bool = False
+    # the requirement submitted last, submitted again with the 'rgb' stream when a frame is first wanted
+    requirement: Union[PipelineRequirement, None] = None
 
     @classmethod
     def new(cls, config: ComponentConfig, dependencies: Mapping[ResourceName, ResourceBase]) -> Self:
@@ -38,13 +90,23 @@ class OakVisionService(Vision, Reconfigurable, Stoppable):
             
         """
         # "model_path": str
-        # "label_path": str
+        # "label_path": str, one class name per line
+        # "nn_type": "yolo|classifier"
         # "input_size_width_px": int
         # "input_size_height_px": int
         # "shaves": int
         # "data_type": str
         # "model_type": "openvino|caffe|tensorflow|onnx|zoo|raw"
         # "mxid": "cam0"
+        # "sensor_resolution", "isp_scale", "fps": see ColorCameraOptions
+        # "spatial": bool, use depth to locate detections in 3D for get_object_point_clouds
+        # "tracking": bool, follow detections with an on-device ObjectTracker
+        # "tracker_type": see TRACKER_TYPES
+        # "nn_fps": float, run the NN on fewer frames than the camera sends
+        # "inference_threads", "nce_per_thread", "nn_queue_size": int, NN performance knobs
+        # "auto_tune": bool, find the best shaves and NN knobs not set above and keep them per model and device type
+        # "tune_seconds": float, how long every tuning trial measures
+        # "tune_shaves": arr[int], shave counts tuning compiles the model for
         ## model specific settings
         # "zoo_type": str
         # "tf_optimizer_params": arr[str]
@@ -57,9 +119,15 @@ class OakVisionService(Vision, Reconfigurable, Stoppable):
 
         model = cls(config.name)
         print("creating new oak vision service")
+        model.mxid = ""
+        model._configure(config)
+
+        print("build vision service complete")
+        return model
 
+    def _configure(self, config: ComponentConfig):
         if "mxid" in config.attributes.fields:
-            model.mxid = config.attributes.fields["mxid"].string_value
+            mxid = config.attributes.fields["mxid"].string_value
         else:
             raise ValueError("mxid is required")
 
@@ -70,6 +138,12 @@ class OakVisionService(Vision, Reconfigurable, Stoppable):
         label_path = None
         if "label_path" in config.attributes.fields:
             label_path = config.attributes.fields["label_path"].string_value
+
+        nn_type = "yolo"
+        if "nn_type" in config.attributes.fields:
+            nn_type = config.attributes.fields["nn_type"].string_value
+        if nn_type not in ("yolo", "classifier"):
+            raise ValueError("nn_type must be yolo or classifier")
         
         input_size_width_px = None
         if "input_size_width_px" in config.attributes.fields:
@@ -120,79 +194,486 @@ class OakVisionService(Vision, Reconfigurable, Stoppable):
         if "raw_name" in config.attributes.fields:
             raw_name = config.attributes.fields["raw_name"].string_value
 
-        blob:Path
-        mt = "" if model_type is None else model_type.lower()
-        if mt == "zoo":
-            blob = blobconverter.from_zoo(name=model_path, shaves=6, zoo_type=zoo_type)
-        elif mt == "caffe":
-            blob = blobconverter.from_caffe(proto=caffe_proto, model=model_path, data_type=data_type, shaves=shaves)
-        elif mt == "tf":
-            blob = blobconverter.from_tf(frozen_pb=model_path, data_type=data_type, shaves=shaves, optimizer_params=tf_optimizer_params)
-        elif mt == "onnx":
-            blob = blobconverter.from_onnx(model=model_path, data_type=data_type, shaves=shaves)
-        elif mt == "openvino":
-            blob = blobconverter.from_openvino(xml=openvino_xml, bin=openvino_bin, data_type=data_type, shaves=shaves)
-        elif mt == "raw":
-            blob = blobconverter.from_config(name=raw_name, path=raw_config_path, data_type=data_type, shaves=shaves)
-        else:
-            raise ValueError("invalid model_type")
+        spec = ModelSpec(model_type, model_path, data_type, shaves, zoo_type, tf_optimizer_params,
+                         caffe_proto, openvino_xml, openvino_bin, raw_config_path, raw_name)
 
-        print("creating camera")
-        model.CameraFactory.createDevice(model.mxid)
-        print("adding neural net to pipeline")
-        model.CameraFactory.addNeuralNetToPipeline(model.mxid, blob)
+        input_size = None
+        if input_size_width_px is not None and input_size_height_px is not None:
+            input_size = (input_size_width_px, input_size_height_px)
+        elif input_size_width_px is not None or input_size_height_px is not None:
+            raise ValueError("input_size_width_px and input_size_height_px must be set together")
 
-        print("build vision service complete")
-        return model
+        options = ColorCameraOptions.fromAttributes(config.attributes.fields)
 
-    def frameNorm(self, bbox):
-        normVals = [416, 416, 416, 416]
-        return (np.clip(np.array(bbox), 0, 1) * normVals).astype(int)
-    
-    def get_detections_internal(self) -> List[Detection]:
-        print("called get detections!")
-        detections:List[Detection] = []
-        current_camera = self.CameraFactory.getDevice(self.mxid)
-        if current_camera is None:
-            raise ValueError("cannot get detections on non-existent camera")
-        
-        queue = self.CameraFactory.getNnQueue(self.mxid)
-        if queue is None:
-            print("NN queue not found")
-            return detections
-        in_nn = cast(depthai.ImgDetections, queue.get())
-        if in_nn is not None:
-            print("found detections: ", len(in_nn.detections))
-            for d in in_nn.detections:
-                f = self.frameNorm((d.xmin, d.ymin, d.xmax, d.ymax))
-                print("bounds: ", f, d.confidence)
-                detections.append(Detection(x_min=int(f[0]), x_max=int(f[1]), y_min=int(f[2]), y_max=int(f[3]), confidence=d.confidence))
+        self.spatial = False
+        if "spatial" in config.attributes.fields:
+            self.spatial = config.attributes.fields["spatial"].bool_value
+
+        # "host_inference" runs the images handed to get_detections through the device NN
+        host_inference = False
+        if "host_inference" in config.attributes.fields:
+            host_inference = config.attributes.fields["host_inference"].bool_value
+
+        tracking = False
+        if "tracking" in config.attributes.fields:
+            tracking = config.attributes.fields["tracking"].bool_value
+        if tracking and nn_type != "yolo":
+            raise ValueError("tracking needs nn_type yolo")
+
+        tracker_type = None
+        if "tracker_type" in config.attributes.fields:
+            tracker_type = config.attributes.fields["tracker_type"].string_value
+            if tracker_type not in TRACKER_TYPES:
+                raise ValueError("tracker_type must be one of " + ", ".join(TRACKER_TYPES))
+
+        nn_fps = None
+        if "nn_fps" in config.attributes.fields:
+            nn_fps = config.attributes.fields["nn_fps"].number_value
+            if nn_fps <= 0:
+                raise ValueError("nn_fps must be positive")
+            if nn_fps < (options.fps if options.fps is not None else PipelineSettings.fps) / PipelineSettings.MAX_THROTTLE_DIVISOR:
+                raise ValueError("nn_fps must be at least fps / " + str(PipelineSettings.MAX_THROTTLE_DIVISOR))
+
+        self.labels = load_labels(label_path)
+
+        # results carry the sequence number of the frame the NN saw, frames only cross XLink when wanted
+        fields: Dict[str, Any] = {"nnType": nn_type}
+        if input_size is not None:
+            fields["previewSize"] = input_size
+        if self.spatial:
+            fields["spatial"] = True
+        if host_inference:
+            fields["hostInference"] = True
+        if tracking:
+            fields["tracking"] = True
+        if tracker_type is not None:
+            fields["trackerType"] = tracker_type
+        if nn_fps is not None:
+            fields["nnFps"] = nn_fps
+        # knobs set here are left alone by auto_tune
+        fixed: Dict[str, Any] = {}
+        if shaves is not None:
+            fixed["shaves"] = shaves
+        if "inference_threads" in config.attributes.fields:
+            fields["inferenceThreads"] = fixed["threads"] = int(config.attributes.fields["inference_threads"].number_value)
+        if "nce_per_thread" in config.attributes.fields:
+            fields["ncePerThread"] = fixed["nce"] = int(config.attributes.fields["nce_per_thread"].number_value)
+        if "nn_queue_size" in config.attributes.fields:
+            fields["nnQueueSize"] = fixed["queue_size"] = int(config.attributes.fields["nn_queue_size"].number_value)
+
+        auto_tune = False
+        if "auto_tune" in config.attributes.fields:
+            auto_tune = config.attributes.fields["auto_tune"].bool_value
+
+        tune_seconds = 3.0
+        if "tune_seconds" in config.attributes.fields:
+            tune_seconds = config.attributes.fields["tune_seconds"].number_value
+            if tune_seconds <= 0:
+                raise ValueError("tune_seconds must be positive")
+
+        tune_shaves = None
+        if "tune_shaves" in config.attributes.fields:
+            tune_shaves = [int(v.number_value) for v in config.attributes.fields["tune_shaves"].list_value.values]
+
+        if "max_detection_age_ms" in config.attributes.fields:
+            self.max_detection_age = config.attributes.fields["max_detection_age_ms"].number_value / 1000.0
+
+        if mxid != self.mxid:
+            if self.mxid != "":
+                self.CameraFactory.withdraw(self.mxid, self._requirement_key())
+                self._stop_workers()
+            self.mxid = mxid
+            self.tracking = tracking
+            self.worker = detection_threads(tracking).acquire(mxid, self.CameraFactory)
+        elif tracking != self.tracking:
+            detection_threads(self.tracking).release(self.worker, timeout=1)
+            self.tracking = tracking
+            self.worker = detection_threads(tracking).acquire(mxid, self.CameraFactory)
+        if host_inference and self.host_worker is None:
+            self.host_worker = HOST_INFERENCE_THREADS.acquire(mxid, self.CameraFactory)
+        elif not host_inference and self.host_worker is not None:
+            HOST_INFERENCE_THREADS.release(self.host_worker, timeout=1)
+            self.host_worker = None
+        self._stop_tuner()
+        self.generation += 1
+        generation = self.generation
+        self.model_error = None
+
+        self.tuned = None
+        self.tuning_args = None
+        if auto_tune:
+            # a device seen before starts right away with what was tuned for its type
+            device_name = self.CameraFactory.getDeviceName(mxid) or self.Tuning.device_name(mxid)
+            self.tuned = None if device_name is None else self.Tuning.lookup(spec.tuning_key(), device_name, fixed)
+            self.tuning_args = (mxid, options, spec, dict(fields), fixed, tune_shaves, tune_seconds)
+            if self.tuned is not None:
+                print("vision service ", self.name, " using NN settings tuned for ", device_name, ": ", self.tuned.config)
+                spec = spec.with_shaves(self.tuned.config.shaves)
+                fields.update(self.tuned.config.fields())
+
+        # on a cache miss the service is usable right away and starts detecting once the blob is compiled.
+        # _blob_ready is the first callback, so waiters on the compile find the requirement submitted.
+        compiled = self.BlobCache.resolve(spec)
+        self.compiled = compiled
+        compiled.add_done_callback(lambda future: self._blob_ready(future, generation, mxid, fields, options))
+
+    def _blob_ready(self, future: "Future[Path]", generation: int, mxid: str, fields: Dict[str, Any], options: ColorCameraOptions):
+        if generation != self.generation:
+            # reconfigured while compiling, a newer blob is on its way
+            return
+        try:
+            blob = future.result()
+        except Exception as e:
+            print("failed to compile blob for vision service ", self.name, ": ", e)
+            self.model_error = str(e)
+            return
+        if os.path.exists(blob) == False:
+            print("blob not found ", blob)
+            self.model_error = "blob not found " + str(blob)
+            return
+
+        change = self._submit_requirement(mxid, PipelineRequirement(options, blob=blob, **fields))
+        print("vision service ", self.name, " pipeline change: ", change)
+        if self.tuning_args is not None and self.tuned is None:
+            self._start_tuner(generation, *self.tuning_args)
+
+    def _submit(self, generation: int, mxid: str, requirement: PipelineRequirement) -> bool:
+        # a tuner finishing a trial after a reconfigure must not bring its requirement back
+        if generation != self.generation:
+            return False
+        self._submit_requirement(mxid, requirement)
+        return True
+
+    def _submit_requirement(self, mxid: str, requirement: PipelineRequirement) -> str:
+        if self.wants_image:
+            # the 'rgb' stream carries the frames get_detections_with_image pairs with results
+            requirement = PipelineRequirement(requirement.options, **{**requirement.fields, "streams": ("rgb",)})
+        self.requirement = requirement
+        return self.CameraFactory.submit(mxid, self._requirement_key(), requirement)
+
+    def _start_tuner(self, generation: int, mxid: str, options: ColorCameraOptions, spec: ModelSpec, fields: Dict[str, Any],
+                     fixed: Dict[str, Any], shaves: Union[List[int], None], seconds: float, force: bool = False):
+        """Sweep the NN knobs not in fixed on the device and switch to the best, unless its type was tuned before."""
+        runner = FactoryTrialRunner(self.CameraFactory, mxid, partial(self._submit, generation, mxid), self.BlobCache, spec, options, fields, seconds)
+
+        def stored() -> Union[TrialResult, None]:
+            # the device type is only known once the device runs
+            if force or runner.wait_running(fields, tuner.stopped) is not None:
+                return None
+            device_name = self.CameraFactory.getDeviceName(mxid) or "unknown"
+            self.Tuning.remember_device(mxid, device_name)
+            return self.Tuning.lookup(spec.tuning_key(), device_name, fixed)
+
+        def done(tuner: NNTuner):
+            if generation != self.generation:
+                return
+            best = tuner.best
+            if best is None:
+                print("NN tuning of vision service ", self.name, " found nothing that runs, keeping the configured settings")
+                self._submit(generation, mxid, PipelineRequirement(options, blob=self.BlobCache.resolve(spec).result(), **fields))
+                return
+            if not tuner.from_store:
+                device_name = self.CameraFactory.getDeviceName(mxid) or "unknown"
+                self.Tuning.remember_device(mxid, device_name)
+                self.Tuning.save(spec.tuning_key(), device_name, fixed, best, tuner.results)
+            print("vision service ", self.name, " switching to tuned NN settings ", best.config, " at ", round(best.fps, 1), " fps")
+            self.tuned = best
+            try:
+                self._submit(generation, mxid, runner.requirement(best.config))
+            except Exception as e:
+                print("cannot apply tuned NN settings: ", e)
+
+        configs, queue_sizes = sweep(fixed, shaves)
+        tuner = NNTuner(runner, configs, queue_sizes, done, stored)
+        self.tuner = tuner
+        tuner.start()
+
+    def _stop_tuner(self):
+        if self.tuner is not None:
+            self.tuner.stop()
+            self.tuner = None
+
+    def tuning_status(self) -> Dict[str, Any]:
+        if self.tuner is not None:
+            status = self.tuner.snapshot()
+        elif self.tuned is not None:
+            status = {"status": "done", "from_store": True, "best": self.tuned.to_dict(), "trials": []}
         else:
-            print("no detections found!")
-        return detections
+            status = {"status": "off"}
+        status["device"] = self.CameraFactory.getDeviceName(self.mxid)
+        return status
+
+    def _requirement_key(self) -> str:
+        return "vision/" + self.name
+
+    def _stop_workers(self):
+        detection_threads(self.tracking).release(self.worker, timeout=1)
+        if self.host_worker is not None:
+            HOST_INFERENCE_THREADS.release(self.host_worker, timeout=1)
+            self.host_worker = None
+        if self.frames is not None:
+            CAMERA_THREADS.release(self.frames, timeout=1)
+            self.frames = None
+
+    def _frame_source(self) -> CameraThread:
+        if self.frames is None:
+            self.frames = CAMERA_THREADS.acquire(self.mxid, self.CameraFactory)
+        return self.frames
+
+    async def wait_ready(self, timeout: Optional[float] = None):
+        """Wait until the model is compiled and the device runs, raises NotReadyError if that takes longer than timeout."""
+        start = time.monotonic()
+        compiled = self.compiled
+        if not compiled.done():
+            try:
+                # shielded, the compile is shared with every service using the same model
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(compiled)), timeout)
+            except asyncio.TimeoutError:
+                raise NotReadyError("vision service " + self.name, "compiling")
+            except Exception:
+                pass
+        if self.model_error is not None:
+            raise NotReadyError("vision service " + self.name, OakCameraFactory.FAILED, self.model_error)
+        remaining = None if timeout is None else max(0.0, timeout - (time.monotonic() - start))
+        await self.CameraFactory.waitReady(self.mxid, remaining)
+
+    async def _wait_ready(self, timeout: Optional[float]) -> Optional[float]:
+        """Wait within the timeout of a call for the NN to run, returns what is left of the timeout.
+
+        A call without a timeout made while the model compiles or the device boots fails right away.
+        """
+        if self.worker.has_queue():
+            return timeout
+        start = time.monotonic()
+        await self.wait_ready(0 if timeout is None else timeout)
+        return None if timeout is None else max(0.0, timeout - (time.monotonic() - start))
+
+    def readiness(self) -> Dict[str, Any]:
+        if not self.compiled.done():
+            return {"ready": False, "status": "compiling"}
+        if self.model_error is not None:
+            return {"ready": False, "status": OakCameraFactory.FAILED, "error": self.model_error}
+        readiness = self.CameraFactory.readiness(self.mxid)
+        readiness["ready"] = readiness["ready"] and self.worker.has_queue()
+        return readiness
+
+    def _detection_transform(self):
+        settings = self.CameraFactory.getPipelineSettings(self.mxid)
+        return None if settings is None else settings.detectionTransform()
+
+    async def get_detection_result(self, extra: Optional[Mapping[str, Any]] = None, timeout: Optional[float] = None) -> NNResult:
+        """Latest NN result, or the next one if it is not fresh enough. Raises NotReadyError while the NN is not running.
+
+        extra may set "max_age_ms" to override max_detection_age, or "after_sequence" to only
+        accept results newer than a sequence number the caller has already seen.
+        """
+        max_age = self.max_detection_age
+        after_sequence = None
+        if extra is not None:
+            if "max_age_ms" in extra:
+                max_age = float(cast(float, extra["max_age_ms"])) / 1000.0
+            if "after_sequence" in extra:
+                after_sequence = int(cast(int, extra["after_sequence"]))
+
+        timeout = await self._wait_ready(timeout)
+        result = self.worker.get_latest(max_age, after_sequence)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while result is None:
+            # concurrent callers all wait on the same next packet instead of racing for the queue
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                result = await asyncio.wait_for(self.worker.next_result(), remaining)
+            except asyncio.TimeoutError:
+                raise TimeoutError("no detections received from camera " + self.mxid + " within " + str(timeout) + "s")
+            if after_sequence is not None and result.sequence <= after_sequence:
+                result = None
+        self.worker.stats.stage(self.worker.stream + "_to_return").record(Clock.now().total_seconds() - result.timestamp)
+        return result
+
+    async def get_detections_internal(self, extra: Optional[Mapping[str, Any]] = None, timeout: Optional[float] = None) -> List[Detection]:
+        result = await self.get_detection_result(extra, timeout)
+        transform = self._detection_transform()
+        if not isinstance(result, DetectionResult) or transform is None:
+            return []
+        # boxes are reported in the pixel space of the camera's rgb stream, which may be larger than the NN input
+        return result.detections(*transform, self.labels)
+
+    async def get_tracks(self, extra: Optional[Mapping[str, Any]] = None, timeout: Optional[float] = None) -> Tuple[List[Dict[str, Any]], int]:
+        """The objects the device tracks with their track ids and status, and the sequence number of their frame.
+
+        extra is passed on to get_detection_result.
+        """
+        if not self.tracking:
+            raise ValueError("tracks need tracking: true in the vision service config")
+        result = await self.get_detection_result(extra, timeout)
+        transform = self._detection_transform()
+        if not isinstance(result, TrackingResult) or transform is None:
+            return [], result.sequence
+        return result.tracks(*transform, self.labels), result.sequence
+
+    async def get_detections_with_image(self, mime_type: str = CameraMimeType.JPEG.value, *, extra: Optional[Mapping[str, Any]] = None, timeout: Optional[float] = None) -> Tuple[RawImage, List[Detection], int]:
+        """The rgb frame an NN result was computed on together with its detections and sequence number.
+
+        extra may set "max_age_ms" like get_detections.
+        """
+        mime, _ = CameraMimeType.from_lazy(mime_type)
+        if mime not in ENCODABLE_MIME_TYPES:
+            raise ValueError("unsupported mime type: " + mime_type)
+        max_age = self.max_detection_age
+        if extra is not None and "max_age_ms" in extra:
+            max_age = float(cast(float, extra["max_age_ms"])) / 1000.0
+
+        if not self.wants_image:
+            self.wants_image = True
+            if self.requirement is not None:
+                print("vision service ", self.name, " adding the rgb stream for images: ", self._submit_requirement(self.mxid, self.requirement))
+        timeout = await self._wait_ready(timeout)
+        frames = self._frame_source()
+        slot, result = await synced_frame(frames, self.worker, max_age, timeout)
+        try:
+            data = await frames.encoded.get(slot, mime)
+        finally:
+            frames.frames.release(slot)
+        transform = self._detection_transform()
+        detections = [] if transform is None or not isinstance(result, DetectionResult) else result.detections(*transform, self.labels)
+        return RawImage(data=data, mime_type=mime.value), detections, result.sequence
     
     async def get_detections_from_camera(self, camera_name: str, *, extra: Optional[Mapping[str, Any]] = None, timeout: Optional[float] = None) -> List[Detection]:
-        return self.get_detections_internal()
+        return await self.get_detections_internal(extra, timeout)
 
     async def get_detections(self, image: Union[Image.Image, RawImage], *, extra: Optional[Mapping[str, Any]] = None, timeout: Optional[float] = None) -> List[Detection]:
-        return self.get_detections_internal()
+        if self.host_worker is None:
+            # without host_inference the image is ignored and the live camera detections are returned
+            return await self.get_detections_internal(extra, timeout)
+        timeout = await self._wait_ready(timeout)
+        result = await self.host_worker.infer(image, timeout)
+        if not isinstance(result, DetectionResult):
+            return []
+        width, height = image_size(image)
+        return result.detections(np.zeros(4), np.array([width, height, width, height], dtype=float), self.labels)
     
     async def get_classifications_from_camera(self, camera_name: str, count: int, *, extra: Optional[Mapping[str, Any]] = None, timeout: Optional[float] = None) -> List[Classification]:
-        raise NotImplementedError()
+        result = await self.get_detection_result(extra, timeout)
+        if not isinstance(result, ClassificationResult):
+            return []
+        # repeated calls for the same frame reuse the result's top-k
+        return result.classifications(count, self.labels)
     
     async def get_classifications(self, image: Union[Image.Image, RawImage], count: int, *, extra: Optional[Mapping[str, Any]] = None, timeout: Optional[float] = None) -> List[Classification]:
-        raise NotImplementedError()
+        if self.host_worker is None:
+            # without host_inference the image is ignored and the live camera classifications are returned
+            return await self.get_classifications_from_camera("", count, extra=extra, timeout=timeout)
+        timeout = await self._wait_ready(timeout)
+        result = await self.host_worker.infer(image, timeout)
+        if not isinstance(result, ClassificationResult):
+            return []
+        return result.classifications(count, self.labels)
     
     async def get_object_point_clouds(self, camera_name: str, *, extra: Optional[Mapping[str, Any]] = None, timeout: Optional[float] = None) -> List[PointCloudObject]:
-        raise NotImplementedError()
+        if not self.spatial:
+            raise ValueError("object point clouds need spatial: true in the vision service config")
+        timeout = await self._wait_ready(timeout)
+        settings = self.CameraFactory.getPipelineSettings(self.mxid)
+        calibration = self.CameraFactory.getCalibration(self.mxid)
+        frames = self._frame_source()
+        if settings is None or calibration is None or not frames.has_depth_stream():
+            return []
+        result = await self.get_detection_result(extra, timeout)
+        if not isinstance(result, DetectionResult) or len(result.boxes) == 0:
+            return []
+
+        # the depth of the frame the NN saw, not whatever depth arrived last
+        try:
+            depth = await synced_depth(frames, result.timestamp, 1.0 / settings.fps, timeout)
+        except RuntimeError:
+            # the depth of an older result may have left the depth ring, the next result's depth is still held
+            result = await self.get_detection_result({"after_sequence": result.sequence}, timeout)
+            if not isinstance(result, DetectionResult) or len(result.boxes) == 0:
+                return []
+            depth = await synced_depth(frames, result.timestamp, 1.0 / settings.fps, timeout)
+        try:
+            isp, _ = settings.colorIntrinsics(calibration)
+            offset, scale = settings.previewToIsp()
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._object_point_clouds, result, depth.view, isp, offset, scale, camera_name)
+        finally:
+            frames.depth.release(depth)
+
+    def _object_point_clouds(self, result: DetectionResult, depth_mm: np.ndarray, isp: Intrinsics, offset: np.ndarray, scale: np.ndarray, reference_frame: str) -> List[PointCloudObject]:
+        # depth is aligned to the whole ISP frame while the NN only sees the preview crop of it
+        boxes = offset + np.clip(result.boxes, 0, 1) * scale
+        objects = []
+        for i in range(len(boxes)):
+            z_range = None
+            if result.spatial is not None and result.spatial[i, 2] > 0:
+                # the VPU's centroid tells the object apart from the background inside its box
+                z = float(result.spatial[i, 2])
+                z_range = (z - self.OBJECT_DEPTH_BAND_MM, z + self.OBJECT_DEPTH_BAND_MM)
+            points = deproject_box(depth_mm, isp, boxes[i], z_range)
+            if len(points) == 0:
+                continue
+            low = points.min(axis=0) * 1000
+            high = points.max(axis=0) * 1000
+            center = (low + high) / 2
+            dims = high - low
+            geometry = Geometry(
+                center=Pose(x=center[0], y=center[1], z=center[2], o_z=1),
+                box=RectangularPrism(dims_mm=Vector3(x=dims[0], y=dims[1], z=dims[2])),
+                label=label_name(self.labels, int(result.labels[i])),
+            )
+            objects.append(PointCloudObject(
+                point_cloud=encode_pcd(points),
+                geometries=GeometriesInFrame(reference_frame=reference_frame, geometries=[geometry]),
+            ))
+        return objects
     
     async def do_command(self, command: Mapping[str, ValueTypes], *, timeout: Optional[float] = None) -> Mapping[str, ValueTypes]:
-        raise NotImplementedError()
+        name = command.get("command")
+        if name == "get_tracks":
+            tracks, sequence = await self.get_tracks(command, timeout)
+            return {"sequence": sequence, "tracks": tracks}
+        if name == "get_detections_with_image":
+            mime_type = str(command.get("mime_type", CameraMimeType.JPEG.value))
+            image, detections, sequence = await self.get_detections_with_image(mime_type, extra=command, timeout=timeout)
+            return {
+                "image": base64.b64encode(image.data).decode("ascii"),
+                "mime_type": image.mime_type,
+                "sequence": sequence,
+                "detections": [
+                    {"x_min": d.x_min, "y_min": d.y_min, "x_max": d.x_max, "y_max": d.y_max, "confidence": d.confidence, "class_name": d.class_name}
+                    for d in detections
+                ],
+            }
+        if name == "stats":
+            return device_stats(self.mxid).snapshot()
+        if name == "ready":
+            # with "wait": true this returns once the NN runs or the call times out
+            if command.get("wait"):
+                try:
+                    await self.wait_ready(timeout)
+                except NotReadyError:
+                    pass
+            return self.readiness()
+        if name == "tuning":
+            # with "tune": true the sweep runs again even if the model was tuned for this device type before
+            if command.get("tune"):
+                if self.tuning_args is None:
+                    raise ValueError("tuning needs auto_tune: true in the vision service config")
+                self._stop_tuner()
+                self.generation += 1
+                self.tuned = None
+                self._start_tuner(self.generation, *self.tuning_args, force=True)
+            return self.tuning_status()
+        raise ValueError("unknown command: " + str(name))
     
     def reconfigure(self, config: ComponentConfig, dependencies: Mapping[ResourceName, ComponentBase]):
-        # todo...
-        pass
+        self._configure(config)
 
     def stop(self, *, extra: Optional[Mapping[str, Any]] = None, timeout: Optional[float] = None, **kwargs):
         print("Stop called in service")
+        # a compile finishing after this must not bring the requirement back
+        self.generation += 1
+        self._stop_tuner()
+        self._stop_workers()
+        self.CameraFactory.withdraw(self.mxid, self._requirement_key())
         return super().stop(extra=extra, timeout=timeout, **kwargs)
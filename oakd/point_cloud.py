@@ -0,0 +1,162 @@
+from functools import lru_cache
+from typing import Tuple, Union
+
+import numpy as np
+
+# the binary PCD layout viam reads: xyz in meters plus a packed 0x00RRGGBB colour
+PCD_DTYPE = np.dtype([("x", "<f4"), ("y", "<f4"), ("z", "<f4"), ("rgb", "<u4")])
+PCD_HEADER = (
+    "VERSION .7\n"
+    "FIELDS x y z rgb\n"
+    "SIZE 4 4 4 4\n"
+    "TYPE F F F I\n"
+    "COUNT 1 1 1 1\n"
+    "WIDTH {count}\n"
+    "HEIGHT 1\n"
+    "VIEWPOINT 0 0 0 1 0 0 0\n"
+    "POINTS {count}\n"
+    "DATA binary\n"
+)
+
+
+class Intrinsics:
+    """Pinhole intrinsics of an image of width x height pixels."""
+    width: int
+    height: int
+    fx: float
+    fy: float
+    cx: float
+    cy: float
+
+    def __init__(self, width: int, height: int, fx: float, fy: float, cx: float, cy: float) -> None:
+        self.width = width
+        self.height = height
+        self.fx = fx
+        self.fy = fy
+        self.cx = cx
+        self.cy = cy
+
+    @classmethod
+    def from_matrix(cls, matrix, width: int, height: int) -> "Intrinsics":
+        return cls(width, height, float(matrix[0][0]), float(matrix[1][1]), float(matrix[0][2]), float(matrix[1][2]))
+
+    def key(self) -> Tuple[int, int, float, float, float, float]:
+        return (self.width, self.height, self.fx, self.fy, self.cx, self.cy)
+
+    def scaled(self, width: int, height: int, offset: Tuple[float, float] = (0.0, 0.0), scale: Union[Tuple[float, float], None] = None) -> "Intrinsics":
+        """Intrinsics of the image this one maps to with pixel' = offset + pixel * scale.
+
+        scale defaults to a plain resize to width x height.
+        """
+        if scale is None:
+            scale = (width / self.width, height / self.height)
+        return Intrinsics(width, height, self.fx * scale[0], self.fy * scale[1], offset[0] + self.cx * scale[0], offset[1] + self.cy * scale[1])
+
+
+@lru_cache(maxsize=8)
+def ray_grid(intrinsics_key: Tuple[int, int, float, float, float, float]) -> np.ndarray:
+    """(height, width, 2) x/z and y/z of the ray through every pixel center.
+
+    Depends only on the intrinsics, so it is computed once per resolution instead of per frame.
+    """
+    width, height, fx, fy, cx, cy = intrinsics_key
+    u = (np.arange(width, dtype=np.float32) + 0.5 - cx) / fx
+    v = (np.arange(height, dtype=np.float32) + 0.5 - cy) / fy
+    rays = np.empty((height, width, 2), dtype=np.float32)
+    rays[:, :, 0] = u[np.newaxis, :]
+    rays[:, :, 1] = v[:, np.newaxis]
+    return rays
+
+
+@lru_cache(maxsize=8)
+def color_lookup(depth_size: Tuple[int, int], color_size: Tuple[int, int], offset: Tuple[float, float], scale: Tuple[float, float]) -> Tuple[np.ndarray, np.ndarray]:
+    """For every depth pixel, the flat index of the colour pixel it lands on and whether it lands inside the colour image.
+
+    offset and scale map normalized depth image coordinates to colour pixels.
+    """
+    depth_width, depth_height = depth_size
+    color_width, color_height = color_size
+    x = np.floor(offset[0] + (np.arange(depth_width) + 0.5) / depth_width * scale[0]).astype(np.int64)
+    y = np.floor(offset[1] + (np.arange(depth_height) + 0.5) / depth_height * scale[1]).astype(np.int64)
+    inside = ((y >= 0) & (y < color_height))[:, np.newaxis] & ((x >= 0) & (x < color_width))[np.newaxis, :]
+    index = np.clip(y, 0, color_height - 1)[:, np.newaxis] * color_width + np.clip(x, 0, color_width - 1)[np.newaxis, :]
+    return index, inside
+
+
+def deproject(depth_mm: np.ndarray, intrinsics: Intrinsics, mask: Union[np.ndarray, None] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """XYZ in meters of every pixel with a depth reading, and the boolean mask of those pixels.
+
+    intrinsics must describe the depth image, an extra mask limits the pixels used.
+    """
+    valid = depth_mm > 0
+    if mask is not None:
+        valid &= mask
+    z = depth_mm[valid].astype(np.float32) * np.float32(0.001)
+    rays = ray_grid(intrinsics.key())[valid]
+    points = np.empty((z.shape[0], 3), dtype=np.float32)
+    points[:, 0] = rays[:, 0] * z
+    points[:, 1] = rays[:, 1] * z
+    points[:, 2] = z
+    return points, valid
+
+
+def deproject_box(depth_mm: np.ndarray, intrinsics: Intrinsics, box: np.ndarray, z_range: Union[Tuple[float, float], None] = None) -> np.ndarray:
+    """XYZ in meters of the pixels inside a normalized (xmin, ymin, xmax, ymax) box of a depth frame.
+
+    Only the box is sliced out of the frame and the cached ray grid, z_range limits the
+    depth in millimeters, e.g. to drop the background behind an object.
+    """
+    height, width = depth_mm.shape
+    if (intrinsics.width, intrinsics.height) != (width, height):
+        intrinsics = intrinsics.scaled(width, height)
+    x0, x1 = np.clip(np.round(box[0::2] * width), 0, width).astype(np.int64)
+    y0, y1 = np.clip(np.round(box[1::2] * height), 0, height).astype(np.int64)
+    roi = depth_mm[y0:y1, x0:x1]
+    valid = roi > 0
+    if z_range is not None:
+        valid &= (roi >= z_range[0]) & (roi <= z_range[1])
+    z = roi[valid].astype(np.float32) * np.float32(0.001)
+    rays = ray_grid(intrinsics.key())[y0:y1, x0:x1][valid]
+    points = np.empty((z.shape[0], 3), dtype=np.float32)
+    points[:, 0] = rays[:, 0] * z
+    points[:, 1] = rays[:, 1] * z
+    points[:, 2] = z
+    return points
+
+
+def pack_rgb(colors: np.ndarray) -> np.ndarray:
+    """(N, 3) uint8 RGB rows as PCD packed 0x00RRGGBB values."""
+    colors = colors.astype(np.uint32)
+    return (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+
+
+def encode_pcd(points: np.ndarray, rgb: Union[np.ndarray, None] = None) -> bytes:
+    """Binary PCD of (N, 3) points in meters with optional packed colours."""
+    cloud = np.empty(points.shape[0], dtype=PCD_DTYPE)
+    cloud["x"] = points[:, 0]
+    cloud["y"] = points[:, 1]
+    cloud["z"] = points[:, 2]
+    cloud["rgb"] = 0 if rgb is None else rgb
+    return PCD_HEADER.format(count=points.shape[0]).encode("ascii") + cloud.tobytes()
+
+
+def depth_to_pcd(depth_mm: np.ndarray, intrinsics: Intrinsics, color: Union[np.ndarray, None] = None,
+                 color_offset: Tuple[float, float] = (0.0, 0.0), color_scale: Union[Tuple[float, float], None] = None) -> bytes:
+    """Binary PCD of a depth frame, coloured from an RGB frame when given.
+
+    color_offset and color_scale map normalized depth image coordinates to colour pixels,
+    by default the colour frame covers the same view as the depth frame. Points outside
+    the colour frame are left out, so the cloud shows what the colour image shows.
+    """
+    depth_size = (depth_mm.shape[1], depth_mm.shape[0])
+    intrinsics = intrinsics.scaled(*depth_size) if (intrinsics.width, intrinsics.height) != depth_size else intrinsics
+    if color is None:
+        points, _ = deproject(depth_mm, intrinsics)
+        return encode_pcd(points)
+
+    color_size = (color.shape[1], color.shape[0])
+    scale = color_size if color_scale is None else color_scale
+    index, inside = color_lookup(depth_size, color_size, tuple(color_offset), tuple(scale))
+    points, valid = deproject(depth_mm, intrinsics, inside)
+    colors = color.reshape(-1, 3)[index[valid]]
+    return encode_pcd(points, pack_rgb(colors))
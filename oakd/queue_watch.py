@@ -0,0 +1,126 @@
+import asyncio
+from threading import Lock
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from depthai import DataOutputQueue
+
+from oakd.rate_limited_log import RateLimitedLogger
+
+LOGGER = RateLimitedLogger(__name__)
+
+
+class QueueWatch:
+    """Tracks the device queue currently backing one stream and the wake-up callback registered on it."""
+    queue: Union[DataOutputQueue, None]
+    callback_id: Union[int, None]
+
+    def __init__(self, name: str, lookup: Callable[[str], Union[DataOutputQueue, None]]) -> None:
+        self.name = name
+        self.lookup = lookup
+        self.queue = None
+        self.callback_id = None
+
+    def update(self, mxid: str, callback: Callable[..., None]) -> bool:
+        """Follow the factory to the current queue, returns True if it changed."""
+        return self.attach(self.lookup(mxid), callback)
+
+    def attach(self, queue: Union[DataOutputQueue, None], callback: Callable[..., None]) -> bool:
+        if queue is self.queue:
+            return False
+        if self.queue is not None and self.callback_id is not None:
+            try:
+                self.queue.removeCallback(self.callback_id)
+            except RuntimeError:
+                # the old queue may already be closed by a reconfigure
+                pass
+        self.queue = queue
+        self.callback_id = None
+        if queue is not None:
+            self.callback_id = queue.addCallback(callback)
+        return True
+
+    def drain(self) -> List[Any]:
+        queue = self.queue
+        if queue is None:
+            return []
+        if queue.isClosed():
+            LOGGER.warning("%s queue is closed", self.name)
+            return []
+        try:
+            return queue.tryGetAll()
+        except RuntimeError:
+            # this is kind of expected when reconfiguring queues?
+            return []
+
+
+class Waiters:
+    """Asyncio futures waiting for the next packet of a stream, resolved from a worker thread."""
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def wait(self) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            self.waiters.append((loop, future))
+        return future
+
+    def waiting(self) -> bool:
+        return len(self.waiters) > 0
+
+    def notify(self, acquire: Callable[[], Any], release: Union[Callable[[Any], None], None] = None) -> None:
+        """Resolve every waiter with its own acquire() result, release() undoes it for waiters that gave up."""
+        with self.lock:
+            waiters = self.waiters
+            self.waiters = []
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future, acquire(), release)
+
+
+def _resolve(future: asyncio.Future, value: Any, release: Union[Callable[[Any], None], None]) -> None:
+    # runs on the waiter's event loop; the waiter may have timed out in the meantime
+    if not future.done():
+        future.set_result(value)
+    elif release is not None:
+        release(value)
+
+
+class WorkerRegistry:
+    """One started worker thread per mxid, shared by every resource on that device.
+
+    A device queue can only have one consumer, so resources acquire the shared worker
+    instead of creating their own. The worker is stopped when the last one releases it.
+    """
+
+    def __init__(self, create: Callable[[str, Any], Any]) -> None:
+        self.create = create
+        self.lock = Lock()
+        self.workers: Dict[str, Any] = {}
+        self.references: Dict[str, int] = {}
+
+    def acquire(self, mxid: str, camera_factory: Any) -> Any:
+        with self.lock:
+            worker = self.workers.get(mxid)
+            if worker is None:
+                worker = self.create(mxid, camera_factory)
+                worker.start()
+                self.workers[mxid] = worker
+                self.references[mxid] = 0
+            self.references[mxid] += 1
+            return worker
+
+    def release(self, worker: Any, timeout: Union[float, None] = None) -> None:
+        with self.lock:
+            mxid = worker.mxid
+            if self.workers.get(mxid) is not worker:
+                return
+            self.references[mxid] -= 1
+            if self.references[mxid] > 0:
+                return
+            del self.workers[mxid]
+            del self.references[mxid]
+        worker.stop()
+        worker.join(timeout)
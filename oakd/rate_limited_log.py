@@ -0,0 +1,43 @@
+import time
+from threading import Lock
+from typing import Any, Dict
+
+from viam.logging import getLogger, logging
+
+
+class RateLimitedLogger:
+    """Logs each kind of message at most once per interval, for messages that may repeat every frame.
+
+    Arguments are passed to the logger unformatted, so nothing is formatted unless the
+    message is actually emitted. The next emitted message says how many were suppressed.
+    """
+
+    def __init__(self, name: str, interval: float = 10.0) -> None:
+        self.logger = getLogger(name)
+        self.interval = interval
+        self.lock = Lock()
+        self.last: Dict[str, float] = {}
+        self.suppressed: Dict[str, int] = {}
+
+    def log(self, level: int, message: str, *args: Any) -> None:
+        # the unformatted message identifies the kind of message
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last.get(message, -self.interval) < self.interval:
+                self.suppressed[message] = self.suppressed.get(message, 0) + 1
+                return
+            self.last[message] = now
+            suppressed = self.suppressed.pop(message, 0)
+        if suppressed > 0:
+            self.logger.log(level, message + " (%d similar messages suppressed)", *args, suppressed)
+        else:
+            self.logger.log(level, message, *args)
+
+    def info(self, message: str, *args: Any) -> None:
+        self.log(logging.INFO, message, *args)
+
+    def warning(self, message: str, *args: Any) -> None:
+        self.log(logging.WARNING, message, *args)
+
+    def error(self, message: str, *args: Any) -> None:
+        self.log(logging.ERROR, message, *args)
@@ -0,0 +1,293 @@
+import json
+import mmap
+import os
+import time
+from threading import Lock
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+import numpy as np
+
+from oakd.rate_limited_log import RateLimitedLogger
+
+LOGGER = RateLimitedLogger(__name__)
+
+# one record per device sequence number from the first recorded one on, frames that did not
+# arrive have size 0. The record of a sequence number is at (sequence - first sequence) * 32.
+INDEX_DTYPE = np.dtype([("sequence", "<i8"), ("timestamp", "<f8"), ("offset", "<u8"), ("size", "<u8")])
+
+# data files go through a buffer this large, so the disk sees few large sequential writes
+WRITE_BUFFER_BYTES = 4 << 20
+INDEX_BUFFER_BYTES = 64 << 10
+
+# NN results are recorded as float32 rows, with these columns by kind:
+# yolo: xmin, ymin, xmax, ymax, confidence, label, spatial adds x, y, z in millimeters,
+# tracklets adds x, y, z, track id, status, age, classifier records one row of scores
+NN_COLUMNS: Dict[str, int] = {"yolo": 6, "spatial": 9, "tracklets": 12}
+
+
+class StreamWriter:
+    """Appends the packets of one stream to <stream>.data and their records to <stream>.index."""
+    first: Union[int, None]
+    last: Union[int, None]
+    offset: int
+    packets: int
+
+    def __init__(self, directory: str, stream: str) -> None:
+        self.data = open(os.path.join(directory, stream + ".data"), "wb", buffering=WRITE_BUFFER_BYTES)
+        self.index = open(os.path.join(directory, stream + ".index"), "wb", buffering=INDEX_BUFFER_BYTES)
+        self.first = None
+        self.last = None
+        self.offset = 0
+        self.packets = 0
+        self.record = np.zeros(1, dtype=INDEX_DTYPE)
+
+    def write(self, sequence: int, timestamp: float, payload: Any) -> bool:
+        """Append a packet, False if its sequence number is not past the last one, as after a device reboot."""
+        if self.last is not None and sequence <= self.last:
+            return False
+        if self.last is not None and sequence > self.last + 1:
+            # keeps the index dense, frames the host skipped or the device dropped get an empty record
+            gap = np.zeros(sequence - self.last - 1, dtype=INDEX_DTYPE)
+            gap["sequence"] = np.arange(self.last + 1, sequence)
+            gap["offset"] = self.offset
+            self.index.write(gap.tobytes())
+        if self.first is None:
+            self.first = sequence
+        data = memoryview(payload).cast("B")
+        self.data.write(data)
+        self.record[0] = (sequence, timestamp, self.offset, len(data))
+        self.index.write(self.record.tobytes())
+        self.offset += len(data)
+        self.last = sequence
+        self.packets += 1
+        return True
+
+    def close(self) -> None:
+        self.data.close()
+        self.index.close()
+
+
+class Recorder:
+    """Records the streams of one device into session directories under directory.
+
+    A session holds a data and an index file per stream, meta.json describing the streams and
+    calibration.json of the device. A new session starts when sequence numbers go back, which
+    happens when the device reboots.
+    """
+    directory: str
+    mxid: str
+    session: Union[str, None]
+    error: Union[str, None]
+
+    def __init__(self, directory: str, mxid: str, calibration: Union[Callable[[], Any], None] = None) -> None:
+        self.directory = directory
+        self.mxid = mxid
+        self.calibration = calibration
+        self.lock = Lock()
+        self.session = None
+        self.writers: Dict[str, StreamWriter] = {}
+        self.meta: Dict[str, Any] = {}
+        self.bytes = 0
+        self.error = None
+
+    def write(self, stream: str, kind: str, sequence: int, timestamp: float, payload: Any) -> None:
+        """Record one packet of a stream. kind tells a replay what the payload is, "jpeg" or an NN_COLUMNS kind."""
+        with self.lock:
+            if self.error is not None:
+                return
+            try:
+                writer = self.writers.get(stream)
+                if writer is None:
+                    writer = self._add_stream(stream, kind)
+                if not writer.write(sequence, timestamp, payload):
+                    LOGGER.info("device %s restarted, starting a new recording session", self.mxid)
+                    self._close_session()
+                    writer = self._add_stream(stream, kind)
+                    writer.write(sequence, timestamp, payload)
+                self.bytes += writer.offset - self.meta["streams"][stream].get("bytes", 0)
+                self.meta["streams"][stream]["bytes"] = writer.offset
+            except OSError as e:
+                # a full disk must not take the camera down, recording stops until it is configured again
+                LOGGER.error("recording of %s failed: %s", self.mxid, e)
+                self.error = str(e)
+                self._close_session()
+
+    def _open_session(self) -> None:
+        name = self.mxid + "-" + time.strftime("%Y%m%d-%H%M%S")
+        session = os.path.join(self.directory, name)
+        suffix = 1
+        while os.path.exists(session):
+            suffix += 1
+            session = os.path.join(self.directory, name + "-" + str(suffix))
+        os.makedirs(session)
+        self.session = session
+        self.meta = {"mxid": self.mxid, "started": time.time(), "streams": {}}
+        calibration = None if self.calibration is None else self.calibration()
+        if calibration is not None:
+            calibration.eepromToJsonFile(os.path.join(session, "calibration.json"))
+        LOGGER.info("recording %s to %s", self.mxid, session)
+
+    def _add_stream(self, stream: str, kind: str) -> StreamWriter:
+        if self.session is None:
+            self._open_session()
+        writer = self.writers[stream] = StreamWriter(self.session, stream)
+        self.meta["streams"][stream] = {"kind": kind}
+        self._write_meta()
+        return writer
+
+    def _write_meta(self) -> None:
+        for stream, writer in self.writers.items():
+            self.meta["streams"][stream].update(first=writer.first, last=writer.last, packets=writer.packets, bytes=writer.offset)
+        with open(os.path.join(self.session, "meta.json"), "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+    def _close_session(self) -> None:
+        # called with lock held
+        if self.session is None:
+            return
+        for writer in self.writers.values():
+            writer.close()
+        self._write_meta()
+        self.writers = {}
+        self.session = None
+
+    def status(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "session": self.session,
+                "bytes": self.bytes,
+                "error": self.error,
+                "packets": {stream: writer.packets for stream, writer in self.writers.items()},
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            self._close_session()
+
+
+class RecordingRegistry:
+    """The recorder of every device being recorded, shared by the threads writing its streams.
+
+    Every resource asking for a recording acquires it, the recording ends with the last release.
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.recorders: Dict[str, Recorder] = {}
+        self.owners: Dict[str, set] = {}
+
+    def acquire(self, mxid: str, owner: str, directory: str, calibration: Union[Callable[[], Any], None] = None) -> Recorder:
+        with self.lock:
+            recorder = self.recorders.get(mxid)
+            if recorder is not None and recorder.directory != directory:
+                if self.owners[mxid] != {owner}:
+                    raise ValueError("device " + mxid + " is already recorded to " + recorder.directory)
+                recorder.close()
+                recorder = None
+            if recorder is None:
+                recorder = self.recorders[mxid] = Recorder(directory, mxid, calibration)
+                self.owners[mxid] = set()
+            self.owners[mxid].add(owner)
+            return recorder
+
+    def release(self, mxid: str, owner: str) -> None:
+        with self.lock:
+            owners = self.owners.get(mxid)
+            if owners is None or owner not in owners:
+                return
+            owners.remove(owner)
+            if len(owners) > 0:
+                return
+            recorder = self.recorders.pop(mxid)
+            del self.owners[mxid]
+        recorder.close()
+
+    def get(self, mxid: str) -> Union[Recorder, None]:
+        # called for every packet, without the lock
+        return self.recorders.get(mxid)
+
+
+RECORDINGS = RecordingRegistry()
+
+
+class Recording:
+    """A recorded session opened for reading. Indexes and data are memory mapped, nothing is read up front."""
+    path: str
+    mxid: str
+    streams: Dict[str, Dict[str, Any]]
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.mxid = meta["mxid"]
+        self.streams = meta["streams"]
+        self.indexes: Dict[str, np.ndarray] = {}
+        self.data: Dict[str, Union[mmap.mmap, bytes]] = {}
+        for stream in self.streams:
+            index_path = os.path.join(path, stream + ".index")
+            data_path = os.path.join(path, stream + ".data")
+            count = os.path.getsize(index_path) // INDEX_DTYPE.itemsize
+            # a session that is still being written ends at the last complete record
+            self.indexes[stream] = np.memmap(index_path, dtype=INDEX_DTYPE, mode="r", shape=(count,)) if count > 0 else np.zeros(0, dtype=INDEX_DTYPE)
+            with open(data_path, "rb") as f:
+                self.data[stream] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(data_path) > 0 else b""
+
+    def index(self, stream: str) -> np.ndarray:
+        return self.indexes[stream]
+
+    def kind(self, stream: str) -> str:
+        return self.streams[stream]["kind"]
+
+    def sequences(self, stream: str) -> Tuple[int, int]:
+        """First and last sequence number of a stream, (0, -1) when it is empty."""
+        index = self.indexes[stream]
+        if len(index) == 0:
+            return 0, -1
+        return int(index[0]["sequence"]), int(index[-1]["sequence"])
+
+    def position(self, stream: str, sequence: int) -> Union[int, None]:
+        """The index position of a sequence number, looked up without a search."""
+        index = self.indexes[stream]
+        if len(index) == 0:
+            return None
+        position = sequence - int(index[0]["sequence"])
+        if position < 0 or position >= len(index):
+            return None
+        return position
+
+    def packet(self, stream: str, sequence: int) -> Union[Tuple[float, memoryview], None]:
+        """The capture timestamp and bytes of a stream's packet for a sequence number, None if it was not recorded."""
+        position = self.position(stream, sequence)
+        if position is None:
+            return None
+        return self.packet_at(stream, position)
+
+    def packet_at(self, stream: str, position: int) -> Union[Tuple[float, memoryview], None]:
+        record = self.indexes[stream][position]
+        size = int(record["size"])
+        if size == 0:
+            return None
+        offset = int(record["offset"])
+        return float(record["timestamp"]), memoryview(self.data[stream])[offset:offset + size]
+
+    def nn_rows(self, stream: str, data: memoryview) -> np.ndarray:
+        """A recorded NN result as its float32 rows, see NN_COLUMNS."""
+        values = np.frombuffer(data, dtype=np.float32)
+        columns = NN_COLUMNS.get(self.kind(stream))
+        return values.reshape(1, -1) if columns is None else values.reshape(-1, columns)
+
+
+def find_sessions(directory: str, mxid: Union[str, None] = None) -> List[str]:
+    """Recorded sessions in directory, of one device or of all, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    sessions = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(os.path.join(path, "meta.json")):
+            continue
+        if mxid is not None and not name.startswith(mxid + "-"):
+            continue
+        sessions.append(path)
+    return sessions
@@ -0,0 +1,266 @@
+import itertools
+import json
+import os
+import time
+from datetime import timedelta
+from threading import Event, Lock, Thread
+from typing import Any, ClassVar, Dict, List, Tuple, Union
+
+import cv2
+import depthai as dai
+import numpy as np
+
+from oakd.recording import Recording, find_sessions
+from oakd.simulated_device import (NN_KINDS, PipelineGraph, SimulatedDevice,
+                                   SimulatedImgFrame, SimulatedNNData, Stream)
+
+# frame types a replay makes out of the recorded colour video
+REPLAY_FRAME_TYPES = (dai.ImgFrame.Type.RGB888i, dai.ImgFrame.Type.BGR888i, dai.ImgFrame.Type.GRAY8)
+
+
+class ReplaySettings:
+    """What replay devices play back. Every device of a recording in directory shows up as available."""
+    directory: str
+    # 1.0 plays at the recorded pace, 2.0 twice as fast, 0 as fast as the host takes the packets
+    speed: float
+    # start over at the end of the recording, otherwise the device goes quiet
+    loop: bool
+    # a session directory to play instead of the newest session of the device
+    session: Union[str, None]
+    # how long creating a device takes
+    boot_seconds: float
+
+    def __init__(self, directory: str = ".", speed: float = 1.0, loop: bool = True, session: Union[str, None] = None,
+                 boot_seconds: float = 0.2) -> None:
+        if speed < 0:
+            raise ValueError("replay speed cannot be negative")
+        self.directory = directory
+        self.speed = speed
+        self.loop = loop
+        self.session = session
+        self.boot_seconds = boot_seconds
+
+
+class ReplayDevice(SimulatedDevice):
+    """Stands in for dai.Device by playing back a recording made with a camera's record_dir, see oakd/recording.py.
+
+    Streams of the pipeline are served from the recording: the MJPEG stream as recorded, frame
+    streams decoded from it and resized, and NN and tracker results as recorded. Streams the
+    recording cannot make, like depth, are left out. Packets keep their recorded sequence
+    numbers and spacing but carry the current time, so the rest of the module sees a live device.
+    """
+    settings: ClassVar[ReplaySettings] = ReplaySettings()
+
+    def __init__(self, pipeline: dai.Pipeline, info: Union[dai.DeviceInfo, None] = None, *args, **kwargs) -> None:
+        settings = self.settings
+        time.sleep(settings.boot_seconds)
+        path = settings.session
+        if path is None:
+            sessions = find_sessions(settings.directory, None if info is None else info.getMxId())
+            if len(sessions) == 0:
+                raise RuntimeError("no recording in " + settings.directory)
+            path = sessions[-1]
+        self.recording = Recording(path)
+        self.mxid = self.recording.mxid
+        print("replaying ", path)
+
+        graph = PipelineGraph(pipeline)
+        self.streams: Dict[str, Stream] = {}
+        has_video = "jpeg" in self.recording.streams
+        for name, stream in graph.streams().items():
+            if stream.kind == "frame" and has_video and stream.frame_type in REPLAY_FRAME_TYPES:
+                self.streams[name] = stream
+            elif stream.kind == "jpeg" and has_video:
+                self.streams[name] = stream
+            elif stream.kind in NN_KINDS.values() and stream.input_stream is None and name in self.recording.streams:
+                self.streams[name] = stream
+            elif stream.kind == "tracklets" and name in self.recording.streams:
+                self.streams[name] = stream
+            else:
+                print("recording has nothing for stream ", name)
+        # recorded results are offered even when the pipeline has no NN, like the simulator's settings.nn
+        for name in self.recording.streams:
+            if name not in self.streams and name != "jpeg":
+                self.streams[name] = Stream(self.recording.kind(name))
+        self.inputs = list(graph.named(dai.node.XLinkIn).keys())
+        self.output_queues = {}
+        self.input_queues = {}
+        self.lock = Lock()
+        self.scheduled = []
+        self.order = itertools.count()
+        # only every divisor-th frame is sent, set through the 'throttle' input like IDLE_SCRIPT.
+        # The NN rate of the recording stays as it was recorded.
+        self.divisor = 1
+        self.rate_divisors = {name: 1 for stream in self.streams.values() for name in stream.rate_inputs}
+
+        starts, ends = zip(*[self.recording.sequences(name) for name in self.recording.streams])
+        self.first = min(starts)
+        self.last = max(ends)
+        self.sequence = self.first
+        # added to recorded sequence numbers, so they keep growing when the recording loops
+        self.sequence_offset = 0
+        # (monotonic time, recorded timestamp) the pace is measured from, reset by seek
+        self.pace: Union[Tuple[float, float], None] = None
+        self.wake = Event()
+        self.closed = False
+        self.producer = Thread(target=self._produce, name="replay-" + self.mxid, daemon=True)
+        self.producer.start()
+
+    @classmethod
+    def getAllAvailableDevices(cls) -> List[dai.DeviceInfo]:
+        mxids = []
+        for path in find_sessions(cls.settings.directory) if cls.settings.session is None else [cls.settings.session]:
+            with open(os.path.join(path, "meta.json")) as f:
+                mxid = json.load(f)["mxid"]
+            if mxid not in mxids:
+                mxids.append(mxid)
+        return [dai.DeviceInfo(mxid) for mxid in mxids]
+
+    def getDeviceName(self) -> str:
+        # NN settings tuned on a replay say nothing about the recording device
+        return "REPLAY"
+
+    def readCalibration(self) -> dai.CalibrationHandler:
+        path = os.path.join(self.recording.path, "calibration.json")
+        if not os.path.exists(path):
+            print("recording has no calibration, using the simulator's")
+            return super().readCalibration()
+        return dai.CalibrationHandler(path)
+
+    def seek(self, sequence: int) -> None:
+        """Continue playback at a recorded sequence number. Finding it takes no search, see Recording.position."""
+        if sequence < self.first or sequence > self.last:
+            raise ValueError("sequence " + str(sequence) + " is not in the recording, which has " + str(self.first) + " to " + str(self.last))
+        with self.lock:
+            self.sequence = sequence
+            # sequence numbers only grow on a device, going back in the recording moves them ahead
+            self.sequence_offset += self.last - self.first + 1
+            self.pace = None
+        self.wake.set()
+
+    def position(self) -> Dict[str, Any]:
+        return {"session": self.recording.path, "sequence": self.sequence, "first": self.first, "last": self.last}
+
+    def _packets(self, sequence: int) -> Dict[str, Tuple[float, memoryview]]:
+        packets = {}
+        for name in self.recording.streams:
+            packet = self.recording.packet(name, sequence)
+            if packet is not None:
+                packets[name] = packet
+        return packets
+
+    def _replayed_frame(self, stream: Stream, data: np.ndarray, sequence: int, capture: timedelta) -> dai.ImgFrame:
+        frame = SimulatedImgFrame(data)
+        frame.setType(dai.ImgFrame.Type.BITSTREAM if stream.kind == "jpeg" else stream.frame_type)
+        frame.setWidth(stream.size[0])
+        frame.setHeight(stream.size[1])
+        frame.setSequenceNum(sequence)
+        frame.setTimestamp(capture)
+        return frame
+
+    def _replayed_result(self, name: str, data: memoryview, sequence: int, capture: timedelta) -> Any:
+        kind = self.recording.kind(name)
+        rows = self.recording.nn_rows(name, data)
+        if kind == "classifier":
+            result = SimulatedNNData(rows[0].tolist())
+        elif kind == "tracklets":
+            result = dai.Tracklets()
+            tracklets = []
+            for row in rows.tolist():
+                detection = dai.ImgDetection()
+                detection.xmin, detection.ymin, detection.xmax, detection.ymax, detection.confidence = row[:5]
+                detection.label = int(row[5])
+                tracklet = dai.Tracklet()
+                tracklet.roi = dai.Rect(dai.Point2f(row[0], row[1]), dai.Point2f(row[2], row[3]))
+                tracklet.srcImgDetection = detection
+                tracklet.label = int(row[5])
+                tracklet.spatialCoordinates = dai.Point3f(row[6], row[7], row[8])
+                tracklet.id = int(row[9])
+                tracklet.status = dai.Tracklet.TrackingStatus(int(row[10]))
+                tracklet.age = int(row[11])
+                tracklets.append(tracklet)
+            result.tracklets = tracklets
+        else:
+            spatial = kind == "spatial"
+            result = dai.SpatialImgDetections() if spatial else dai.ImgDetections()
+            detections = []
+            for row in rows.tolist():
+                detection = dai.SpatialImgDetection() if spatial else dai.ImgDetection()
+                detection.xmin, detection.ymin, detection.xmax, detection.ymax, detection.confidence = row[:5]
+                detection.label = int(row[5])
+                if spatial:
+                    detection.spatialCoordinates = dai.Point3f(row[6], row[7], row[8])
+                detections.append(detection)
+            result.detections = detections
+        result.setSequenceNum(sequence)
+        result.setTimestamp(capture)
+        return result
+
+    def _send_packets(self, recorded: int, packets: Dict[str, Tuple[float, memoryview]]) -> None:
+        sequence = recorded + self.sequence_offset
+        capture = dai.Clock.now()
+        video = packets.get("jpeg")
+        image = None
+        # decoded once, then resized for every frame stream
+        resized: Dict[Tuple[Tuple[int, int], bool], np.ndarray] = {}
+        for name, stream in self.streams.items():
+            if stream.kind == "jpeg" and video is not None:
+                self._send(name, self._replayed_frame(stream, np.frombuffer(video[1], dtype=np.uint8), sequence, capture))
+            elif stream.kind == "frame" and video is not None:
+                gray = stream.frame_type == dai.ImgFrame.Type.GRAY8
+                key = (stream.size, gray)
+                data = resized.get(key)
+                if data is None:
+                    if image is None:
+                        image = cv2.imdecode(np.frombuffer(video[1], dtype=np.uint8), cv2.IMREAD_COLOR)
+                    data = image if (image.shape[1], image.shape[0]) == stream.size else cv2.resize(image, stream.size, interpolation=cv2.INTER_AREA)
+                    data = cv2.cvtColor(data, cv2.COLOR_BGR2GRAY if gray else cv2.COLOR_BGR2RGB)
+                    resized[key] = data
+                if stream.frame_type == dai.ImgFrame.Type.BGR888i:
+                    data = np.ascontiguousarray(data[:, :, ::-1])
+                elif stream.frame_type == dai.ImgFrame.Type.YUV420p:
+                    data = cv2.cvtColor(data, cv2.COLOR_RGB2YUV_I420)
+                self._send(name, self._replayed_frame(stream, data, sequence, capture))
+            elif name in packets:
+                self._send(name, self._replayed_result(name, packets[name][1], sequence, capture))
+
+    def _produce(self) -> None:
+        cpu = time.thread_time()
+        while not self.closed:
+            with self.lock:
+                recorded = self.sequence
+                if recorded > self.last:
+                    if not self.settings.loop:
+                        recorded = None
+                    else:
+                        self.sequence_offset += self.last - self.first + 1
+                        self.sequence = recorded = self.first
+                        self.pace = None
+                if recorded is not None:
+                    self.sequence += 1
+            if recorded is None:
+                self.wake.wait(0.5)
+                self.wake.clear()
+                continue
+            if recorded % self.divisor != 0:
+                continue
+            packets = self._packets(recorded)
+            if len(packets) == 0:
+                # frames that never made it to the host were recorded as gaps
+                continue
+            timestamp = next(iter(packets.values()))[0]
+            if self.pace is None:
+                self.pace = (time.monotonic(), timestamp)
+            elif self.settings.speed > 0:
+                due = self.pace[0] + (timestamp - self.pace[1]) / self.settings.speed
+                self.wake.wait(max(0.0, due - time.monotonic()))
+                self.wake.clear()
+                if self.pace is None:
+                    # a seek came in while waiting, its first packet is sent right away
+                    continue
+            self._send_packets(recorded, packets)
+
+            used = time.thread_time()
+            with SimulatedDevice.cpu_lock:
+                SimulatedDevice.cpu_seconds += used - cpu
+            cpu = used
@@ -0,0 +1,261 @@
+"""Frames shared with other processes on the same host through a memory mapped ring file.
+
+A camera with `shared_memory: true` writes every frame of its stream into a ring of slots in
+a file under /dev/shm, readers map the same file and look at the frames in place. Only numpy
+and the standard library are imported here, so a reader does not need depthai or the viam SDK:
+
+    reader = SharedFrameReader(shared_frame_path("<mxid>", "rgb"))
+    frame = reader.next(timeout=1.0)
+    ... frame.array ...
+    if not frame.valid():
+        ... the writer reused the slot while frame.array was in use, drop the result ...
+
+The file starts with a FILE_HEADER, followed by `slots` slots of a SLOT_HEADER plus
+`capacity` bytes of frame data. Every slot is guarded by a seqlock: the writer makes the
+slot's lock odd before it touches the slot and even again once the slot holds a whole frame,
+a reader only accepts a frame if the lock was even and did not change while it read. The
+writer moves on to the next slot for every frame, so a frame stays valid for slots - 1 frame
+periods. The writer never waits for readers.
+
+Python cannot order stores with a memory barrier, so on weakly ordered CPUs such as ARM the
+lock alone can look unchanged while the header or pixels are from another frame. The slot
+header therefore also holds a CRC32 of the other header fields and the frame data, and a frame
+is only valid if the data a reader used still matches it.
+"""
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+from typing import Tuple, Union
+
+import numpy as np
+
+MAGIC = b"OAKRING2"
+# magic, slots, closed, slot data capacity, completed writes
+FILE_HEADER = struct.Struct("<8sIIQQ")
+WRITES_OFFSET = 24
+CLOSED_OFFSET = 12
+# seqlock, device sequence number, capture timestamp, height, width, channels, numpy dtype string, bytes, CRC32
+SLOT_HEADER = struct.Struct("<QqdIII8sQI")
+# the fields the CRC32 covers besides the data, everything between the seqlock and the CRC32
+SLOT_FIELDS = struct.Struct("<qdIII8sQ")
+# headers take a cache line, frame data starts aligned
+HEADER_SIZE = 64
+
+
+def shared_frame_path(mxid: str, stream: str, directory: Union[str, None] = None) -> str:
+    """Where the frames of a device stream are shared, in OAK_SHARED_MEMORY_DIR, /dev/shm or the temp directory."""
+    if directory is None:
+        directory = os.environ.get("OAK_SHARED_MEMORY_DIR")
+    if directory is None:
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "oak-" + mxid + "-" + stream)
+
+
+def _slot_offset(index: int, capacity: int) -> int:
+    return HEADER_SIZE + index * (HEADER_SIZE + capacity)
+
+
+def _checksum(fields: Tuple[int, float, int, int, int, bytes, int], data: np.ndarray) -> int:
+    return zlib.crc32(data.data, zlib.crc32(SLOT_FIELDS.pack(*fields)))
+
+
+class SharedFrameWriter:
+    """Writes frames into a new ring file at path, replacing any file there.
+
+    Frames larger than capacity replace the file with a larger one, readers follow on their own.
+    """
+    path: str
+    slots: int
+    capacity: int
+    writes: int
+    inode: int
+
+    def __init__(self, path: str, slots: int, capacity: int) -> None:
+        if slots < 2:
+            raise ValueError("a shared frame ring needs at least 2 slots")
+        self.path = path
+        self.slots = slots
+        # whole cache lines, so every slot's data stays aligned
+        self.capacity = (capacity + HEADER_SIZE - 1) // HEADER_SIZE * HEADER_SIZE
+        self.writes = 0
+        size = _slot_offset(slots, self.capacity)
+        # written under a temporary name and renamed, a reader never maps a half initialized file
+        temporary = path + ".new"
+        fd = os.open(temporary, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+            self.inode = os.fstat(fd).st_ino
+        finally:
+            os.close(fd)
+        FILE_HEADER.pack_into(self.map, 0, MAGIC, slots, 0, self.capacity, 0)
+        os.replace(temporary, path)
+
+    def write(self, frame: np.ndarray, sequence: int, timestamp: float) -> None:
+        """Copy a frame into the next slot and publish it."""
+        if frame.nbytes > self.capacity:
+            raise ValueError("frame does not fit the shared frame ring", frame.nbytes, self.capacity)
+        offset = _slot_offset(self.writes % self.slots, self.capacity)
+        lock = struct.unpack_from("<Q", self.map, offset)[0]
+        struct.pack_into("<Q", self.map, offset, lock + 1)
+        data = np.frombuffer(self.map, dtype=frame.dtype, count=frame.size, offset=offset + HEADER_SIZE).reshape(frame.shape)
+        data[...] = frame
+        # the mapping cannot be closed while an array still points into it
+        height, width = frame.shape[:2]
+        channels = frame.shape[2] if frame.ndim > 2 else 1
+        fields = (sequence, timestamp, height, width, channels, frame.dtype.str.encode(), frame.nbytes)
+        # taken from the slot, so it covers what readers will see
+        checksum = _checksum(fields, data)
+        del data
+        SLOT_HEADER.pack_into(self.map, offset, lock + 1, *fields, checksum)
+        struct.pack_into("<Q", self.map, offset, lock + 2)
+        self.writes += 1
+        struct.pack_into("<Q", self.map, WRITES_OFFSET, self.writes)
+
+    def close(self, unlink: bool = True) -> None:
+        """Mark the ring closed for readers and remove the file, unless it was already replaced by a newer writer."""
+        struct.pack_into("<I", self.map, CLOSED_OFFSET, 1)
+        if unlink:
+            try:
+                if os.stat(self.path).st_ino == self.inode:
+                    os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        self.map.close()
+
+
+class SharedFrame:
+    """One frame of a SharedFrameReader, `array` is a read-only view onto the ring.
+
+    The view is only trustworthy as long as valid() holds, check it after using the array.
+    """
+    array: np.ndarray
+    sequence: int
+    timestamp: float
+
+    def __init__(self, map: mmap.mmap, offset: int, lock: int, array: np.ndarray,
+                 fields: Tuple[int, float, int, int, int, bytes, int], checksum: int) -> None:
+        self._map = map
+        self._offset = offset
+        self._lock = lock
+        self._fields = fields
+        self._checksum = checksum
+        self.array = array
+        self.sequence = fields[0]
+        self.timestamp = fields[1]
+
+    def valid(self) -> bool:
+        """Whether the writer has left the slot alone since the frame was read, and the frame is whole."""
+        return self._unchanged() and self._whole(self.array)
+
+    def _unchanged(self) -> bool:
+        return struct.unpack_from("<Q", self._map, self._offset)[0] == self._lock
+
+    def _whole(self, array: np.ndarray) -> bool:
+        # header and pixels of one frame, whatever order the writer's stores became visible in
+        return _checksum(self._fields, array) == self._checksum
+
+
+class SharedFrameReader:
+    """Maps the ring file a SharedFrameWriter writes to, and reopens it when the writer replaces it."""
+    path: str
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.map: Union[mmap.mmap, None] = None
+        self.inode = -1
+        self._open()
+
+    def _open(self) -> bool:
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            inode = os.fstat(fd).st_ino
+            if inode == self.inode and self.map is not None:
+                return False
+            ring = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, slots, _, capacity, _ = FILE_HEADER.unpack_from(ring, 0)
+        if magic != MAGIC:
+            raise ValueError("not a shared frame ring", self.path)
+        # frames still in use keep the old mapping alive, it is unmapped once they are gone
+        self.map = ring
+        self.inode = inode
+        self.slots = slots
+        self.capacity = capacity
+        return True
+
+    def _ring(self) -> Union[mmap.mmap, None]:
+        if self.map is None or struct.unpack_from("<I", self.map, CLOSED_OFFSET)[0] != 0:
+            self._open()
+        return self.map
+
+    def writes(self) -> int:
+        """How many frames the writer has published, a cheap way to notice a new frame."""
+        ring = self._ring()
+        return 0 if ring is None else struct.unpack_from("<Q", ring, WRITES_OFFSET)[0]
+
+    def latest(self) -> Union[SharedFrame, None]:
+        """The newest frame without copying it, or None before the first frame."""
+        while True:
+            ring = self._ring()
+            if ring is None:
+                return None
+            writes = struct.unpack_from("<Q", ring, WRITES_OFFSET)[0]
+            if writes == 0:
+                return None
+            offset = _slot_offset((writes - 1) % self.slots, self.capacity)
+            lock, *fields, checksum = SLOT_HEADER.unpack_from(ring, offset)
+            if lock % 2 == 1:
+                # the writer is lapping the readers, try the slot it finished last
+                continue
+            _, _, height, width, channels, dtype_name, nbytes = fields
+            try:
+                dtype = np.dtype(dtype_name.rstrip(b"\0").decode())
+                shape: Tuple[int, ...] = (height, width) if channels == 1 else (height, width, channels)
+                array = np.frombuffer(ring, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset + HEADER_SIZE).reshape(shape)
+            except (TypeError, ValueError, UnicodeDecodeError):
+                # a header read while the writer was storing it
+                continue
+            frame = SharedFrame(ring, offset, lock, array, tuple(fields), checksum)
+            if frame._unchanged():
+                return frame
+
+    def read(self) -> Union[SharedFrame, None]:
+        """The newest frame copied out of the ring, which stays valid."""
+        while True:
+            frame = self.latest()
+            if frame is None:
+                return None
+            array = frame.array.copy()
+            if frame._unchanged() and frame._whole(array):
+                frame.array = array
+                return frame
+
+    def next(self, after_sequence: Union[int, None] = None, timeout: Union[float, None] = None, copy: bool = False,
+             poll_seconds: float = 0.0005) -> Union[SharedFrame, None]:
+        """Wait for a frame newer than after_sequence, polling the ring. None if none came within timeout.
+
+        Without after_sequence this waits for the next frame the writer publishes.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        writes = self.writes() if after_sequence is None else -1
+        while True:
+            if self.writes() != writes:
+                frame = self.read() if copy else self.latest()
+                if frame is not None and (after_sequence is None or frame.sequence > after_sequence):
+                    return frame
+                writes = self.writes()
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_seconds)
+
+    def close(self) -> None:
+        # a mapping with frames still in use is closed once they are collected
+        self.map = None
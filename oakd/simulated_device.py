@@ -0,0 +1,642 @@
+import heapq
+import itertools
+import time
+from collections import deque
+from datetime import timedelta
+from threading import Event, Lock, Thread
+from typing import Any, Callable, ClassVar, Deque, Dict, List, Tuple, Union
+
+import cv2
+import depthai as dai
+import numpy as np
+
+
+class SimulationSettings:
+    """How simulated devices behave. Resolutions and frame rates come from the pipeline itself."""
+    # what getAllAvailableDevices reports
+    mxids: List[str]
+    # how long creating a device takes
+    boot_seconds: float
+    # overrides the camera fps of the pipeline
+    fps: Union[float, None]
+    # objects in every simulated detection result
+    detections: int
+    # from capture until an NN result is sent, and for host fed NNs from input until the result
+    nn_latency: float
+    classes: int
+    # NN output to simulate when the pipeline has no NN: None, "yolo", "spatial" or "classifier".
+    # A real NN node needs a compiled blob, which is often not at hand where the simulator is used.
+    nn: Union[str, None]
+    # also simulate an ObjectTracker on the 'tracklets' stream for that NN
+    tracking: bool
+    # also answer images sent on 'nn_in' on 'nn_host' with that NN, like a pipeline with host_inference
+    host_nn: bool
+    # the NN runs on every nn_divisor-th frame until the host sends a divisor on 'nn_rate'
+    nn_divisor: int
+    # what getDeviceName reports, tuned NN settings are stored per device name
+    device_name: str
+    # time one inference of the camera fed NN takes with 6 shaves and one NCE. None answers every frame after
+    # nn_latency, otherwise the NN below is modelled and frames it has no time for are dropped at its input.
+    nn_inference_seconds: Union[float, None]
+    # shaves the blob is compiled for, inference threads, NCEs per thread and the NN input queue depth,
+    # like PipelineSettings. A pipeline without a blob has no NN node to read them from.
+    nn_shaves: int
+    nn_threads: int
+    nn_nce: int
+    nn_queue_size: int
+    # shaves left to the NN by the rest of the pipeline, every thread needs the blob's shaves
+    nn_available_shaves: int
+
+    def __init__(self, mxids: Union[List[str], None] = None, boot_seconds: float = 1.0, fps: Union[float, None] = None,
+                 detections: int = 3, nn_latency: float = 0.03, classes: int = 80, nn: Union[str, None] = None,
+                 tracking: bool = False, host_nn: bool = False, nn_divisor: int = 1, device_name: str = "SIMULATED",
+                 nn_inference_seconds: Union[float, None] = None, nn_shaves: int = 6, nn_threads: int = 1, nn_nce: int = 1,
+                 nn_queue_size: int = 5, nn_available_shaves: int = 13) -> None:
+        self.mxids = ["SIMULATED"] if mxids is None else mxids
+        self.boot_seconds = boot_seconds
+        self.fps = fps
+        self.detections = detections
+        self.nn_latency = nn_latency
+        self.classes = classes
+        self.nn = nn
+        self.tracking = tracking
+        self.host_nn = host_nn
+        self.nn_divisor = nn_divisor
+        self.device_name = device_name
+        self.nn_inference_seconds = nn_inference_seconds
+        self.nn_shaves = nn_shaves
+        self.nn_threads = nn_threads
+        self.nn_nce = nn_nce
+        self.nn_queue_size = nn_queue_size
+        self.nn_available_shaves = nn_available_shaves
+
+    def inference_seconds(self) -> Union[float, None]:
+        """How long one inference takes with the NN settings, None if the NN is not modelled.
+
+        More shaves help less than linearly, a second NCE makes it 1.6 times as fast and a second thread slows
+        every inference down by 15% for the memory they share. Raises like a device that cannot load the NN.
+        """
+        if self.nn_inference_seconds is None:
+            return None
+        if self.nn_threads * self.nn_shaves > self.nn_available_shaves:
+            raise RuntimeError("NN needs " + str(self.nn_threads * self.nn_shaves) + " shaves, only " + str(self.nn_available_shaves) + " are available")
+        if self.nn_threads * self.nn_nce > NCE_COUNT:
+            raise RuntimeError("NN needs " + str(self.nn_threads * self.nn_nce) + " NCEs, the device has " + str(NCE_COUNT))
+        seconds = self.nn_inference_seconds * (6 / self.nn_shaves) ** 0.6 / (1 + 0.6 * (self.nn_nce - 1))
+        return seconds * (1 + 0.15 * (self.nn_threads - 1))
+
+
+# neural compute engines of an RVC2 device
+NCE_COUNT = 2
+
+
+class SimulatedNNData(dai.NNData):
+    # NNData created on the host has no tensors, so the scores are handed out directly
+    def __init__(self, scores: List[float]) -> None:
+        super().__init__()
+        self.scores = scores
+
+    def getFirstLayerFp16(self) -> List[float]:
+        return self.scores
+
+
+class SimulatedImgFrame(dai.ImgFrame):
+    # hands out the shared synthetic frame like depthai hands out a view of the packet, instead of copying it in
+    def __init__(self, data: np.ndarray) -> None:
+        super().__init__()
+        self.data = data
+
+    def getData(self) -> np.ndarray:
+        return self.data
+
+
+class SimulatedOutputQueue:
+    """Stands in for dai.DataOutputQueue, filled by a SimulatedDevice."""
+
+    def __init__(self, name: str, max_size: int, blocking: bool) -> None:
+        self.name = name
+        # a full blocking queue stalls the device, which the simulator does not model, it drops like a non-blocking one
+        self.messages: Deque[Any] = deque(maxlen=max_size)
+        self.blocking = blocking
+        self.lock = Lock()
+        self.callbacks: Dict[int, Callable] = {}
+        self.callback_ids = itertools.count()
+        self.closed = False
+        self.available = Event()
+
+    def _push(self, message: Any) -> None:
+        with self.lock:
+            if self.closed:
+                return
+            self.messages.append(message)
+            callbacks = list(self.callbacks.values())
+        self.available.set()
+        for callback in callbacks:
+            callback(self.name, message)
+
+    def getName(self) -> str:
+        return self.name
+
+    def isClosed(self) -> bool:
+        return self.closed
+
+    def has(self) -> bool:
+        return len(self.messages) > 0
+
+    def tryGet(self) -> Any:
+        with self.lock:
+            return self.messages.popleft() if self.messages else None
+
+    def tryGetAll(self) -> List[Any]:
+        with self.lock:
+            messages = list(self.messages)
+            self.messages.clear()
+            self.available.clear()
+        return messages
+
+    def get(self) -> Any:
+        while True:
+            with self.lock:
+                if self.messages:
+                    return self.messages.popleft()
+                if self.closed:
+                    raise RuntimeError("queue " + self.name + " is closed")
+                self.available.clear()
+            self.available.wait(0.1)
+
+    def getAll(self) -> List[Any]:
+        messages = [self.get()]
+        return messages + self.tryGetAll()
+
+    def addCallback(self, callback: Callable) -> int:
+        with self.lock:
+            callback_id = next(self.callback_ids)
+            self.callbacks[callback_id] = callback
+        return callback_id
+
+    def removeCallback(self, callback_id: int) -> bool:
+        with self.lock:
+            return self.callbacks.pop(callback_id, None) is not None
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+        self.available.set()
+
+
+class SimulatedInputQueue:
+    """Stands in for dai.DataInputQueue, handing every message sent to the device."""
+
+    def __init__(self, name: str, receive: Callable[[str, Any], None]) -> None:
+        self.name = name
+        self.receive = receive
+        self.sent = 0
+        self.closed = False
+
+    def getName(self) -> str:
+        return self.name
+
+    def isClosed(self) -> bool:
+        return self.closed
+
+    def send(self, message: Any) -> None:
+        if self.closed:
+            raise RuntimeError("queue " + self.name + " is closed")
+        self.sent += 1
+        self.receive(self.name, message)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class Stream:
+    """What one XLinkOut of the pipeline emits: frames of a type and size, encoded frames, NN results or tracklets."""
+    kind: str
+    size: Tuple[int, int]
+    frame_type: Union[dai.ImgFrame.Type, None]
+    # for NN outputs, the XLinkIn feeding the NN when it does not run on camera frames
+    input_stream: Union[str, None]
+    # for NN outputs, the XLinkIns setting the divisor of throttle scripts in front of the NN, other than 'throttle'
+    rate_inputs: Tuple[str, ...]
+    # for tracklets, the kind of NN feeding the tracker
+    detections: Union[str, None]
+
+    def __init__(self, kind: str, size: Tuple[int, int] = (0, 0), frame_type: Union[dai.ImgFrame.Type, None] = None,
+                 input_stream: Union[str, None] = None, rate_inputs: Tuple[str, ...] = (), detections: Union[str, None] = None) -> None:
+        self.kind = kind
+        self.size = size
+        self.frame_type = frame_type
+        self.input_stream = input_stream
+        self.rate_inputs = rate_inputs
+        self.detections = detections
+
+
+# bytes per pixel of the frame types a pipeline can send to the host
+FRAME_BYTES: Dict[dai.ImgFrame.Type, float] = {
+    dai.ImgFrame.Type.RGB888i: 3, dai.ImgFrame.Type.BGR888i: 3, dai.ImgFrame.Type.RGB888p: 3, dai.ImgFrame.Type.BGR888p: 3,
+    dai.ImgFrame.Type.NV12: 1.5, dai.ImgFrame.Type.YUV420p: 1.5, dai.ImgFrame.Type.GRAY8: 1, dai.ImgFrame.Type.RAW8: 1,
+    dai.ImgFrame.Type.RAW16: 2,
+}
+NN_KINDS: Dict[str, str] = {
+    "YoloDetectionNetwork": "yolo",
+    "MobileNetDetectionNetwork": "yolo",
+    "YoloSpatialDetectionNetwork": "spatial",
+    "MobileNetSpatialDetectionNetwork": "spatial",
+    "NeuralNetwork": "classifier",
+}
+
+
+class PipelineGraph:
+    """Works out what a pipeline sends to the host by following its links back from every XLinkOut."""
+
+    def __init__(self, pipeline: dai.Pipeline) -> None:
+        self.nodes = {node.id: node for node in pipeline.getAllNodes()}
+        self.sources = {(c.inputId, c.inputName): (c.outputId, c.outputName) for c in pipeline.getConnections()}
+
+    def source(self, node: dai.Node, input_name: str) -> Union[Tuple[dai.Node, str], None]:
+        source = self.sources.get((node.id, input_name))
+        return None if source is None else (self.nodes[source[0]], source[1])
+
+    def named(self, node_type: type) -> Dict[str, dai.Node]:
+        return {node.getStreamName(): node for node in self.nodes.values() if isinstance(node, node_type)}
+
+    def streams(self) -> Dict[str, Stream]:
+        streams = {}
+        for name, xout in self.named(dai.node.XLinkOut).items():
+            source = self.source(xout, "in")
+            stream = None if source is None else self.stream(*source)
+            if stream is None:
+                print("simulator cannot produce stream ", name)
+                continue
+            streams[name] = stream
+        return streams
+
+    def stream(self, node: dai.Node, output: str) -> Union[Stream, None]:
+        kind = type(node).__name__
+        if kind in NN_KINDS:
+            source = self.source(node, "in")
+            fed_by = source[0] if source is not None else None
+            rate_inputs = []
+            # a host fed NN sits behind an XLinkIn, possibly with an ImageManip in between
+            while isinstance(fed_by, (dai.node.ImageManip, dai.node.Script)):
+                if isinstance(fed_by, dai.node.Script):
+                    throttle = self.source(fed_by, "throttle")
+                    if throttle is not None and isinstance(throttle[0], dai.node.XLinkIn) and throttle[0].getStreamName() != "throttle":
+                        rate_inputs.append(throttle[0].getStreamName())
+                source = self.source(fed_by, "inputImage" if isinstance(fed_by, dai.node.ImageManip) else "in")
+                fed_by = source[0] if source is not None else None
+            input_stream = fed_by.getStreamName() if isinstance(fed_by, dai.node.XLinkIn) else None
+            return Stream(NN_KINDS[kind], input_stream=input_stream, rate_inputs=tuple(rate_inputs))
+        if isinstance(node, dai.node.ObjectTracker):
+            source = self.source(node, "inputDetections")
+            nn = None if source is None else self.stream(*source)
+            if nn is None or nn.kind not in ("yolo", "spatial"):
+                return None
+            return Stream("tracklets", detections=nn.kind)
+        frame = self.frame(node, output)
+        if frame is None:
+            return None
+        if isinstance(node, dai.node.VideoEncoder):
+            return Stream("jpeg", frame[0])
+        return Stream("frame", *frame)
+
+    def frame(self, node: dai.Node, output: str) -> Union[Tuple[Tuple[int, int], dai.ImgFrame.Type], None]:
+        """Size and type of the frames a node output emits."""
+        if isinstance(node, dai.node.ColorCamera):
+            if output == "preview":
+                return node.getPreviewSize(), dai.ImgFrame.Type.RGB888i
+            if output == "video":
+                return node.getVideoSize(), dai.ImgFrame.Type.NV12
+            return node.getIspSize(), dai.ImgFrame.Type.YUV420p
+        if isinstance(node, dai.node.MonoCamera):
+            return node.getResolutionSize(), dai.ImgFrame.Type.GRAY8
+        if isinstance(node, dai.node.ImageManip):
+            source = self.source(node, "inputImage")
+            upstream = None if source is None else self.frame(*source)
+            if upstream is None:
+                return None
+            config = node.initialConfig
+            size = (config.getResizeWidth(), config.getResizeHeight()) if config.getResizeWidth() > 0 else upstream[0]
+            return size, config.getFormatConfig().type
+        if isinstance(node, dai.node.VideoEncoder):
+            source = self.source(node, "in")
+            return None if source is None else self.frame(*source)
+        if isinstance(node, dai.node.Script):
+            # scripts only ever pass frames through, like the throttle. The idle script passes each input on
+            # through the output of the same name.
+            source = self.source(node, "in" if output == "out" else output)
+            return None if source is None else self.frame(*source)
+        if isinstance(node, dai.node.StereoDepth):
+            source = self.source(node, "left")
+            mono = None if source is None else self.frame(*source)
+            if mono is None:
+                return None
+            decimation = node.initialConfig.get().postProcessing.decimationFilter.decimationFactor
+            size = (mono[0][0] // decimation, mono[0][1] // decimation)
+            return size, dai.ImgFrame.Type.RAW16 if output == "depth" else dai.ImgFrame.Type.RAW8
+        return None
+
+    def fps(self) -> float:
+        cameras = [node for node in self.nodes.values() if isinstance(node, (dai.node.ColorCamera, dai.node.MonoCamera))]
+        return max((camera.getFps() for camera in cameras), default=30.0)
+
+
+def synthetic_image(width: int, height: int, index: int) -> np.ndarray:
+    """An RGB test pattern with a square moving across it, so encoders see changing content."""
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:, :, 0] = x[np.newaxis, :]
+    image[:, :, 1] = y[:, np.newaxis]
+    image[:, :, 2] = 128
+    side = max(1, min(width, height) // 4)
+    left = (index * side // 2) % max(1, width - side)
+    image[height // 3:height // 3 + side, left:left + side] = 255
+    return image
+
+
+def synthetic_packet(stream: Stream, index: int) -> np.ndarray:
+    """Flat packet data of the index-th synthetic frame of a stream."""
+    width, height = stream.size
+    image = synthetic_image(width, height, index)
+    if stream.kind == "jpeg":
+        return cv2.imencode(".jpg", cv2.cvtColor(image, cv2.COLOR_RGB2BGR))[1].reshape(-1)
+    if stream.frame_type == dai.ImgFrame.Type.RAW16:
+        # a slanted floor from 4m at the top to 0.5m at the bottom, in millimeters
+        depth = np.linspace(4000, 500, height, dtype=np.uint16)[:, np.newaxis].repeat(width, axis=1)
+        return depth.reshape(-1).view(np.uint8)
+    if stream.frame_type in (dai.ImgFrame.Type.RGB888i, dai.ImgFrame.Type.BGR888i):
+        return image.reshape(-1)
+    if stream.frame_type in (dai.ImgFrame.Type.RGB888p, dai.ImgFrame.Type.BGR888p):
+        return image.transpose(2, 0, 1).reshape(-1).copy()
+    # only the size matters for the YUV and grey frame types
+    size = int(width * height * FRAME_BYTES.get(stream.frame_type, 1))
+    return np.resize(image[:, :, 1].reshape(-1), size)
+
+
+def synthetic_frames(stream: Stream, count: int) -> List[np.ndarray]:
+    """count different packets of a stream, generated once and cycled through."""
+    frames = [synthetic_packet(stream, index) for index in range(count)]
+    for frame in frames:
+        # shared by every packet of the stream, consumers must copy what they keep
+        frame.flags.writeable = False
+    return frames
+
+
+class SimulatedDevice:
+    """Stands in for dai.Device without hardware, see OakCameraFactory.useDeviceClass.
+
+    It emits synthetic frames on every stream the pipeline sends to the host, at the
+    camera's frame rate, with consecutive sequence numbers shared by all streams of a
+    frame like on a device. NN streams get moving detections or classification scores
+    after nn_latency, or as fast as the modelled NN gets through them, see
+    SimulationSettings.nn_inference_seconds. NNs fed through an XLinkIn answer every message sent to it.
+    """
+    settings: ClassVar[SimulationSettings] = SimulationSettings()
+    # CPU time spent by all simulated devices, so benchmarks can leave it out of the host's share
+    cpu_lock: ClassVar[Lock] = Lock()
+    cpu_seconds: ClassVar[float] = 0.0
+    # distinct frames generated per stream, cycled through
+    FRAME_VARIANTS: ClassVar[int] = 8
+
+    def __init__(self, pipeline: dai.Pipeline, info: Union[dai.DeviceInfo, None] = None, *args, **kwargs) -> None:
+        settings = self.settings
+        time.sleep(settings.boot_seconds)
+        self.inference_seconds = settings.inference_seconds()
+        graph = PipelineGraph(pipeline)
+        self.mxid = info.getMxId() if info is not None else settings.mxids[0]
+        self.streams = graph.streams()
+        if settings.nn is not None and not any(stream.kind in NN_KINDS.values() and stream.input_stream is None for stream in self.streams.values()):
+            self.streams["nn"] = Stream(settings.nn, rate_inputs=("nn_rate",))
+            if settings.tracking:
+                self.streams["tracklets"] = Stream("tracklets", detections=settings.nn)
+        self.inputs = list(graph.named(dai.node.XLinkIn).keys())
+        if settings.nn is not None and settings.host_nn and "nn_host" not in self.streams:
+            self.streams["nn_host"] = Stream(settings.nn, input_stream="nn_in")
+            self.inputs.append("nn_in")
+        self.fps = settings.fps if settings.fps is not None else graph.fps()
+        self.frames = {name: synthetic_frames(stream, self.FRAME_VARIANTS) for name, stream in self.streams.items() if stream.kind in ("frame", "jpeg")}
+        self.output_queues: Dict[str, SimulatedOutputQueue] = {}
+        self.input_queues: Dict[str, SimulatedInputQueue] = {}
+        self.lock = Lock()
+        # (due, order, stream name, message) sent once due
+        self.scheduled: List[Tuple[float, int, str, Any]] = []
+        self.order = itertools.count()
+        # only every divisor-th frame is sent, set through the 'throttle' input like IDLE_SCRIPT
+        self.divisor = 1
+        # NNs behind further throttle scripts only run on every divisor-th frame, by the XLinkIn setting it
+        self.rate_divisors = {name: 1 for stream in self.streams.values() for name in stream.rate_inputs}
+        if "nn_rate" in self.rate_divisors:
+            self.rate_divisors["nn_rate"] = settings.nn_divisor
+        # the sequence number every track was first seen on
+        self.tracks_seen: Dict[int, int] = {}
+        # for the modelled NN, by stream: (sequence, capture) of frames waiting at its input, oldest dropped when
+        # full, and when each inference thread is free again
+        self.nn_waiting: Dict[str, Deque[Tuple[int, timedelta]]] = {}
+        self.nn_free: Dict[str, List[float]] = {}
+        if self.inference_seconds is not None:
+            for name, stream in self.streams.items():
+                if stream.kind in NN_KINDS.values() and stream.input_stream is None:
+                    self.nn_waiting[name] = deque(maxlen=max(1, settings.nn_queue_size))
+                    self.nn_free[name] = [0.0] * settings.nn_threads
+        self.wake = Event()
+        self.closed = False
+        self.producer = Thread(target=self._produce, name="simulated-" + self.mxid, daemon=True)
+        self.producer.start()
+
+    @classmethod
+    def getAllAvailableDevices(cls) -> List[dai.DeviceInfo]:
+        return [dai.DeviceInfo(mxid) for mxid in cls.settings.mxids]
+
+    def getMxId(self) -> str:
+        return self.mxid
+
+    def getDeviceName(self) -> str:
+        return self.settings.device_name
+
+    def getOutputQueueNames(self) -> List[str]:
+        return list(self.streams.keys())
+
+    def getInputQueueNames(self) -> List[str]:
+        return list(self.inputs)
+
+    def getOutputQueue(self, name: str, maxSize: int = 16, blocking: bool = True) -> SimulatedOutputQueue:
+        if name not in self.streams:
+            raise RuntimeError("no output stream " + name)
+        with self.lock:
+            queue = self.output_queues.get(name)
+            if queue is None:
+                queue = self.output_queues[name] = SimulatedOutputQueue(name, maxSize, blocking)
+        return queue
+
+    def getInputQueue(self, name: str, maxSize: int = 16, blocking: bool = True) -> SimulatedInputQueue:
+        if name not in self.inputs:
+            raise RuntimeError("no input stream " + name)
+        with self.lock:
+            queue = self.input_queues.get(name)
+            if queue is None:
+                queue = self.input_queues[name] = SimulatedInputQueue(name, self._receive)
+        return queue
+
+    def readCalibration(self) -> dai.CalibrationHandler:
+        """Intrinsics of a 4056x3040 colour sensor and two 1280x800 mono sensors, without distortion."""
+        calibration = dai.CalibrationHandler(dai.EepromData())
+        sockets = [(dai.CameraBoardSocket.CAM_A, 4056, 3040, 3000.0), (dai.CameraBoardSocket.CAM_B, 1280, 800, 800.0), (dai.CameraBoardSocket.CAM_C, 1280, 800, 800.0)]
+        for socket, width, height, focal in sockets:
+            calibration.setCameraIntrinsics(socket, [[focal, 0.0, width / 2], [0.0, focal, height / 2], [0.0, 0.0, 1.0]], width, height)
+            calibration.setDistortionCoefficients(socket, [0.0] * 14)
+        return calibration
+
+    def isClosed(self) -> bool:
+        return self.closed
+
+    def close(self) -> None:
+        self.closed = True
+        self.wake.set()
+        self.producer.join()
+        with self.lock:
+            for queue in self.output_queues.values():
+                queue.close()
+            for input_queue in self.input_queues.values():
+                input_queue.close()
+
+    def _send(self, name: str, message: Any) -> None:
+        queue = self.output_queues.get(name)
+        if queue is not None:
+            queue._push(message)
+
+    def _schedule(self, due: float, name: str, message: Any) -> None:
+        with self.lock:
+            heapq.heappush(self.scheduled, (due, next(self.order), name, message))
+        self.wake.set()
+
+    def _receive(self, name: str, message: Any) -> None:
+        if name == "throttle":
+            self.divisor = max(1, int(message.getData()[0]))
+            return
+        if name in self.rate_divisors:
+            self.rate_divisors[name] = max(1, int(message.getData()[0]))
+            return
+        # messages to the control input only change settings a simulation does not have
+        for output, stream in self.streams.items():
+            if stream.input_stream == name:
+                capture = dai.Clock.now()
+                result = self._nn_result(stream.kind, message.getSequenceNum(), capture)
+                self._schedule(time.monotonic() + self.settings.nn_latency, output, result)
+
+    def _frame(self, name: str, stream: Stream, sequence: int, capture: timedelta) -> dai.ImgFrame:
+        frames = self.frames[name]
+        frame = SimulatedImgFrame(frames[sequence % len(frames)])
+        frame.setType(dai.ImgFrame.Type.BITSTREAM if stream.kind == "jpeg" else stream.frame_type)
+        frame.setWidth(stream.size[0])
+        frame.setHeight(stream.size[1])
+        frame.setSequenceNum(sequence)
+        frame.setTimestamp(capture)
+        return frame
+
+    def _nn_result(self, kind: str, sequence: int, capture: timedelta) -> Any:
+        settings = self.settings
+        if kind == "classifier":
+            scores = np.full(settings.classes, -4.0, dtype=np.float32)
+            scores[sequence % settings.classes] = 4.0
+            result = SimulatedNNData(scores.tolist())
+        else:
+            spatial = kind == "spatial"
+            result = dai.SpatialImgDetections() if spatial else dai.ImgDetections()
+            detections = []
+            for index in range(settings.detections):
+                detection = dai.SpatialImgDetection() if spatial else dai.ImgDetection()
+                # boxes drift across the image and wrap around
+                x = ((sequence * 0.01 + index / max(1, settings.detections)) % 0.8)
+                y = 0.1 + 0.6 * index / max(1, settings.detections)
+                detection.xmin, detection.ymin, detection.xmax, detection.ymax = x, y, x + 0.2, y + 0.2
+                detection.label = index % settings.classes
+                detection.confidence = 0.9 - 0.1 * (index % 5)
+                if spatial:
+                    detection.spatialCoordinates = dai.Point3f((x - 0.4) * 2000.0, (y - 0.4) * 2000.0, 1000.0 + 500.0 * index)
+                detections.append(detection)
+            result.detections = detections
+        result.setSequenceNum(sequence)
+        result.setTimestamp(capture)
+        return result
+
+    def _tracklets(self, kind: str, sequence: int, capture: timedelta) -> dai.Tracklets:
+        # the simulated objects move smoothly, so the tracker knows where they are on every frame.
+        # Detection index i is track i.
+        detections = self._nn_result(kind, sequence, capture)
+        tracklets = []
+        for index, detection in enumerate(detections.detections):
+            tracklet = dai.Tracklet()
+            tracklet.id = index
+            tracklet.label = detection.label
+            tracklet.roi = dai.Rect(dai.Point2f(detection.xmin, detection.ymin), dai.Point2f(detection.xmax, detection.ymax))
+            tracklet.srcImgDetection = detection
+            if kind == "spatial":
+                tracklet.spatialCoordinates = detection.spatialCoordinates
+            tracklet.status = dai.Tracklet.TrackingStatus.TRACKED if index in self.tracks_seen else dai.Tracklet.TrackingStatus.NEW
+            tracklet.age = sequence - self.tracks_seen.setdefault(index, sequence)
+            tracklets.append(tracklet)
+        result = dai.Tracklets()
+        result.tracklets = tracklets
+        result.setSequenceNum(sequence)
+        result.setTimestamp(capture)
+        return result
+
+    def _run_inferences(self, now: float) -> Union[float, None]:
+        """Hand waiting frames to free inference threads of the modelled NNs, returns when the next thread frees up for a waiting frame."""
+        free_at = None
+        for name, waiting in self.nn_waiting.items():
+            free = self.nn_free[name]
+            while waiting:
+                thread = min(range(len(free)), key=free.__getitem__)
+                if free[thread] > now:
+                    free_at = free[thread] if free_at is None else min(free_at, free[thread])
+                    break
+                sequence, capture = waiting.popleft()
+                free[thread] = now + self.inference_seconds
+                # the result goes out when the inference is done, transfer to the host is left out
+                self._schedule(free[thread], name, self._nn_result(self.streams[name].kind, sequence, capture))
+        return free_at
+
+    def _produce(self) -> None:
+        period = 1.0 / self.fps
+        next_frame = time.monotonic()
+        sequence = 0
+        cpu = time.thread_time()
+        while not self.closed:
+            now = time.monotonic()
+            if now >= next_frame and sequence % self.divisor != 0:
+                sequence += 1
+                next_frame = max(next_frame + period, now)
+            elif now >= next_frame:
+                capture = dai.Clock.now()
+                for name, stream in self.streams.items():
+                    if stream.kind in ("frame", "jpeg"):
+                        self._send(name, self._frame(name, stream, sequence, capture))
+                    elif stream.kind == "tracklets":
+                        self._send(name, self._tracklets(stream.detections, sequence, capture))
+                    elif stream.input_stream is None and all(sequence % self.rate_divisors[rate] == 0 for rate in stream.rate_inputs):
+                        if name in self.nn_waiting:
+                            self.nn_waiting[name].append((sequence, capture))
+                        else:
+                            self._schedule(now + self.settings.nn_latency, name, self._nn_result(stream.kind, sequence, capture))
+                sequence += 1
+                # a slow host does not make a device catch up on missed frames
+                next_frame = max(next_frame + period, now)
+            nn_free_at = self._run_inferences(now)
+            with self.lock:
+                due = []
+                while self.scheduled and self.scheduled[0][0] <= now:
+                    due.append(heapq.heappop(self.scheduled))
+                wait_until = min(next_frame, self.scheduled[0][0]) if self.scheduled else next_frame
+                if nn_free_at is not None:
+                    wait_until = min(wait_until, nn_free_at)
+            for _, _, name, message in due:
+                self._send(name, message)
+
+            used = time.thread_time()
+            with SimulatedDevice.cpu_lock:
+                SimulatedDevice.cpu_seconds += used - cpu
+            cpu = used
+            self.wake.wait(max(0.0, wait_until - time.monotonic()))
+            self.wake.clear()
@@ -0,0 +1,172 @@
+import bisect
+import time
+from threading import Lock
+from typing import Any, Dict, List, Union
+
+# histogram bucket upper bounds in seconds, 25% apart from 50us to about a minute
+HISTOGRAM_BOUNDS: List[float] = [0.00005 * 1.25 ** i for i in range(64)]
+
+
+class Histogram:
+    """Latency histogram with fixed log-spaced buckets, recording is a bisect and a few adds."""
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        index = bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction of samples, in seconds."""
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            largest = self.max
+        if count == 0:
+            return 0.0
+        target = fraction * count
+        seen = 0
+        for index, bucket in enumerate(counts):
+            seen += bucket
+            if seen >= target:
+                return min(largest, HISTOGRAM_BOUNDS[index]) if index < len(HISTOGRAM_BOUNDS) else largest
+        return largest
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram()
+        with self.lock:
+            histogram.counts = list(self.counts)
+            histogram.count = self.count
+            histogram.total = self.total
+            histogram.max = self.max
+        return histogram
+
+    def since(self, earlier: "Histogram") -> "Histogram":
+        """The samples recorded after earlier was copied from this histogram. Their max is the top of the highest bucket."""
+        histogram = self.copy()
+        histogram.counts = [now - then for now, then in zip(histogram.counts, earlier.counts)]
+        histogram.count -= earlier.count
+        histogram.total -= earlier.total
+        used = [index for index, bucket in enumerate(histogram.counts) if bucket > 0]
+        if not used:
+            histogram.max = 0.0
+        elif used[-1] < len(HISTOGRAM_BOUNDS):
+            histogram.max = min(histogram.max, HISTOGRAM_BOUNDS[used[-1]])
+        return histogram
+
+    def snapshot(self) -> Dict[str, Any]:
+        count = self.count
+        return {
+            "count": count,
+            "mean_ms": 1000 * self.total / count if count > 0 else 0.0,
+            "p50_ms": 1000 * self.percentile(0.5),
+            "p90_ms": 1000 * self.percentile(0.9),
+            "p99_ms": 1000 * self.percentile(0.99),
+            "max_ms": 1000 * self.max,
+        }
+
+
+class QueueStats:
+    """Packet rate and losses of one device output queue.
+
+    Frames dropped on the device or by a full non-blocking queue show up as gaps in the
+    sequence numbers, frames the host drained but skipped for a newer one are counted apart.
+    """
+    # weight of the newest interval in the smoothed frame period
+    SMOOTHING = 0.1
+
+    def __init__(self) -> None:
+        self.received = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.last_sequence = -1
+        self.last_received = 0.0
+        self.period = 0.0
+
+    def packet(self, sequence: int, skipped: int = 0) -> None:
+        now = time.monotonic()
+        if self.last_received > 0:
+            interval = (now - self.last_received) / (skipped + 1)
+            self.period = interval if self.period == 0 else self.period + self.SMOOTHING * (interval - self.period)
+        if self.last_sequence >= 0 and sequence > self.last_sequence:
+            self.dropped += max(0, sequence - self.last_sequence - 1 - skipped)
+        self.received += skipped + 1
+        self.skipped += skipped
+        self.last_sequence = sequence
+        self.last_received = now
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "fps": 1.0 / self.period if self.period > 0 else 0.0,
+            "received": self.received,
+            "dropped": self.dropped,
+            "skipped": self.skipped,
+        }
+
+
+class DeviceStats:
+    """Latency histograms per pipeline stage and rates per queue of one device."""
+
+    def __init__(self, mxid: str) -> None:
+        self.mxid = mxid
+        self.lock = Lock()
+        self.stages: Dict[str, Histogram] = {}
+        self.queues: Dict[str, QueueStats] = {}
+
+    def stage(self, name: str) -> Histogram:
+        histogram = self.stages.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.stages.setdefault(name, Histogram())
+        return histogram
+
+    def queue(self, name: str) -> QueueStats:
+        queue = self.queues.get(name)
+        if queue is None:
+            with self.lock:
+                queue = self.queues.setdefault(name, QueueStats())
+        return queue
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "mxid": self.mxid,
+            "stages": {name: histogram.snapshot() for name, histogram in list(self.stages.items())},
+            "queues": {name: queue.snapshot() for name, queue in list(self.queues.items())},
+        }
+
+
+_devices_lock = Lock()
+_devices: Dict[str, DeviceStats] = {}
+
+
+def device_stats(mxid: str) -> DeviceStats:
+    stats = _devices.get(mxid)
+    if stats is None:
+        with _devices_lock:
+            stats = _devices.setdefault(mxid, DeviceStats(mxid))
+    return stats
+
+
+class Timer:
+    """Context manager recording how long its block took into a histogram."""
+
+    def __init__(self, histogram: Union[Histogram, None]) -> None:
+        self.histogram = histogram
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self.histogram is not None:
+            self.histogram.record(time.perf_counter() - self.start)